@@ -1,36 +1,128 @@
 #! /usr/bin/env python
 # Copyright (c) Polyconseil SAS. All rights reserved.
 
+import contextlib
+import json
 import logging
 
 import click
 
 from . import __version__
-from . import builders
-from . import cleanners
-from . import helpers
+from . import events
 from . import loggers
-from . import utils
+from . import profiling
+
+# Modules importing docker, requests, jinja2, yaml or packaging are imported by the commands using them,
+# to keep `grocker --help` (and `--version`) fast.
 
 logger = logging.getLogger('grocker')
 
 
+def parse_option(parser_name):
+    """Return a click callback parsing an option value with a grocker.helpers parser."""
+    def callback(ctx, param, value):
+        from . import helpers
+
+        if value is None:
+            return None
+        try:
+            return getattr(helpers, parser_name)(value)
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+    return callback
+
+
 @click.group()
 @click.version_option(__version__)
 @click.option('-v', '--verbose', count=True)
-def main(verbose):
+@click.option(
+    '--output-format', type=click.Choice(sorted(events.RENDERERS)), default='human', show_default=True,
+    help="format of the build output (ndjson to get a JSON object by line)",
+)
+def main(verbose, output_format):
     loggers.setup(verbose > 0)
+    events.setup(output_format)
 
 
 @main.command()
 @click.option('-a', '--all-versions/--only-old-versions', default=False)
 @click.option('-f', '--including-final-images/--excluding-final-images', default=False)
-def purge(all_versions, including_final_images):
+@click.option('-n', '--dry-run', is_flag=True, help="only report what would be deleted")
+@click.option(
+    '-j', '--jobs', type=click.IntRange(min=1), default=8, metavar='<number>', show_default=True,
+    help="maximum number of concurrent deletions",
+)
+@click.option(
+    '--max-cache-size', callback=parse_option('parse_size'), metavar='<size>',
+    help="delete the least recently used wheel volumes until they fit in this size (eg 20G, 20GiB)",
+)
+@click.option(
+    '--max-age', callback=parse_option('parse_duration'), metavar='<duration>',
+    help="delete the wheel volumes not used for this duration (eg 30d, 12h)",
+)
+def purge(all_versions, including_final_images, dry_run, jobs, max_cache_size, max_age):
     """Purge Grocker created Docker stuff."""
+    from . import cleanners
+    from . import utils
+
+    docker_client = utils.docker_get_client()
+    options = {'dry_run': dry_run, 'workers': jobs}
+    results = [
+        # Shared wheel servers first, they use wheel volumes
+        ('wheel servers', cleanners.docker_stop_shared_wheel_servers(
+            docker_client, current_version=all_versions, **options,
+        )),
+        ('containers', cleanners.docker_purge_container(docker_client, current_version=all_versions, **options)),
+        ('volumes', cleanners.docker_purge_volumes(docker_client, current_version=all_versions, **options)),
+        ('images', cleanners.docker_purge_images(
+            docker_client, current_version=all_versions, runner=including_final_images, **options,
+        )),
+    ]
+    if max_cache_size is not None or max_age is not None:
+        results.append(('wheel volumes', cleanners.docker_evict_wheel_volumes(
+            docker_client, max_size=max_cache_size, max_age=max_age, **options,
+        )))
+    for kind, (count, size) in results:
+        click.echo('%s %d %s (%s)' % (
+            'Would remove' if dry_run else 'Removed', count, kind, cleanners.format_size(size),
+        ))
+
+
+@main.command()
+@click.option(
+    '-c', '--config', multiple=True, type=click.Path(exists=True), metavar='<filename>',
+    help='Grocker config file',
+)
+@click.option(
+    '-r', '--runtime', 'runtimes', multiple=True, metavar='<runtime>',
+    help="runtime of the wheel volume to clean (default to the configured runtime)",
+)
+@click.option(
+    '--image-prefix', metavar='<uri>',
+    help='docker registry or account on Docker official registry to use',
+)
+@click.option(
+    '--max-age', callback=parse_option('parse_duration'), default='30d', metavar='<duration>',
+    show_default=True, help="keep the wheels used by releases compiled or built during this duration",
+)
+def gc(config, runtimes, image_prefix, max_age):
+    """Delete the wheels not used by recent releases."""
+    from . import builders
+    from . import utils
+
+    configs = [
+        utils.Config.parse(config, runtime=runtime, docker_image_prefix=image_prefix)
+        for runtime in runtimes or [None]
+    ]
     docker_client = utils.docker_get_client()
-    cleanners.docker_purge_container(docker_client, current_version=all_versions)
-    cleanners.docker_purge_volumes(docker_client, current_version=all_versions)
-    cleanners.docker_purge_images(docker_client, current_version=all_versions, runner=including_final_images)
+    with builders.ImagePrefetcher(docker_client) as images:
+        for runtime_config in configs:
+            volume_name = builders.wheel_volume_name(runtime_config)
+            if not docker_client.volumes.list(filters={'name': volume_name}):
+                logger.info('No wheel volume for runtime %s.', runtime_config['runtime'])
+                continue
+            images.get(runtime_config, 'compiler')  # the root image is got first, the compiler is built from it
+            builders.collect_unused_wheels(docker_client, runtime_config, max_age)
 
 
 @main.command()
@@ -38,7 +130,108 @@ def purge(all_versions, including_final_images):
     '-c', '--config', multiple=True, type=click.Path(exists=True), metavar='<filename>',
     help='Grocker config file',
 )
-@click.option('-r', '--runtime', metavar='<runtime>', help="runtime used to build and run this image")
+@click.option(
+    '-r', '--runtime', 'runtimes', multiple=True, metavar='<runtime>',
+    help="runtime to get images for (default to the configured runtime)",
+)
+@click.option(
+    '--image-prefix', metavar='<uri>',
+    help='docker registry or account on Docker official registry to use',
+)
+@click.option(
+    '--role', 'roles', multiple=True, type=click.Choice(['root', 'compiler', 'wheel-server']),
+    help="image to get (default to all of them)",
+)
+@click.option(
+    '-j', '--jobs', type=click.IntRange(min=1), default=4, metavar='<number>', show_default=True,
+    help="maximum number of concurrent image pulls and builds",
+)
+def warm(config, runtimes, image_prefix, roles, jobs):
+    """Pull (or build) Grocker images before building releases."""
+    from . import builders
+    from . import scheduler
+    from . import utils
+
+    configs = [
+        utils.Config.parse(config, runtime=runtime, docker_image_prefix=image_prefix)
+        for runtime in runtimes or [None]
+    ]
+    for runtime_config in configs:
+        scheduler.warn_deprecated_runtime(runtime_config)
+
+    docker_client = utils.docker_get_client()
+    with builders.ImagePrefetcher(docker_client, max_workers=jobs) as images:
+        futures = {}
+        for runtime_config in configs:
+            for role, future in images.prefetch(runtime_config, roles or builders.prefetch.IMAGE_BUILDERS).items():
+                futures[(runtime_config['runtime'], role)] = future
+
+    failures = 0
+    for (runtime, role), future in futures.items():
+        try:
+            logger.info('%s image for %s: %s', role, runtime, future.result().tags[0])
+        except Exception as e:
+            failures += 1
+            logger.error('Unable to get %s image for %s: %s', role, runtime, e)
+    if failures:
+        raise click.ClickException('%d of %d images are not available.' % (failures, len(futures)))
+
+
+@main.command()
+@click.option(
+    '-b', '--bind', default='127.0.0.1:8042', metavar='<host:port>', show_default=True,
+    help="address of the HTTP API (host defaults to 127.0.0.1)",
+)
+@click.option('--socket', 'socket_path', type=click.Path(), metavar='<path>', help="serve the API on a unix socket")
+@click.option(
+    '--pip-conf', type=click.Path(exists=True), metavar='<filename>',
+    help="pip configuration file used to download dependencies (by default use pip config getter)",
+)
+@click.option(
+    '-j', '--jobs', type=click.IntRange(min=1), default=4, metavar='<number>', show_default=True,
+    help="maximum number of concurrent builds",
+)
+@click.option(
+    '--jobs-per-config', type=click.IntRange(min=1), default=1, metavar='<number>', show_default=True,
+    help="maximum number of concurrent builds sharing a config (and a wheel volume)",
+)
+def serve(bind, socket_path, pip_conf, jobs, jobs_per_config):
+    """Build the releases submitted to an HTTP API.
+
+    Jobs are submitted to /jobs as JSON objects (the release and build
+    options), and their events (then their result) are streamed from
+    /jobs/<id>/events.
+    """
+    from . import helpers
+    from . import server
+    from . import utils
+
+    host, _, port = bind.rpartition(':')
+    if not port.isdigit():
+        raise click.BadParameter('%s is not a <host:port> address' % bind, param_hint='--bind')
+    address = (host or '127.0.0.1', int(port))  # never every interface by mistake
+    docker_client = utils.docker_get_client()
+    with helpers.pip_conf(pip_conf_path=pip_conf) as pip_conf_path:
+        with server.BuildServer(docker_client, pip_conf_path, workers=jobs, per_config=jobs_per_config) as build_server:
+            http_server = server.make_http_server(build_server, address=address, socket_path=socket_path)
+            logger.info('Serving the Grocker API on %s', socket_path or '%s:%d' % address)
+            try:
+                http_server.serve_forever()
+            except KeyboardInterrupt:
+                logger.info('Stopping once the running builds are finished, pending builds are cancelled...')
+            finally:
+                http_server.server_close()
+
+
+@main.command()
+@click.option(
+    '-c', '--config', multiple=True, type=click.Path(exists=True), metavar='<filename>',
+    help='Grocker config file',
+)
+@click.option(
+    '-r', '--runtime', multiple=True, metavar='<runtime>',
+    help="runtime used to build and run this image (repeat it, or use 'all', to build for several runtimes)",
+)
 @click.option(
     '--pip-conf', type=click.Path(exists=True), metavar='<filename>',
     help="pip configuration file used to download dependencies (by default use pip config getter)",
@@ -60,6 +253,15 @@ def purge(all_versions, including_final_images):
     help="base name for the image (eg '<image-prefix>/<image-base-name>:<image-version>')",
 )
 @click.option('-n', '--image-name', metavar='<name>', help="name used to tag the build image")
+@click.option(
+    '-t', '--extra-tag', multiple=True, metavar='<tag>',
+    help="other tag (or full image name) pushed with the image",
+)
+@click.option(
+    '--runner-wheels', type=click.Choice(['server', 'shared-server', 'context']),
+    help="get runner image wheels from a wheel server container (shared-server: kept for the next builds) or "
+         "from the build context",
+)
 @click.option(
     '--result-file', type=click.Path(exists=False), metavar='<filename>',
     help="yaml file where results (image name, ...) are written",
@@ -68,6 +270,14 @@ def purge(all_versions, including_final_images):
     '--build-dependencies/--no-build-dependencies', default=True,
     help='build the dependencies',
 )
+@click.option(
+    '--reuse-wheels/--no-reuse-wheels', default=True,
+    help='skip the compilation when the wheels compiled for this release are still available',
+)
+@click.option(
+    '--compile-jobs', type=click.IntRange(min=0), default=1, metavar='<number>', show_default=True,
+    help='number of wheels built in parallel, after a first dependency resolution (0 for every available CPU)',
+)
 @click.option(
     '--build-image/--no-build-image', default=True,
     help='build the docker image',
@@ -76,7 +286,27 @@ def purge(all_versions, including_final_images):
     '--push/--no-push', default=True,
     help='push the image',
 )
-@click.argument('release')
+@click.option(
+    '-f', '--manifest', type=click.Path(exists=True), metavar='<filename>',
+    help="yaml file listing the releases to build (instead of RELEASE)",
+)
+@click.option(
+    '-j', '--jobs', type=click.IntRange(min=1), default=4, metavar='<number>', show_default=True,
+    help="maximum number of concurrent compilations and image builds",
+)
+@click.option(
+    '--plan', is_flag=True,
+    help="only print (in JSON) which images would be pulled, built or pushed, and exit",
+)
+@click.option(
+    '--profile/--no-profile', default=False,
+    help="record phase, Docker API call durations and image cache hits in the result file",
+)
+@click.option(
+    '--profile-trace', type=click.Path(exists=False), metavar='<filename>',
+    help="JSON file where the profile is written in the Trace Event Format (implies --profile)",
+)
+@click.argument('release', required=False)
 def build(release, build_dependencies, build_image, push, **kwargs):
     """Build docker image for RELEASE (version specifiers can be used).
 
@@ -86,74 +316,84 @@ def build(release, build_dependencies, build_image, push, **kwargs):
         grocker build your_project[with_extra]==1.2.3
 
         grocker build /path/to/your_project-1.2.3.whl[with_extra]
+
+    Several releases can be built at once by listing them in a manifest file:
+
+        grocker build --manifest builds.yaml
+
+    or for several runtimes (image tags get the runtime as suffix):
+
+        grocker build -r bookworm/3.12 -r alpine/3 your_project==1.2.3
     """
-    requirement = utils.GrockerRequirement.parse(release)
-    collect = {}  # will contain all collected information
-    docker_client = utils.docker_get_client()
-    collect['release'] = release
-
-    config = utils.parse_config(
-        kwargs['config'],
-        runtime=kwargs['runtime'],
-        entrypoint_name=kwargs['entrypoint'],
-        pip_constraint=kwargs['pip_constraint'],
-        docker_image_prefix=kwargs['image_prefix'],
-        image_base_name=kwargs['image_base_name'],
-        volumes=kwargs['volume'],
-        ports=kwargs['port'],
-        envs=dict(item.split('=', 1) for item in kwargs['env']),
-    )
-    image_name = kwargs['image_name'] or utils.default_image_name(config, requirement)
-    collect['image'] = image_name
-
-    # Raise if grocker do not known the runtime
-    if config['runtime'] not in config['runtimes']:
-        raise RuntimeError('Unknown runtime: %s', config['runtime'])
-
-    if config['runtimes'][config['runtime']].get('deprecated'):
-        logging.warning(
-            "Runtime %s is deprecated, please update to more recent runtime",
-            config['runtime'],
+    from . import helpers
+    from . import scheduler
+    from . import utils
+
+    if bool(release) == bool(kwargs['manifest']):
+        raise click.UsageError('Either RELEASE or --manifest should be given.')
+
+    options = {name: kwargs[name] for name in scheduler.BUILD_OPTIONS}
+    if kwargs['manifest']:
+        jobs = scheduler.load_manifest(kwargs['manifest'], options)
+    else:
+        jobs = scheduler.BuildJob.matrix(release, options)
+
+    if kwargs['plan']:
+        build_plan = scheduler.plan(
+            utils.docker_get_client(), jobs, build_dependencies=build_dependencies, build_image=build_image,
+            push=push, workers=kwargs['jobs'],
         )
+        click.echo(json.dumps(build_plan, indent=2))
+        return
 
+    profiler = profiling.enable() if kwargs['profile'] or kwargs['profile_trace'] else None
+    docker_client = utils.docker_get_client()
+    profiling.instrument(docker_client)
     if build_dependencies:
-        logger.info('Compiling dependencies...')
-        builders.get_or_build_root_image(docker_client, config)
-        compiler = builders.get_or_build_compiler_image(docker_client, config)
-        collect['compiler_image'] = compiler.tags[0]
-
-        with helpers.pip_conf(pip_conf_path=kwargs['pip_conf']) as pip_conf:
-            builders.compile_wheels(
-                docker_client=docker_client,
-                config=config,
-                requirement=requirement,
-                pip_conf=pip_conf,
-            )
-
-    if build_image:
-        logger.info('Building image...')
-        root_image = builders.get_or_build_root_image(docker_client, config)
-        collect['root_image'] = root_image.tags[0]
-        builders.build_runner_image(
-            docker_client=docker_client,
-            config=config,
-            name=image_name,
-            requirement=requirement,
+        pip_conf_context = helpers.pip_conf(pip_conf_path=kwargs['pip_conf'])
+    else:
+        pip_conf_context = contextlib.nullcontext()
+
+    with pip_conf_context as pip_conf:
+        failed_jobs = scheduler.run(
+            docker_client,
+            jobs,
+            pip_conf=pip_conf,
+            build_dependencies=build_dependencies,
+            build_image=build_image,
+            push=push,
+            workers=kwargs['jobs'],
+            reuse_wheels=kwargs['reuse_wheels'],
+            compile_jobs=kwargs['compile_jobs'],
         )
 
-    if push:
-        if not builders.is_prefixed_image(image_name):
-            logger.warning('Not pushing any image since the registry is unclear in %s', image_name)
-        else:
-            logger.info('Pushing image...')
-            image = builders.docker_push_image(docker_client, image_name)
-            collect['hash'] = (
-                builders.get_manifest_digest(image_name)
-                or [x.split('@')[1] for x in image.attrs['RepoDigests']][0]
-            ) if config['manifest'] else None
+    if profiler:
+        profiling.disable()
+        if kwargs['profile_trace']:
+            profiler.dump_trace(kwargs['profile_trace'])
+
+    if failed_jobs and len(jobs) == 1 and not kwargs['manifest']:
+        raise failed_jobs[0].error
 
     if kwargs['result_file']:
-        helpers.dump_yaml(kwargs['result_file'], collect)
+        dump_results(kwargs['result_file'], jobs, manifest=bool(kwargs['manifest']), profiler=profiler)
+
+    if failed_jobs:
+        raise click.ClickException('%d of %d builds failed.' % (len(failed_jobs), len(jobs)))
+
+
+def dump_results(result_file, jobs, manifest, profiler=None):
+    from . import helpers
+
+    if manifest:
+        collect = {'builds': [job.collect for job in jobs]}
+    elif len(jobs) > 1:  # a release built for several runtimes
+        collect = {'runtimes': {job.config['runtime']: job.collect for job in jobs}}
+    else:
+        collect = jobs[0].collect
+    if profiler:
+        collect['profile'] = profiler.summary()
+    helpers.dump_yaml(result_file, collect)
 
 
 if __name__ == '__main__':
@@ -1,37 +1,44 @@
 # Copyright (c) Polyconseil SAS. All rights reserved.
 
 
-from . import build
-from . import naming
-from . import op
+from . import prefetch
 from .build import build_runner_image
+from .naming import image_name
+from .naming import wheel_volume_name
+from .op import docker_find_image
+from .op import docker_publish_image
 from .op import docker_push_image
 from .op import get_manifest_digest
 from .op import is_prefixed_image
+from .prefetch import ImagePrefetcher
+from .wheels import collect_unused_wheels
 from .wheels import compile_wheels
 
 __all__ = [
     'build_runner_image',
+    'docker_find_image',
+    'docker_publish_image',
     'docker_push_image',
+    'image_name',
     'is_prefixed_image',
+    'wheel_volume_name',
+    'collect_unused_wheels',
     'compile_wheels',
     'get_manifest_digest',
     'get_or_build_root_image',
     'get_or_build_compiler_image',
+    'get_or_build_wheel_server_image',
+    'ImagePrefetcher',
 ]
 
 
 def get_or_build_root_image(docker_client, config):
-    return op.docker_get_or_build_image(
-        docker_client,
-        naming.image_name(config, 'root'),
-        lambda client: build.build_root_image(client, config),
-    )
+    return prefetch.get_or_build_image(docker_client, config, 'root')
 
 
 def get_or_build_compiler_image(docker_client, config):
-    return op.docker_get_or_build_image(
-        docker_client,
-        naming.image_name(config, 'compiler'),
-        lambda client: build.build_compiler_image(client, config),
-    )
+    return prefetch.get_or_build_image(docker_client, config, 'compiler')
+
+
+def get_or_build_wheel_server_image(docker_client, config):
+    return prefetch.get_or_build_image(docker_client, config, 'wheel-server')
@@ -1,96 +1,129 @@
 # Copyright (c) Polyconseil SAS. All rights reserved.
 
 import contextlib
+import hashlib
 import logging
-import os.path
-import shutil
+import time
+import uuid
 
 import docker.errors
 
 from .. import __version__
 from .. import helpers
+from .. import usage
 from .. import utils
+from . import contexts
 from . import naming
 from . import op
+from . import wheels
 
 logger = logging.getLogger(__name__)
 
+WHEEL_SERVER_HOST = 'grocker-wheels'  # see runner-image/provision.sh
+SHARED_WHEEL_SERVER_IDLE_TIMEOUT = 30 * 60  # seconds without serving any wheel
+SHARED_WHEEL_SERVER_ATTEMPTS = 20
+SHARED_WHEEL_SERVER_RETRY_DELAY = 0.5  # seconds
+# Container states of a wheel server being started (by another process): not replaced
+SHARED_WHEEL_SERVER_STARTING_STATES = ('created', 'restarting')
 
-def build_root_image(docker_client, config):
-    with op.docker_build_context('grocker.resources.docker.root-image') as build_dir:
-        cfg = config['runtimes'][config['runtime']]
-        context = {
-            'base_image': cfg['image'],
-            'repositories': config['repositories'],
-            'runtime': cfg['runtime'],
-            'grocker_version': __version__,
-        }
-
-        helpers.render_template(
-            os.path.join(build_dir, 'Dockerfile.j2'),
-            os.path.join(build_dir, 'Dockerfile'),
-            context,
-        )
 
-        # XXX: We should replace template by env vars
-        helpers.render_template(
-            os.path.join(build_dir, 'provision.sh.j2'),
-            os.path.join(build_dir, 'provision.sh'),
-            context,
-        )
+def build_root_image(docker_client, config):
+    cfg = config['runtimes'][config['runtime']]
+    context = {
+        'base_image': cfg['image'],
+        'repositories': config['repositories'],
+        'runtime': cfg['runtime'],
+        'grocker_version': __version__,
+    }
+    # XXX: We should replace provision.sh template by env vars
+    build_context = contexts.get_cached_context(
+        'grocker.resources.docker.root-image',
+        {'Dockerfile.j2': 'Dockerfile', 'provision.sh.j2': 'provision.sh'},
+        context,
+    )
 
-        dependencies = utils.get_dependencies(config)
-        build_env = {
-            'SYSTEM_DEPENDENCIES': ' '.join(dependencies),
-        }
-        return op.docker_build_image(
-            docker_client,
-            build_dir,
-            naming.image_name(config, 'root'),
-            buildargs=build_env,
-            role='root',
-        )
+    dependencies = utils.get_dependencies(config)
+    build_env = {
+        'SYSTEM_DEPENDENCIES': ' '.join(dependencies),
+    }
+    return op.docker_build_image(
+        docker_client,
+        build_context,
+        naming.image_name(config, 'root'),
+        buildargs=build_env,
+        role='root',
+    )
 
 
 def build_compiler_image(docker_client, config):
-    with op.docker_build_context('grocker.resources.docker.compiler-image') as build_dir:
-        context = {
-            'base_image': naming.image_name(config, 'root'),
-            'runtime': config['runtimes'][config['runtime']]['runtime'],
-        }
-
-        helpers.render_template(
-            os.path.join(build_dir, 'Dockerfile.j2'),
-            os.path.join(build_dir, 'Dockerfile'),
-            context,
-        )
+    context = {
+        'base_image': naming.image_name(config, 'root'),
+        'runtime': config['runtimes'][config['runtime']]['runtime'],
+    }
+    build_context = contexts.get_cached_context(
+        'grocker.resources.docker.compiler-image',
+        {'Dockerfile.j2': 'Dockerfile'},
+        context,
+    )
 
-        dependencies = utils.get_dependencies(config, with_build_dependencies=True)
-        build_env = {
-            'SYSTEM_DEPENDENCIES': ' '.join(dependencies),
-        }
-        return op.docker_build_image(
-            docker_client,
-            build_dir,
-            naming.image_name(config, 'compiler'),
-            buildargs=build_env,
-            role='compiler',
-        )
+    dependencies = utils.get_dependencies(config, with_build_dependencies=True)
+    build_env = {
+        'SYSTEM_DEPENDENCIES': ' '.join(dependencies),
+    }
+    return op.docker_build_image(
+        docker_client,
+        build_context,
+        naming.image_name(config, 'compiler'),
+        buildargs=build_env,
+        role='compiler',
+    )
 
 
 def build_wheel_server_image(docker_client, config):
-    with op.docker_build_context('grocker.resources.docker.wheel-server') as build_dir:
-        return op.docker_build_image(
-            docker_client,
-            build_dir,
-            naming.image_name(config, 'wheel-server'),
-            role='wheel-server',
-        )
+    return op.docker_build_image(
+        docker_client,
+        contexts.get_cached_context('grocker.resources.docker.wheel-server', {}, {}),
+        naming.image_name(config, 'wheel-server'),
+        role='wheel-server',
+    )
 
 
 def build_runner_image(docker_client, config, name, requirement):
+    """
+    Build the runner image of a release.
+
+    When the wheels compiled for the release are known, they are installed from its lock: pinned to their
+    sha256, without resolving dependencies again.
+
+    Args:
+        docker_client (docker.DockerClient): a docker client
+        config (dict): Grocker config
+        name (str): runner image name
+        requirement (grocker.utils.GrockerRequirement): the release
+
+    Returns:
+        list: the lock of the release (see ``wheels.get_compiled_records``), None when it is unknown
+
+    """
+    if config['runner_wheels'] not in utils.RUNNER_WHEELS_SOURCES:
+        raise ValueError('Unknown runner wheels source: %s' % config['runner_wheels'])
+    embedded_wheels = config['runner_wheels'] == 'context'
+
+    record = wheels.get_release_record(docker_client, config, requirement)
+    if record is None:
+        logger.warning('Wheels used by %s are unknown, its dependencies are not cached.', requirement.to_install)
+        lock = hashes = None
+        app_wheels, dependency_wheels = [], None
+        dependencies = [requirement.to_install]
+    else:
+        lock = record['lock']
+        hashes = {entry['wheel']: entry['sha256'] for entry in lock}
+        app_wheels, dependency_wheels = wheels.split_wheels(record['wheels'], requirement.project_name)
+        dependencies = wheels.get_wheels_requirements(dependency_wheels, hashes)
+    dependencies_hash = hashlib.sha256('\n'.join(dependencies).encode('utf-8')).hexdigest()
+
     # Markers would not make much sense here and url are unsupported.
-    with op.docker_build_context('grocker.resources.docker.runner-image') as build_dir:
+    with contexts.BuildContext('grocker.resources.docker.runner-image') as build_context:
         context = {
             'base_image': naming.image_name(config, 'root'),
             'entrypoint_name': config['entrypoint_name'],
@@ -100,42 +133,84 @@ def build_runner_image(docker_client, config, name, requirement):
             'volumes': config['volumes'],
             'ports': config['ports'],
             'envs': config['envs'],
+            'dependencies_hash': dependencies_hash,
         }
+        build_context.render_template('Dockerfile.j2', 'Dockerfile', context)
 
-        helpers.render_template(
-            os.path.join(build_dir, 'Dockerfile.j2'),
-            os.path.join(build_dir, 'Dockerfile'),
-            context,
-        )
+        # The build context has a directory for each stage: dependencies and app
+        for stage in ('dependencies', 'app'):
+            build_context.add_resource(f'{stage}/provision.sh', 'provision.sh')
+            if config.get('pip_constraint'):
+                build_context.add_file(f'{stage}/constraints.txt', config['pip_constraint'])
 
-        if config.get('pip_constraint'):
-            shutil.copyfile(
-                config['pip_constraint'],
-                os.path.join(build_dir, 'constraints.txt'),
+        # Locked requirements are installed without resolving dependencies (see provision.sh)
+        requirements_files = {'dependencies': dependencies}
+        if lock is not None and app_wheels:
+            requirements_files['app'] = wheels.get_wheels_requirements(app_wheels, hashes)
+        for stage, requirements in requirements_files.items():
+            build_context.add_bytes(
+                f'{stage}/requirements.lock' if lock is not None else f'{stage}/requirements.txt',
+                ''.join(f'{requirement}\n' for requirement in requirements).encode('utf-8'),
             )
 
+        # Changing build id always invalidates the last step cache, to get security updates.
+        build_env = {
+            'GROCKER_BUILD_ID': uuid.uuid4().hex,
+        }
+        if record is None:
+            # The dependencies stage installs the release itself, which may be rebuilt with the same version
+            # (as a local wheel): never reuse it.
+            build_context.add_bytes('dependencies/build-id', build_env['GROCKER_BUILD_ID'].encode('utf-8'))
+
+        if embedded_wheels:
+            for stage, stage_wheels in (('dependencies', dependency_wheels), ('app', app_wheels)):
+                wheels.copy_wheels(docker_client, config, stage_wheels, build_context, f'{stage}/wheels')
+            op.docker_build_image(
+                docker_client,
+                build_context.chunks(),
+                name,
+                role='runner',
+                buildargs=build_env,
+            )
+            return lock
+
+        # A host name rather than a build arg: the IP address changes from one build to the next and
+        # build args are part of the cache key of the steps using them (as the cached dependencies one).
         with wheel_server(docker_client, config) as wheel_server_ip:
-            build_env = {
-                'GROCKER_WHEEL_SERVER_IP': wheel_server_ip,
-            }
-            return op.docker_build_image(
+            op.docker_build_image(
                 docker_client,
-                build_dir,
+                build_context.chunks(),
                 name,
                 role='runner',
                 buildargs=build_env,
-                nocache=True,
+                extra_hosts={WHEEL_SERVER_HOST: wheel_server_ip},
             )
+        return lock
 
 
-@contextlib.contextmanager
-def wheel_server(docker_client, config):
-    image = op.docker_get_or_build_image(
+def get_wheel_server_image(docker_client, config):
+    return op.docker_get_or_build_image(
         docker_client,
         naming.image_name(config, 'wheel-server'),
         lambda client: build_wheel_server_image(client, config),
     )
 
+
+@contextlib.contextmanager
+def wheel_server(docker_client, config):
+    usage.record_volume_use(naming.wheel_volume_name(config))
+    with usage.volume_lock(naming.wheel_volume_name(config)):  # no garbage collection while serving wheels
+        with _wheel_server(docker_client, config) as server_ip:
+            yield server_ip
+
+
+@contextlib.contextmanager
+def _wheel_server(docker_client, config):
+    if config['runner_wheels'] == 'shared-server':
+        yield get_shared_wheel_server(docker_client, config)
+        return
+
+    image = get_wheel_server_image(docker_client, config)
     container = docker_client.containers.run(
         image=image.id,
         volumes={
@@ -154,3 +229,82 @@ def wheel_server(docker_client, config):
         yield server_ip
     finally:
         helpers.retry(docker.errors.APIError)(container.remove)(force=True)
+
+
+def get_shared_wheel_server(docker_client, config):
+    """
+    Get the wheel server shared by the builds using the config wheel volume, starting it when needed.
+
+    The container is named after the wheel volume, so that concurrent Grocker processes share it too. It
+    stops itself (and is removed) once it did not serve any wheel for SHARED_WHEEL_SERVER_IDLE_TIMEOUT,
+    getting it restarts this delay. Stopped or unhealthy containers are replaced, containers being started (by
+    another process) are waited for.
+
+    Args:
+        docker_client (docker.DockerClient): a docker client
+        config (dict): Grocker config
+
+    Returns:
+        str: IP address of the wheel server
+
+    """
+    name = naming.shared_wheel_server_name(config)
+    for _ in range(SHARED_WHEEL_SERVER_ATTEMPTS):
+        try:
+            attrs = docker_client.api.inspect_container(name)
+        except docker.errors.NotFound:
+            attrs = _start_shared_wheel_server(docker_client, config, name)
+            if attrs is not None:
+                return attrs['NetworkSettings']['IPAddress']
+            continue  # started (or removed) by another process meanwhile
+
+        state = attrs['State']
+        if state.get('Running') and (state.get('Health') or {}).get('Status') != 'unhealthy':
+            try:
+                docker_client.api.kill(attrs['Id'], signal='SIGUSR1')  # restarts the idle delay
+            except docker.errors.APIError:  # stopped meanwhile
+                continue
+            logger.info('Using wheel server container %s', name)
+            return attrs['NetworkSettings']['IPAddress']
+
+        if state.get('Status') not in SHARED_WHEEL_SERVER_STARTING_STATES + ('removing',):
+            logger.info('Replacing wheel server container %s (%s)', name, state.get('Status'))
+            _remove_container(docker_client, attrs['Id'])
+        time.sleep(SHARED_WHEEL_SERVER_RETRY_DELAY)
+    raise RuntimeError('Unable to start wheel server container %s' % name)
+
+
+def _remove_container(docker_client, container_id):
+    try:
+        docker_client.api.remove_container(container_id, force=True)
+    except docker.errors.APIError as e:  # removed by another process meanwhile
+        logger.debug(e)
+
+
+def _start_shared_wheel_server(docker_client, config, name):
+    """
+    Start a shared wheel server container and return its attributes (None when the name is taken, or when it
+    was removed by another process before being started).
+    """
+    image = get_wheel_server_image(docker_client, config)
+    volume_name = naming.wheel_volume_name(config)
+    try:
+        container = docker_client.containers.run(
+            image=image.id,
+            command=['idle-nginx'],
+            name=name,
+            labels={naming.SHARED_WHEEL_SERVER_LABEL: volume_name},
+            environment={'IDLE_TIMEOUT': str(SHARED_WHEEL_SERVER_IDLE_TIMEOUT)},
+            volumes={volume_name: {'bind': '/wheels', 'mode': 'ro'}},
+            auto_remove=True,
+            detach=True,
+        )
+    except docker.errors.NotFound:  # removed between its creation and its start
+        return None
+    except docker.errors.APIError as e:
+        if e.status_code != 409:  # conflict: the container name is taken
+            raise
+        return None
+    logger.info('Started wheel server container %s', name)
+    container.reload()  # attributes returned by run are read before the container starts, without IP address
+    return container.attrs
@@ -0,0 +1,143 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import collections
+import collections.abc
+import hashlib
+import io
+import json
+import posixpath
+import tarfile
+import tempfile
+import threading
+from importlib import resources
+
+from .. import helpers
+
+SPOOL_MAX_SIZE = 32 * 1024 * 1024  # bigger contexts (with wheels) are spooled to disk
+CHUNK_SIZE = 1024 * 1024
+CACHE_SIZE = 32
+
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class BuildContext:
+    """
+    Docker build context, made as a tar archive in memory and sent to the Docker daemon as is.
+
+    Files get a fixed modification time, so that identical contexts are identical archives.
+
+    Args:
+        resources_package (str): package whose resources (templates included) are added to the context
+    """
+
+    def __init__(self, resources_package):
+        self.resources_package = resources_package
+        self._fileobj = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        self._archive = tarfile.open(fileobj=self._fileobj, mode='w', format=tarfile.PAX_FORMAT)
+        self._directories = set()
+        for entry in sorted(resources.contents(resources_package)):
+            if resources.is_resource(resources_package, entry):
+                self.add_resource(entry, entry)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._archive.close()
+        self._fileobj.close()
+
+    def add_resource(self, name, resource):
+        """Add a resource of the resources package (keeping its mode) as the name file."""
+        with resources.path(self.resources_package, resource) as path:
+            self.add_file(name, str(path))
+
+    def add_file(self, name, path):
+        """Add a file (keeping its mode) as the name file."""
+        info = self._archive.gettarinfo(path, arcname=name)
+        info.mtime = 0
+        self.add_directory(posixpath.dirname(name))
+        with open(path, 'rb') as fp:
+            self._archive.addfile(info, fp)
+
+    def add_fileobj(self, name, fileobj, size, mode=0o644):
+        """Add size bytes read from a file object as the name file."""
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = mode
+        self.add_directory(posixpath.dirname(name))
+        self._archive.addfile(info, fileobj)
+
+    def add_bytes(self, name, data, mode=0o644):
+        self.add_fileobj(name, io.BytesIO(data), len(data), mode=mode)
+
+    def add_directory(self, name):
+        """Add a directory (and its parents) unless it is already in the context."""
+        if not name or name in self._directories:
+            return
+        self.add_directory(posixpath.dirname(name))
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        self._archive.addfile(info)
+        self._directories.add(name)
+
+    def render_template(self, template, name, context):
+        """Render a template of the resources package as the name file."""
+        output = helpers.render_template_resource(self.resources_package, template, context)
+        self.add_bytes(name, output.encode('utf-8'))
+
+    def getvalue(self):
+        """Finish the archive and return it."""
+        self._archive.close()
+        self._fileobj.seek(0)
+        return self._fileobj.read()
+
+    def chunks(self):
+        """Finish the archive and yield it by chunks (to stream contexts spooled to disk)."""
+        self._archive.close()
+        self._fileobj.seek(0)
+        return iter(lambda: self._fileobj.read(CHUNK_SIZE), b'')
+
+
+def _unfreeze(value):
+    if isinstance(value, collections.abc.Mapping):
+        return dict(value)
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def get_cached_context(resources_package, templates, context):
+    """
+    Return the build context of a resources package, with its templates rendered.
+
+    Build contexts are cached by a hash of the package, the templates and the template context: images
+    sharing a context (e.g. root images of configs only differing by system dependencies, which are
+    build arguments) do not render and archive it again.
+
+    Args:
+        resources_package (str): package whose resources are the build context
+        templates (dict): output file name by template name
+        context (dict): template context
+
+    Returns:
+        bytes: tar archive of the build context
+
+    """
+    key = hashlib.sha256(json.dumps(
+        [resources_package, templates, context], sort_keys=True, default=_unfreeze,
+    ).encode('utf-8')).hexdigest()
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    with BuildContext(resources_package) as build_context:
+        for template, name in sorted(templates.items()):
+            build_context.render_template(template, name, context)
+        data = build_context.getvalue()
+
+    with _cache_lock:
+        _cache[key] = data
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return data
@@ -1,29 +1,48 @@
 # Copyright (c) Polyconseil SAS. All rights reserved.
 
+import functools
+
 from .. import __version__
 from .. import utils
 
+# Label of the shared wheel server containers, set to the name of the wheel volume they serve
+SHARED_WHEEL_SERVER_LABEL = 'grocker.wheel-server.volume'
+
 
 def image_name(config, role):
+    return _image_name(config['docker_image_prefix'], config['runtime'], role, utils.config_identifier(config))
+
+
+def wheel_volume_name(config):
+    return _wheel_volume_name(config['runtime'], utils.config_identifier(config))
+
+
+def shared_wheel_server_name(config):
+    return 'grocker-wheel-server-' + wheel_volume_name(config)[len('grocker-wheel-cache-'):]
+
+
+@functools.lru_cache(maxsize=None)
+def _image_name(prefix, runtime, role, config_hash):
     image_name_template = 'grocker-{runtime}-{role}:{version}-{hash}'
     if role == 'wheel-server':
         image_name_template = 'grocker-{role}:{version}'
 
-    if config['docker_image_prefix']:
+    if prefix:
         image_name_template = '{prefix}/' + image_name_template
 
     return image_name_template.format(
-        prefix=config['docker_image_prefix'],
-        runtime=config['runtime'].replace('/', '-'),
+        prefix=prefix,
+        runtime=runtime.replace('/', '-'),
         role=role,
         version=__version__,
-        hash=utils.config_identifier(config),
+        hash=config_hash,
     )
 
 
-def wheel_volume_name(config):
+@functools.lru_cache(maxsize=None)
+def _wheel_volume_name(runtime, config_hash):
     return 'grocker-wheel-cache-{version}-{runtime}-{hash}'.format(
         version=__version__,
-        runtime=config['runtime'].replace('/', '-'),
-        hash=utils.config_identifier(config),
+        runtime=runtime.replace('/', '-'),
+        hash=config_hash,
     )
@@ -1,9 +1,10 @@
 # Copyright (c) Polyconseil SAS. All rights reserved.
 
+import codecs
 import contextlib
+import io
 import logging
-import os.path
-import tempfile
+import tarfile
 
 import docker
 import docker.errors
@@ -12,7 +13,10 @@ import requests
 import requests.exceptions
 
 from .. import __version__
+from .. import events
 from .. import helpers
+from .. import profiling
+from .. import registry
 
 logger = logging.getLogger(__name__)
 
@@ -21,29 +25,40 @@ def is_prefixed_image(name):
     return '/' in name
 
 
-@contextlib.contextmanager
-def docker_build_context(context_module):
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        build_dir = os.path.join(tmp_dir, 'build')
-        helpers.copy_resources(context_module, build_dir)
-        yield build_dir
+def docker_build_image(docker_client, context, name, role=None, labels=None, **kwargs):
+    """
+    Build an image.
+
+    Args:
+        docker_client (docker.DockerClient): a docker client
+        context (bytes): tar archive of the build context (or an iterable of its chunks)
+        name (str): image name
+        role (str): Grocker image role
+        labels (dict): extra image labels
 
+    Returns:
+        docker.models.images.Image: the built image
 
-def docker_build_image(docker_client, path, name, role=None, labels=None, **kwargs):
+    """
     computed_labels = {
         'grocker.version': __version__,
         'grocker.image.role': role,
     }
     computed_labels.update(labels or {})
+    events.emit(events.StartEvent(name, 'Sending build context'))
     stream = docker_client.api.build(
-        path=path,
+        fileobj=context,
+        custom_context=True,
         tag=name,
         rm=True,
         forcerm=True,
         labels=computed_labels,
         **kwargs
     )
-    _inspect_stream(stream)
+    errors = _inspect_stream(stream, name)
+    events.emit(events.EndEvent(name, 'Build finished', success=not errors))
+    if errors:
+        raise RuntimeError('Image %s build failed: %s' % (name, errors[-1]))
     try:
         return docker_client.images.get(name)
     except docker.errors.ImageNotFound:
@@ -52,17 +67,44 @@ def docker_build_image(docker_client, path, name, role=None, labels=None, **kwar
 
 def docker_get_or_build_image(docker_client, name, builder):
     try:
-        return docker_client.images.get(name)
+        image = docker_client.images.get(name)
+        profiling.record_image_lookup(name, 'local')
+        return image
     except (requests.exceptions.HTTPError, docker.errors.ImageNotFound):
         try:
-            return docker_pull_image(docker_client, name)
+            image = docker_pull_image(docker_client, name)
+            profiling.record_image_lookup(name, 'registry')
+            return image
         except (requests.exceptions.HTTPError, docker.errors.NotFound):
             image = builder(docker_client)
+            profiling.record_image_lookup(name, 'build')
             if is_prefixed_image(name):
                 image = docker_push_image(docker_client, name)
             return image
 
 
+def docker_find_image(docker_client, name):
+    """
+    Look up an image like ``docker_get_or_build_image`` does, without pulling or building it.
+
+    Returns:
+        str: where the image is (local or registry), None when it would be built
+
+    """
+    try:
+        docker_client.images.get(name)
+        return 'local'
+    except (requests.exceptions.HTTPError, docker.errors.ImageNotFound):
+        pass
+    if not is_prefixed_image(name):  # only prefixed images are pushed, do not ask Docker Hub
+        return None
+    try:
+        return 'registry' if registry.get_client().get_manifest_digest(name) else None
+    except (requests.exceptions.RequestException, registry.RegistryError) as e:
+        logger.warning('Unable to look up %s in its registry: %s', name, e)
+        return None
+
+
 def get_or_create_data_volume(docker_client, name, role, labels=None):
     logger.info('Creating volume %s...', name)
     computed_labels = {
@@ -83,19 +125,88 @@ def docker_pull_image(docker_client, name):
 
 def docker_push_image(docker_client, name):
     logger.info('Pushing image %s...', name)
-    docker_client.images.push(name)
+    _push(docker_client, name)
     return docker_client.images.get(name)
 
 
+def docker_publish_image(docker_client, name, extra_names=()):
+    """
+    Push an image (and extra names of it) unless the registry already has it.
+
+    Args:
+        docker_client (docker.DockerClient): a docker client
+        name (str): image name
+        extra_names (list): other names (tags) of the image to push
+
+    Returns:
+        str: manifest digest of the image in the registry (None when unknown)
+
+    """
+    image = docker_client.images.get(name)
+    targets = [name] + list(extra_names)
+    try:
+        registry_digests = registry.get_client().get_manifest_digests(targets)
+    except (requests.exceptions.RequestException, registry.RegistryError) as e:
+        logger.debug('Unable to get %s manifests from their registry: %s', name, e)
+        registry_digests = {}
+
+    digests = {}
+    for target in targets:
+        if target != name:
+            image.tag(*registry.split_image_name(target))
+        digest = _get_published_digest(image, target, registry_digests.get(target))
+        if digest:
+            logger.info('Image %s is already in the registry (%s), not pushing it.', target, digest)
+        else:
+            logger.info('Pushing image %s...', target)
+            digest = _push(docker_client, target)
+        digests[target] = digest
+    return digests[name]
+
+
 def get_manifest_digest(name):
-    registry_repository, tag = name.split(':', 1)
-    if '.' not in registry_repository:  # Docker Hub
-        return None  # Docker HUB API is not documented
+    return registry.get_client().get_manifest_digest(name)
+
+
+def _get_published_digest(image, name, digest):
+    """Return the registry digest of the image if the registry has it under name, None otherwise."""
+    if digest is None:
+        return None
+    repository, _ = registry.split_image_name(name)
+    if f'{repository}@{digest}' in (image.attrs.get('RepoDigests') or []):
+        return digest  # pushed (or pulled) from this host
+    try:
+        manifest = registry.get_client().get_manifest(name)
+    except (requests.exceptions.RequestException, registry.RegistryError, ValueError) as e:
+        logger.debug('Unable to get %s manifest from its registry: %s', name, e)
+        return None
+    # The image id is the digest of its config
+    if manifest and manifest.content.get('config', {}).get('digest') == image.id:
+        return manifest.digest
+    return None
+
+
+def _push(docker_client, name):
+    """Push an image, logging the progress of each layer, and return its digest."""
+    repository, tag = registry.split_image_name(name)
+    digest = None
+    layer_statuses = {}
+    for line in docker_client.api.push(repository, tag=tag, stream=True, decode=True):
+        if 'error' in line:
+            raise RuntimeError('Push of %s failed: %s' % (name, line['error']))
+        if 'aux' in line:
+            digest = line['aux'].get('Digest')
+            continue
 
-    registry, repository = registry_repository.split('/', 1)
-    response = requests.head(f'https://{registry}/v2/{repository}/manifests/{tag}', timeout=5)
-    response.raise_for_status()
-    return response.headers['Docker-Content-Digest']
+        layer, status = line.get('id'), line.get('status', '')
+        if layer is None:
+            logger.info('%s: %s', name, status)
+        elif layer_statuses.get(layer) != status:
+            logger.info('%s: %s %s', name, layer, status)
+            layer_statuses[layer] = status
+        elif line.get('progress'):
+            logger.debug('%s: %s %s %s', name, layer, status, line['progress'])
+    return digest
 
 
 def docker_run_container(docker_client, name, command, volumes=None, environment=None):
@@ -111,25 +222,88 @@ def docker_run_container(docker_client, name, command, volumes=None, environment
         detach=True,
     )
 
-    stream = container.attach(stream=True, logs=True)
-    for line in stream:
-        print(line.decode('utf-8'), end='')
+    source = '%s (%s)' % (name, container.short_id)
+    events.emit(events.StartEvent(source, 'Running %s' % ' '.join(command)))
+    splitter = events.LineSplitter()
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for chunk in container.attach(stream=True, logs=True):
+        for line in splitter.feed(decoder.decode(chunk)):
+            events.emit(events.parse_line(source, line))
+    for line in splitter.flush():
+        events.emit(events.parse_line(source, line))
     result = container.wait()
     container.remove()
+    events.emit(events.EndEvent(source, 'Exited with code %s' % result['StatusCode'], success=not result['StatusCode']))
     if result['StatusCode'] != 0:
         raise RuntimeError('Container exit with a non-zero return code (%s).' % result)
 
 
-def _inspect_stream(stream):
-    """Return some data about the stream."""
-    error = False
+@contextlib.contextmanager
+def docker_volume_container(docker_client, name, volumes):
+    """Yield a created (but never started) container giving access to volume files."""
+    container = docker_client.containers.create(
+        image=name,
+        volumes=volumes,
+        labels={'grocker.version': __version__},
+    )
+    try:
+        yield container
+    finally:
+        helpers.retry(docker.errors.APIError)(container.remove)(force=True)
+
+
+@contextlib.contextmanager
+def docker_open_archive(container, path):
+    """Yield a tar archive of a container path, streamed from the docker daemon."""
+    stream, _ = container.get_archive(path)
+    with tarfile.open(fileobj=io.BufferedReader(_ChunksReader(stream)), mode='r|') as archive:
+        yield archive
+
+
+def docker_read_file(container, path):
+    """Return the content of a container file, or None if it does not exist."""
+    try:
+        with docker_open_archive(container, path) as archive:
+            return archive.extractfile(archive.next()).read()
+    except docker.errors.NotFound:
+        return None
+
+
+class _ChunksReader(io.RawIOBase):
+    """Read only file object reading an iterable of bytes chunks."""
+
+    def __init__(self, chunks):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer:
+            self._buffer = next(self._chunks, b'')
+            if not self._buffer:
+                return 0
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def _inspect_stream(stream, source):
+    """Emit events of a docker build stream, and return the reported errors."""
+    errors = []
+    splitter = events.LineSplitter()
     for line in docker.utils.json_stream.json_stream(stream):
         if 'stream' in line:
-            print(line['stream'], end='')
+            for output_line in splitter.feed(line['stream']):
+                events.emit(events.parse_line(source, output_line))
         elif 'error' in line:
-            print(line['error'])
-            error = True
+            errors.append(line['error'])
+            events.emit(events.ErrorEvent(source, line['error']))
         else:
-            print(line)
-    print()
-    return not error
+            events.emit(events.OutputEvent(source, str(line)))
+    for output_line in splitter.flush():
+        events.emit(events.parse_line(source, output_line))
+    return errors
@@ -0,0 +1,96 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import concurrent.futures
+import logging
+import threading
+
+from .. import events
+from .. import profiling
+from . import build
+from . import naming
+from . import op
+
+logger = logging.getLogger(__name__)
+
+IMAGE_BUILDERS = {
+    'root': build.build_root_image,
+    'compiler': build.build_compiler_image,
+    'wheel-server': build.build_wheel_server_image,
+}
+
+# The compiler image is built from the root image.
+IMAGE_DEPENDENCIES = {
+    'compiler': 'root',
+}
+
+
+def get_or_build_image(docker_client, config, role):
+    """Get a Grocker image (root, compiler or wheel-server) locally, from the registry or by building it."""
+    return op.docker_get_or_build_image(
+        docker_client,
+        naming.image_name(config, role),
+        lambda client: IMAGE_BUILDERS[role](client, config),
+    )
+
+
+class ImagePrefetcher:
+    """
+    Look up, pull or build Grocker images concurrently.
+
+    Each image is looked up once, even when several configs share it. An image only waits for the
+    image it is built from (the compiler waits for the root image); other lookups run in parallel.
+
+    Lookup events are received by the recorders of the thread starting the lookup, and by the ones of
+    the threads getting the image (see ``get``).
+    """
+
+    def __init__(self, docker_client, max_workers=4):
+        self.docker_client = docker_client
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = {}
+        self._lookup_events = {}  # lookup recorder and the recorders it was forwarded to, by image name
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._executor.shutdown(wait=True)
+
+    def prefetch(self, config, roles=tuple(IMAGE_BUILDERS)):
+        """Start the lookup of config images, and return their futures by role."""
+        return {role: self._submit(config, role) for role in roles}
+
+    def get(self, config, role):
+        """Wait for an image lookup (starting it if needed), and return the image.
+
+        The events of this lookup (and of the lookup of the image it is built from) are given to the
+        recorders of the current thread, so that image builds are part of the steps waiting for them.
+        """
+        image = self._submit(config, role).result()
+        for lookup_role in filter(None, (IMAGE_DEPENDENCIES.get(role), role)):
+            with self._lock:
+                recorder, forwarded_recorders = self._lookup_events[naming.image_name(config, lookup_role)]
+            events.replay(recorder.events, exclude=forwarded_recorders)
+        return image
+
+    def _submit(self, config, role):
+        name = naming.image_name(config, role)
+        with self._lock:
+            future = self._futures.get(name)
+            if future is None or (future.done() and future.exception() is not None):  # retry failed lookups
+                # Dependencies are submitted first: a waiting lookup never blocks the one it waits for.
+                parent = IMAGE_DEPENDENCIES.get(role)
+                parent_future = self._submit(config, parent) if parent else None
+                recorder, recorders = events.Recorder(), events.current_recorders()
+                self._lookup_events[name] = (recorder, recorders)
+                self._futures[name] = self._executor.submit(
+                    self._lookup, config, role, parent_future, [recorder] + recorders,
+                )
+            return self._futures[name]
+
+    def _lookup(self, config, role, parent_future, recorders):
+        if parent_future is not None:
+            parent_future.result()
+        with events.forwarding(recorders), profiling.phase('%s image lookup' % role, runtime=config['runtime']):
+            return get_or_build_image(self.docker_client, config, role)
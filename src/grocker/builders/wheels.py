@@ -1,17 +1,31 @@
 # Copyright (c) Polyconseil SAS. All rights reserved.
 
 import base64
+import collections
 import configparser
+import hashlib
+import json
 import logging
 import os.path
+import posixpath
+import time
 import zlib
 
+import packaging.utils
+
+from .. import usage
 from .. import utils
 from . import naming
 from . import op
 
 logger = logging.getLogger(__name__)
 
+# Paths in the compiler container, metadata are hidden from pip and nginx indexes.
+WHEELS_DIRECTORY = '/home/grocker/packages'
+METADATA_DIRECTORY = posixpath.join(WHEELS_DIRECTORY, '.grocker')
+RECORDS_DIRECTORY = posixpath.join(METADATA_DIRECTORY, 'records')
+INVENTORY_PATH = posixpath.join(METADATA_DIRECTORY, 'inventory.json')
+
 
 def get_pip_env(pip_conf):
     def get(cfg, section, option, default=None):
@@ -38,7 +52,165 @@ def get_pip_env(pip_conf):
     return env
 
 
-def compile_wheels(docker_client, config, requirement, pip_conf):
+def wheels_record_identifier(requirement, constraints):
+    """
+    Hash a requirement and the constraints used to compile it.
+
+    Args:
+        requirement (grocker.utils.GrockerRequirement): the compiled requirement
+        constraints (bytes): content of the pip constraint file
+
+    Returns:
+        str: Record identifier (SHA 256)
+
+    """
+    if requirement.filepath:
+        with open(requirement.filepath, 'rb') as fp:
+            release = hashlib.sha256(fp.read()).hexdigest() + requirement.pip_extras
+    else:
+        release = requirement.to_install
+    data = utils.GROUP_SEPARATOR.join([release.encode('utf-8'), constraints])
+    return hashlib.sha256(data).hexdigest()
+
+
+def _read_constraints(config):
+    if not config['pip_constraint']:
+        return b''
+    with open(config['pip_constraint'], 'rb') as fp:
+        return fp.read()
+
+
+def _read_compiled_records(container, record_identifiers):
+    available_wheels = set(json.loads(op.docker_read_file(container, INVENTORY_PATH) or '[]'))
+    compiled_records = {}
+    for identifier in record_identifiers:
+        record_path = posixpath.join(RECORDS_DIRECTORY, identifier + '.json')
+        record = json.loads(op.docker_read_file(container, record_path) or '{}')
+        wheels = record.get('wheels')
+        # Records written by older compilers have no lock
+        is_valid = wheels and record.get('lock') and available_wheels.issuperset(wheels)
+        compiled_records[identifier] = record if is_valid else None
+    return compiled_records
+
+
+def _wheel_volume_reader(docker_client, config):
+    return op.docker_volume_container(
+        docker_client,
+        naming.image_name(config, 'root'),
+        {naming.wheel_volume_name(config): {'bind': WHEELS_DIRECTORY, 'mode': 'ro'}},
+    )
+
+
+def get_compiled_records(docker_client, config, record_identifiers):
+    """
+    Get the records of some releases, if the wheels they use are all still in the wheel volume.
+
+    A record has the ``wheels`` (filenames) used by the release and its ``lock``: the ``name``, ``version``,
+    ``wheel`` and ``sha256`` of each of these wheels.
+
+    Args:
+        docker_client (docker.DockerClient): a docker client
+        config (dict): Grocker config
+        record_identifiers (list): record identifiers (see ``wheels_record_identifier``)
+
+    Returns:
+        dict: record by record identifier, None when the record is missing or outdated
+
+    """
+    with _wheel_volume_reader(docker_client, config) as container:
+        compiled_records = _read_compiled_records(container, record_identifiers)
+    usage.record_records_use(
+        naming.wheel_volume_name(config),
+        [identifier for identifier, record in compiled_records.items() if record is not None],
+    )
+    return compiled_records
+
+
+def get_release_record(docker_client, config, requirement):
+    """Return the record of a requirement (see ``get_compiled_records``), or None when unknown or outdated."""
+    identifier = wheels_record_identifier(requirement, _read_constraints(config))
+    return get_compiled_records(docker_client, config, [identifier])[identifier]
+
+
+def split_wheels(wheels, project_name):
+    """
+    Split wheels between project wheels and its dependencies.
+
+    Returns:
+        tuple: project wheel list, dependency wheel list
+
+    """
+    project_name = packaging.utils.canonicalize_name(project_name)
+    project_wheels, dependency_wheels = [], []
+    for wheel in wheels:
+        name, _, _, _ = packaging.utils.parse_wheel_filename(wheel)
+        (project_wheels if name == project_name else dependency_wheels).append(wheel)
+    return project_wheels, dependency_wheels
+
+
+def get_wheels_requirements(wheels, hashes=None):
+    """
+    Return pinned requirements (sorted) matching wheels.
+
+    Args:
+        wheels (list): wheel filenames
+        hashes (dict): sha256 by wheel filename, to pin the requirements to these wheels (hash-checking mode)
+
+    Returns:
+        list: requirements
+
+    """
+    requirements = collections.defaultdict(set)
+    for wheel in wheels:
+        name, version, _, _ = packaging.utils.parse_wheel_filename(wheel)
+        requirements[f'{name}=={version}'].add(hashes[wheel] if hashes is not None else None)
+    if hashes is None:
+        return sorted(requirements)
+    return sorted(
+        ' '.join([requirement] + ['--hash=sha256:%s' % digest for digest in sorted(digests)])
+        for requirement, digests in requirements.items()
+    )
+
+
+def copy_wheels(docker_client, config, wheels, build_context, destination):
+    """
+    Copy wheels from the wheel volume to a build context directory.
+
+    Args:
+        docker_client (docker.DockerClient): a docker client
+        config (dict): Grocker config
+        wheels (list): wheel filenames, None to copy every wheel of the volume
+        build_context (grocker.builders.contexts.BuildContext): the build context
+        destination (str): build context directory where wheels are copied
+
+    """
+    build_context.add_directory(destination)
+    if wheels is None:
+        paths = [WHEELS_DIRECTORY]
+    else:
+        paths = [posixpath.join(WHEELS_DIRECTORY, wheel) for wheel in wheels]
+    if not paths:
+        return
+
+    copied_wheels = []
+    usage.record_volume_use(naming.wheel_volume_name(config))
+    with usage.volume_lock(naming.wheel_volume_name(config)), _wheel_volume_reader(docker_client, config) as container:
+        for path in paths:
+            with op.docker_open_archive(container, path) as archive:
+                for member in archive:
+                    # Skip metadata and nested files when the whole volume is copied
+                    if not member.isfile() or member.name.count('/') > 1 or not member.name.endswith('.whl'):
+                        continue
+                    filename = posixpath.basename(member.name)
+                    build_context.add_fileobj(
+                        posixpath.join(destination, filename), archive.extractfile(member), member.size,
+                    )
+                    copied_wheels.append(filename)
+
+    logger.debug('Wheels copied to %s: %s', destination, copied_wheels)
+
+
+def compile_wheels(docker_client, config, requirements, pip_conf, reuse_wheels=True, jobs=1):
     wheels_destination_volume = op.get_or_create_data_volume(
         docker_client,
         naming.wheel_volume_name(config),
@@ -50,31 +222,76 @@ def compile_wheels(docker_client, config, requirement, pip_conf):
     )
     volumes = {
         wheels_destination_volume.name: {
-            'bind': '/home/grocker/packages',
+            'bind': WHEELS_DIRECTORY,
             'mode': 'rw',
         },
     }
+    usage.record_volume_use(wheels_destination_volume.name)
 
-    if requirement.filepath:
-        filename = os.path.basename(requirement.filepath)
-        wheel_path = f'/tmp/src/{filename}'  # noqa: S108
-        volumes[requirement.filepath] = {'bind': wheel_path, 'mode': 'ro'}
-        to_install = wheel_path + requirement.pip_extras
-    else:
-        to_install = requirement.to_install
+    constraints = _read_constraints(config)
+    records = {}
+    for requirement in requirements:
+        records.setdefault(wheels_record_identifier(requirement, constraints), requirement)
 
-    command = ['--python', config['runtimes'][config['runtime']]['runtime'], to_install]
-    environment = get_pip_env(pip_conf)
+    if reuse_wheels:
+        compiled_records = get_compiled_records(docker_client, config, list(records))
+        for identifier, record in compiled_records.items():
+            if record is not None:
+                logger.info('Wheels for %s are already compiled.', records[identifier].to_install)
+                del records[identifier]
+
+    if not records:
+        return
+
+    command = ['--python', config['runtimes'][config['runtime']]['runtime'], '--jobs', str(jobs)]
+    for identifier, requirement in records.items():
+        if requirement.filepath:
+            filename = os.path.basename(requirement.filepath)
+            wheel_path = f'/tmp/src/{filename}'  # noqa: S108
+            volumes[requirement.filepath] = {'bind': wheel_path, 'mode': 'ro'}
+            command += ['--record', identifier, wheel_path + requirement.pip_extras]
+        else:
+            command += ['--record', identifier, requirement.to_install]
 
-    if config['pip_constraint']:
-        with open(config['pip_constraint'], 'rb') as fp:
-            constraints = fp.read()
+    environment = get_pip_env(pip_conf)
+    if constraints:
         environment['PIP_CONSTRAINT_CONTENT'] = base64.b64encode(zlib.compress(constraints)).decode()
 
-    return op.docker_run_container(
+    op.docker_run_container(
         docker_client,
         naming.image_name(config, 'compiler'),
         command,
         volumes=volumes,
         environment=environment,
     )
+    usage.record_records_use(wheels_destination_volume.name, list(records))
+
+
+def collect_unused_wheels(docker_client, config, max_age):
+    """
+    Delete the wheels which are not used by a recent release from the wheel volume.
+
+    Records (the wheels used by a release) are kept when they were compiled, or used from this host, less
+    than max_age ago. Wheels which are not used by any kept record (nor built less than max_age ago) are
+    then deleted, once the builds of this host reading the volume are finished.
+
+    Args:
+        docker_client (docker.DockerClient): a docker client
+        config (dict): Grocker config
+        max_age (float): maximum time since the last use of a record (in seconds)
+
+    """
+    volume_name = naming.wheel_volume_name(config)
+    now = time.time()
+    command = ['--gc', '--max-age', str(max_age)]
+    for identifier, last_use in sorted(usage.load_record_uses(volume_name).items()):
+        if now - last_use <= max_age:
+            command += ['--keep-record', identifier]
+
+    with usage.volume_lock(volume_name, exclusive=True):
+        op.docker_run_container(
+            docker_client,
+            naming.image_name(config, 'compiler'),
+            command,
+            volumes={volume_name: {'bind': WHEELS_DIRECTORY, 'mode': 'rw'}},
+        )
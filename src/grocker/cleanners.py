@@ -1,79 +1,210 @@
 # Copyright (c) Polyconseil SAS. All rights reserved.
 
-import itertools
+import concurrent.futures
+import datetime
 import logging
+import re
+import time
 
 import docker.errors
+import docker.utils
 import packaging.version
 
 from . import __version__
+from . import usage
 
 logger = logging.getLogger(__name__)
 
+RUNNER_LABEL = 'grocker.image.role=runner'
+# See builders.naming.SHARED_WHEEL_SERVER_LABEL (builders are not imported by purge)
+SHARED_WHEEL_SERVER_LABEL = 'grocker.wheel-server.volume'
+
 
 def created_by_older_version(obj):
     grocker_version = packaging.version.parse(__version__)
-    labels = obj.attrs.get('Config', obj.attrs)['Labels']
-    obj_version = labels.get('grocker.version', '')
+    if isinstance(obj, dict):  # low-level API objects
+        labels = obj.get('Labels') or {}
+    else:
+        labels = obj.attrs.get('Config', obj.attrs)['Labels']
+    obj_version = labels.get('grocker.version')
+    if not obj_version:  # created by old grocker versions
+        return True
     return packaging.version.parse(obj_version) < grocker_version
 
 
-def docker_purge_container(docker_client, current_version=False):
+def format_size(size):
+    units = ['B', 'kB', 'MB', 'GB']
+    while size >= 1000 and units[1:]:
+        size /= 1000
+        units.pop(0)
+    return '%d B' % size if units[0] == 'B' else '%.1f %s' % (size, units[0])
+
+
+def _remove_all(removals, workers):
+    """
+    Run removals in a bounded thread pool.
+
+    Args:
+        removals (dict): (remove function, size) tuples by object description
+        workers (int): maximum number of concurrent removals
+
+    Returns:
+        tuple: number of removed objects and their size
+
+    """
+    count, size = 0, 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(remove): (name, object_size) for name, (remove, object_size) in removals.items()}
+        for future in concurrent.futures.as_completed(futures):
+            name, object_size = futures[future]
+            try:
+                future.result()
+            except docker.errors.APIError as e:
+                logger.error(e)
+            else:
+                logger.info('Removed %s', name)
+                count += 1
+                size += object_size
+    return count, size
+
+
+def docker_stop_shared_wheel_servers(docker_client, current_version=False, dry_run=False, workers=4):
+    """
+    Stop the shared wheel server containers (which are removed once stopped).
+
+    Args:
+        docker_client (docker.DockerClient): a docker client
+        current_version (bool): whether the containers for current version will be stopped
+        dry_run (bool): only report what would be stopped
+        workers (int): maximum number of concurrent stops
+
+    Returns:
+        tuple: number of stopped containers and reclaimed space (always 0, they do not write anything)
+
+    """
+    servers = [
+        container
+        for container in docker_client.api.containers(filters={'label': SHARED_WHEEL_SERVER_LABEL})
+        if current_version or created_by_older_version(container)
+    ]
+    if dry_run:
+        for container in servers:
+            logger.info('Would stop container %s', container['Names'][0].lstrip('/'))
+        return len(servers), 0
+
+    def stop(container_id):
+        docker_client.api.stop(container_id)
+        try:  # so that their wheel volume can be deleted
+            docker_client.api.wait(container_id, condition='removed')
+        except docker.errors.NotFound:  # already removed
+            pass
+
+    return _remove_all(
+        {
+            'container %s' % container['Names'][0].lstrip('/'): (lambda container=container: stop(container['Id']), 0)
+            for container in servers
+        },
+        workers,
+    )
+
+
+def docker_purge_container(docker_client, current_version=False, dry_run=False, workers=4):
     """
     Purge Grocker internal containers.
 
     Args:
         docker_client (docker.DockerClient): a docker client
         current_version (bool): whether the images for current version will be deleted
+        dry_run (bool): only report what would be deleted
+        workers (int): maximum number of concurrent deletions
+
+    Returns:
+        tuple: number of deleted containers and reclaimed space (in bytes, only known in dry run)
 
     """
+    # Containers are never pruned: pruning removes created containers too, as the ones of running builds
+    # (volume readers, shared wheel servers being started). The container list does not support label!
+    # (only prune endpoints do): runners are filtered out below.
     removable_containers = [
         container
-        for container in docker_client.containers.list(
-            all=True,
-            filters={'label': 'grocker.version', 'status': 'exited'},
+        for container in docker_client.api.containers(
+            all=True, filters={'label': 'grocker.version', 'status': 'exited'}, size=dry_run,
         )
         if (
             (current_version or created_by_older_version(container))
-            and container.attrs['Config']['Labels'].get('grocker.image.role') != 'runner'
+            and container['Labels'].get('grocker.image.role') != 'runner'
         )
     ]
+    if dry_run:
+        for container in removable_containers:
+            logger.info('Would remove container %s', container['Names'][0].lstrip('/'))
+        return len(removable_containers), sum(container.get('SizeRw', 0) for container in removable_containers)
 
-    for container in removable_containers:
-        logger.info('Removing container %s...', container.name)
-        try:
-            container.remove()
-        except docker.errors.APIError as e:
-            logger.error(e)
+    return _remove_all(
+        {
+            'container %s' % container['Names'][0].lstrip('/'): (
+                lambda container=container: docker_client.api.remove_container(container['Id']),
+                0,  # unknown without listing sizes, which is slow
+            )
+            for container in removable_containers
+        },
+        workers,
+    )
 
 
-def docker_purge_volumes(docker_client, current_version=False):
+def docker_purge_volumes(docker_client, current_version=False, dry_run=False, workers=4):
     """
     Purge Grocker volumes.
 
     Args:
         docker_client (docker.DockerClient): a docker client
         current_version (bool): whether the volumes for current version will be deleted
+        dry_run (bool): only report what would be deleted
+        workers (int): maximum number of concurrent deletions
+
+    Returns:
+        tuple: number of deleted volumes and reclaimed space (in bytes, only known in dry run)
 
     """
-    removable_volumes = [
-        volume
-        for volume in itertools.chain(
-            docker_client.volumes.list(filters={'label': 'grocker.version'}),
-            docker_client.volumes.list(filters={'label': 'grocker'}),  # old grocker versions
-        )
+    labels = (
+        'grocker.version',
+        'grocker',  # old grocker versions
+    )
+    if current_version and not dry_run:
+        # Since API 1.42, volume prune only deletes anonymous volumes, unless asked to.
+        extra_filters = {'all': 'true'} if docker.utils.version_gte(docker_client.api.api_version, '1.42') else {}
+        count, size = 0, 0
+        for label in labels:
+            result = docker_client.api.prune_volumes(filters=dict(extra_filters, label=label))
+            count += len(result.get('VolumesDeleted') or [])
+            size += result.get('SpaceReclaimed', 0)
+        return count, size
+
+    removable_volumes = {
+        volume['Name']: volume
+        for label in labels
+        for volume in docker_client.api.volumes(filters={'label': label}).get('Volumes') or []
         if current_version or created_by_older_version(volume)
-    ]
+    }
+    if dry_run:
+        sizes = {
+            volume['Name']: max(volume.get('UsageData', {}).get('Size', 0), 0)
+            for volume in docker_client.api.df().get('Volumes') or []
+        }
+        for name in removable_volumes:
+            logger.info('Would remove volume %s', name)
+        return len(removable_volumes), sum(sizes.get(name, 0) for name in removable_volumes)
 
-    for volume in removable_volumes:
-        logger.info('Removing volume %s...', volume.name)
-        try:
-            volume.remove()
-        except docker.errors.APIError as e:
-            logger.error(e)
+    return _remove_all(
+        {
+            'volume %s' % name: (lambda name=name: docker_client.api.remove_volume(name), 0)
+            for name in removable_volumes
+        },
+        workers,
+    )
 
 
-def docker_purge_images(docker_client, current_version=False, runner=False):
+def docker_purge_images(docker_client, current_version=False, runner=False, dry_run=False, workers=4):
     """
     Purge Grocker images.
 
@@ -81,20 +212,123 @@ def docker_purge_images(docker_client, current_version=False, runner=False):
         docker_client (docker.DockerClient): a docker client
         current_version (bool): whether the images for current version will be deleted
         runner (bool): whether the runner images will be deleted
+        dry_run (bool): only report what would be deleted
+        workers (int): maximum number of concurrent deletions
+
+    Returns:
+        tuple: number of deleted images (and layers when pruned) and reclaimed space (in bytes, shared layers
+        are counted once per image when not pruned)
 
     """
+    filters = {'label': 'grocker.version'}
+    if not runner:
+        filters['label!'] = RUNNER_LABEL
+    if current_version and not dry_run:
+        result = docker_client.api.prune_images(filters=dict(filters, dangling=False))
+        deleted = [item for item in result.get('ImagesDeleted') or [] if 'Deleted' in item]
+        return len(deleted), result.get('SpaceReclaimed', 0)
+
     removable_images = [
         image
-        for image in docker_client.images.list(filters={'label': 'grocker.version'})
+        for image in docker_client.api.images(filters={'label': 'grocker.version'})
         if (
             (current_version or created_by_older_version(image))
-            and (runner or image.attrs.get('Labels', {}).get('grocker.image.role') == 'runner')
+            and (runner or (image.get('Labels') or {}).get('grocker.image.role') != 'runner')
         )
     ]
-    for image in removable_images:
-        for tag in image.tags:
-            logger.info('Removing image %s...', tag)
-            try:
-                docker_client.images.remove(tag)
-            except docker.errors.APIError as e:
-                logger.error(e)
+    if dry_run:
+        for image in removable_images:
+            logger.info('Would remove image %s', ', '.join(image.get('RepoTags') or [image['Id']]))
+        return len(removable_images), sum(image.get('Size', 0) for image in removable_images)
+
+    return _remove_all(
+        {
+            # Removing an image by id needs force when it is tagged in several repositories.
+            'image %s' % ', '.join(image.get('RepoTags') or [image['Id']]): (
+                lambda image=image: docker_client.api.remove_image(
+                    image['Id'], force=len(image.get('RepoTags') or []) > 1,
+                ),
+                image.get('Size', 0),
+            )
+            for image in removable_images
+        },
+        workers,
+    )
+
+
+def _parse_docker_time(value):
+    """Return the timestamp of a Docker RFC 3339 time (0 if it can not be parsed)."""
+    try:
+        value = re.sub(r'\.\d+', '', value).replace('Z', '+00:00')  # Python < 3.11 only parses microseconds
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return 0
+
+
+def docker_evict_wheel_volumes(docker_client, max_size=None, max_age=None, dry_run=False, workers=4):
+    """
+    Delete the least recently used wheel volumes.
+
+    Volumes not used for more than max_age are deleted, then the least recently used volumes are deleted
+    until the wheel volumes fit in max_size. Last uses are recorded by the builds (on this host), volumes
+    unknown to this host are considered used when they were created. Volumes used by a container are kept.
+
+    Args:
+        docker_client (docker.DockerClient): a docker client
+        max_size (int): maximum size of the wheel volumes (in bytes)
+        max_age (float): maximum time since the last use of a wheel volume (in seconds)
+        dry_run (bool): only report what would be deleted
+        workers (int): maximum number of concurrent deletions
+
+    Returns:
+        tuple: number of deleted volumes and reclaimed space (in bytes)
+
+    """
+    now = time.time()
+    uses = usage.load_volume_uses()
+    wheel_volumes = [
+        volume
+        for volume in docker_client.api.df().get('Volumes') or []
+        if (
+            (volume.get('Labels') or {}).get('grocker.image.role') == 'wheel'
+            and not created_by_older_version(volume)  # already deleted by docker_purge_volumes
+        )
+    ]
+    if not dry_run:
+        existing_names = {volume['Name'] for volume in docker_client.api.volumes().get('Volumes') or []}
+        usage.forget_volumes(set(uses) - existing_names)
+
+    total_size = 0
+    candidates = []
+    for volume in wheel_volumes:
+        usage_data = volume.get('UsageData') or {}
+        size = max(usage_data.get('Size', 0), 0)
+        total_size += size
+        if usage_data.get('RefCount', 0) > 0:
+            continue
+        last_use = uses.get(volume['Name']) or _parse_docker_time(volume.get('CreatedAt'))
+        candidates.append((last_use, volume['Name'], size))
+
+    evicted = {}
+    for last_use, name, size in sorted(candidates):
+        if (max_age is not None and now - last_use > max_age) or (max_size is not None and total_size > max_size):
+            evicted[name] = size
+            total_size -= size
+
+    if dry_run:
+        for name in evicted:
+            logger.info('Would remove volume %s', name)
+        return len(evicted), sum(evicted.values())
+
+    removed = []
+
+    def remove(name):
+        docker_client.api.remove_volume(name)
+        removed.append(name)
+
+    result = _remove_all(
+        {'volume %s' % name: (lambda name=name: remove(name), size) for name, size in evicted.items()},
+        workers,
+    )
+    usage.forget_volumes(removed)  # at once, the usage file is rewritten on each update
+    return result
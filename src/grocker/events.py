@@ -0,0 +1,246 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import contextlib
+import datetime
+import json
+import re
+import sys
+import threading
+import time
+
+_STEP_RE = re.compile(r'^Step (?P<number>\d+)/(?P<total>\d+) : (?P<instruction>.*)$')
+_PIP_RE = re.compile(
+    r'^\s*(?P<phase>Collecting|Downloading|Processing|Building wheels? for|Created wheel for|Saved|Stored in directory'
+    r'|Installing collected packages|Successfully built|Successfully installed)[: ]\s*(?P<detail>.*)$',
+)
+_ERROR_RE = re.compile(r'^\s*(ERROR|error):\s*(?P<detail>.*)$')
+
+
+class Event:
+    """Something which happened while building an image, or running a container."""
+
+    kind = 'output'
+
+    def __init__(self, source, message, timestamp=None):
+        self.source = source
+        self.message = message
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+    def to_dict(self):
+        data = {
+            'event': self.kind,
+            'time': datetime.datetime.fromtimestamp(self.timestamp, datetime.timezone.utc).isoformat(),
+            'source': self.source,
+            'message': self.message,
+        }
+        data.update(self.details())
+        return data
+
+    def details(self):
+        return {}
+
+
+class OutputEvent(Event):
+    """Raw output line."""
+
+
+class StartEvent(Event):
+    """A build (or a container run) started."""
+
+    kind = 'start'
+
+
+class EndEvent(Event):
+    """A build (or a container run) ended."""
+
+    kind = 'end'
+
+    def __init__(self, source, message, success, timestamp=None):
+        super().__init__(source, message, timestamp)
+        self.success = success
+
+    def details(self):
+        return {'success': self.success}
+
+
+class StepEvent(Event):
+    """A Dockerfile step started."""
+
+    kind = 'step'
+
+    def __init__(self, source, message, number, total, instruction, timestamp=None):
+        super().__init__(source, message, timestamp)
+        self.number = number
+        self.total = total
+        self.instruction = instruction
+
+    def details(self):
+        return {'number': self.number, 'total': self.total, 'instruction': self.instruction}
+
+
+class PipEvent(Event):
+    """A pip phase (collecting, building, installing...) started."""
+
+    kind = 'pip'
+
+    def __init__(self, source, message, phase, detail, timestamp=None):
+        super().__init__(source, message, timestamp)
+        self.phase = phase
+        self.detail = detail
+
+    def details(self):
+        return {'phase': self.phase, 'detail': self.detail}
+
+
+class ErrorEvent(Event):
+    """An error was reported."""
+
+    kind = 'error'
+
+
+def parse_line(source, line):
+    """Return the event matching an output line."""
+    match = _STEP_RE.match(line)
+    if match:
+        return StepEvent(
+            source, line,
+            number=int(match.group('number')),
+            total=int(match.group('total')),
+            instruction=match.group('instruction'),
+        )
+
+    match = _PIP_RE.match(line)
+    if match:
+        phase = match.group('phase').lower().replace(' ', '-')
+        return PipEvent(source, line, phase=phase, detail=match.group('detail'))
+
+    if _ERROR_RE.match(line):
+        return ErrorEvent(source, line)
+
+    return OutputEvent(source, line)
+
+
+class LineSplitter:
+    """Split a stream of text chunks into lines."""
+
+    def __init__(self):
+        self._buffer = ''
+
+    def feed(self, chunk):
+        """Return the lines completed by chunk."""
+        lines = (self._buffer + chunk).split('\n')
+        self._buffer = lines.pop()
+        return [line.rstrip('\r') for line in lines]
+
+    def flush(self):
+        """Return the remaining (unterminated) line, if any."""
+        lines = [self._buffer] if self._buffer else []
+        self._buffer = ''
+        return lines
+
+
+class Recorder:
+    """Keep the events emitted in a thread, to compute step durations."""
+
+    def __init__(self):
+        self.events = []
+
+    def add(self, event):
+        if isinstance(event, (StartEvent, EndEvent, StepEvent)):
+            self.events.append(event)
+
+    def step_durations(self):
+        """
+        Return the duration of each step of each recorded build or container run.
+
+        Returns:
+            list: a dict (with source, step and duration keys) for each step
+
+        """
+        durations = []
+        current = {}  # running step by source
+        for event in self.events:
+            previous = current.pop(event.source, None)
+            if previous is not None:
+                durations.append({
+                    'source': previous.source,
+                    'step': previous.instruction if isinstance(previous, StepEvent) else previous.message,
+                    'duration': round(event.timestamp - previous.timestamp, 3),
+                })
+            if not isinstance(event, EndEvent):
+                current[event.source] = event
+        return durations
+
+
+def render_human(event):
+    if isinstance(event, (StartEvent, EndEvent)):
+        return
+    sys.stdout.write(event.message + '\n')
+
+
+def render_ndjson(event):
+    sys.stdout.write(json.dumps(event.to_dict()) + '\n')
+
+
+RENDERERS = {
+    'human': render_human,
+    'ndjson': render_ndjson,
+}
+
+_renderer = render_human
+_render_lock = threading.Lock()
+_local = threading.local()
+
+
+def setup(output_format='human'):
+    global _renderer
+    _renderer = RENDERERS[output_format]
+
+
+def emit(event):
+    for recorder in getattr(_local, 'recorders', []):
+        recorder.add(event)
+    with _render_lock:
+        _renderer(event)
+        sys.stdout.flush()
+
+
+@contextlib.contextmanager
+def recording(recorder=None):
+    """
+    Yield a recorder receiving the events emitted by the current thread.
+
+    Args:
+        recorder: an object with an ``add(event)`` method, a new Recorder by default
+
+    """
+    recorder = recorder or Recorder()
+    recorders = _local.__dict__.setdefault('recorders', [])
+    recorders.append(recorder)
+    try:
+        yield recorder
+    finally:
+        recorders.remove(recorder)
+
+
+def current_recorders():
+    """Return the recorders receiving the events emitted by the current thread."""
+    return list(getattr(_local, 'recorders', []))
+
+
+@contextlib.contextmanager
+def forwarding(recorders):
+    """Make recorders (of another thread) receive the events emitted by the current thread."""
+    with contextlib.ExitStack() as stack:
+        for recorder in recorders:
+            stack.enter_context(recording(recorder))
+        yield
+
+
+def replay(events, exclude=()):
+    """Give already emitted events to the recorders of the current thread (except excluded ones), without
+    rendering them again."""
+    for recorder in current_recorders():
+        if not any(recorder is excluded for excluded in exclude):
+            for event in events:
+                recorder.add(event)
@@ -6,7 +6,8 @@ import functools
 import json
 import os
 import os.path
-import shutil
+import posixpath
+import re
 import subprocess  # noqa: S404
 import tempfile
 import time
@@ -15,6 +16,8 @@ from importlib import resources
 import jinja2
 import yaml
 
+RESOURCES_PACKAGE = 'grocker.resources'
+
 
 def deep_update(initial_mapping, updating_mapping):
     updated_mapping = initial_mapping.copy()
@@ -26,17 +29,6 @@ def deep_update(initial_mapping, updating_mapping):
     return updated_mapping
 
 
-def copy_resources(package, destination):
-    os.makedirs(destination, exist_ok=True)
-
-    for entry in resources.contents(package):
-        if not resources.is_resource(package, entry):
-            continue
-
-        with resources.path(package, entry) as resource_path:
-            shutil.copy2(str(resource_path), destination)
-
-
 def load_yaml(file_path):
     with open(file_path, encoding='utf-8') as fp:
         return yaml.safe_load(fp.read())
@@ -55,17 +47,30 @@ def load_yaml_resource(package, name):
         return load_yaml(str(resource_path))
 
 
-def render_template(template_path, output_path, context):
-    env = jinja2.Environment()  # noqa: S701
-    env.filters['jsonify'] = json.dumps
+@functools.lru_cache(maxsize=None)
+def get_template_environment():
+    """
+    Return the Jinja environment shared by Grocker.
 
-    with open(template_path, encoding='utf-8') as template_file:
-        template = env.from_string(template_file.read())
+    Templates are loaded from grocker.resources and kept compiled (resources never change while running),
+    and their bytecode is cached on disk for the next runs.
+    """
+    env = jinja2.Environment(  # noqa: S701
+        loader=jinja2.PackageLoader('grocker', 'resources'),
+        auto_reload=False,
+        bytecode_cache=jinja2.FileSystemBytecodeCache(),
+    )
+    env.filters['jsonify'] = json.dumps
+    return env
 
-    output = template.render(**context)
 
-    with open(output_path, mode='w', encoding='utf-8') as output_file:
-        output_file.write(output)
+def render_template_resource(package, name, context):
+    """Render the name template of a grocker.resources package."""
+    if package != RESOURCES_PACKAGE and not package.startswith(RESOURCES_PACKAGE + '.'):
+        raise ValueError('Templates must be in %s, not in %s' % (RESOURCES_PACKAGE, package))
+    directory = package[len(RESOURCES_PACKAGE) + 1:].replace('.', '/')
+    template = get_template_environment().get_template(posixpath.join(directory, name))
+    return template.render(**context)
 
 
 @contextlib.contextmanager
@@ -113,3 +118,26 @@ def retry(exception, tries=3, delay=1):
                     time.sleep(delay)
         return inner
     return decorator
+
+
+SIZE_UNITS = {'': 1, 'k': 10 ** 3, 'm': 10 ** 6, 'g': 10 ** 9, 't': 10 ** 12}
+BINARY_SIZE_UNITS = {'k': 2 ** 10, 'm': 2 ** 20, 'g': 2 ** 30, 't': 2 ** 40}
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_size(value):
+    """Parse a size (e.g. ``500M``, ``20G`` or ``20GiB``) and return it in bytes."""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*(?:([kmgt])(i)?)?b?\s*$', value, re.IGNORECASE)
+    if not match:
+        raise ValueError('Invalid size: %s' % value)
+    unit = (match.group(2) or '').lower()
+    units = BINARY_SIZE_UNITS if match.group(3) else SIZE_UNITS
+    return int(float(match.group(1)) * units[unit])
+
+
+def parse_duration(value):
+    """Parse a duration (e.g. ``12h`` or ``30d``, in days by default) and return it in seconds."""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*$', value, re.IGNORECASE)
+    if not match:
+        raise ValueError('Invalid duration: %s' % value)
+    return float(match.group(1)) * DURATION_UNITS[match.group(2).lower() or 'd']
@@ -0,0 +1,161 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import collections
+import contextlib
+import json
+import re
+import threading
+import time
+
+_API_VERSION_RE = re.compile(r'^/v\d+(\.\d+)*')
+
+
+class Profiler:
+    """Record the duration of build phases and Docker API calls, and the result of image lookups."""
+
+    def __init__(self):
+        self.origin = time.time()
+        self.spans = []
+        self.image_lookups = []
+        self._lock = threading.Lock()
+        self._threads = {}
+
+    def add_span(self, name, category, start, duration, **args):
+        thread = threading.current_thread()
+        with self._lock:
+            self._threads.setdefault(thread.ident, thread.name)
+            self.spans.append({
+                'name': name,
+                'category': category,
+                'start': start,
+                'duration': duration,
+                'thread': thread.ident,
+                'args': args,
+            })
+
+    @contextlib.contextmanager
+    def phase(self, name, **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, 'phase', start, time.time() - start, **args)
+
+    def add_image_lookup(self, name, source):
+        with self._lock:
+            self.image_lookups.append({'image': name, 'source': source, 'hit': source == 'local'})
+
+    def on_response(self, response, *args, **kwargs):
+        """Requests response hook recording Docker API calls (until their response headers are received)."""
+        elapsed = response.elapsed.total_seconds()
+        self.add_span(
+            '%s %s' % (response.request.method, _api_path(response.request.path_url)),
+            'docker',
+            time.time() - elapsed,
+            elapsed,
+            status=response.status_code,
+        )
+
+    def summary(self):
+        """
+        Return the profile to write in the result file.
+
+        Returns:
+            dict: total duration, phases, Docker API calls by endpoint and image lookups
+
+        """
+        with self._lock:
+            spans = list(self.spans)
+            image_lookups = list(self.image_lookups)
+
+        endpoints = collections.defaultdict(lambda: {'calls': 0, 'duration': 0})
+        for span in spans:
+            if span['category'] == 'docker':
+                endpoints[span['name']]['calls'] += 1
+                endpoints[span['name']]['duration'] += span['duration']
+
+        return {
+            'duration': round(time.time() - self.origin, 3),
+            'phases': [
+                dict(span['args'], name=span['name'], duration=round(span['duration'], 3))
+                for span in spans
+                if span['category'] == 'phase'
+            ],
+            'docker_api': {
+                'calls': sum(endpoint['calls'] for endpoint in endpoints.values()),
+                'duration': round(sum(endpoint['duration'] for endpoint in endpoints.values()), 3),
+                'endpoints': {
+                    name: {'calls': endpoint['calls'], 'duration': round(endpoint['duration'], 3)}
+                    for name, endpoint in sorted(endpoints.items())
+                },
+            },
+            'image_lookups': image_lookups,
+        }
+
+    def trace(self):
+        """Return the profile in the Trace Event Format (to open it with chrome://tracing or Perfetto)."""
+        with self._lock:
+            spans = list(self.spans)
+            threads = dict(self._threads)
+
+        tids = {ident: tid for tid, ident in enumerate(threads, start=1)}
+        trace_events = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tids[ident], 'args': {'name': name}}
+            for ident, name in threads.items()
+        ]
+        trace_events.extend(
+            {
+                'name': span['name'],
+                'cat': span['category'],
+                'ph': 'X',
+                'ts': round((span['start'] - self.origin) * 1e6),
+                'dur': round(span['duration'] * 1e6),
+                'pid': 1,
+                'tid': tids[span['thread']],
+                'args': span['args'],
+            }
+            for span in spans
+        )
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    def dump_trace(self, file_path):
+        with open(file_path, 'w') as fp:
+            json.dump(self.trace(), fp)
+
+
+def _api_path(path_url):
+    return _API_VERSION_RE.sub('', path_url.split('?', 1)[0])
+
+
+_profiler = None
+
+
+def enable():
+    """Start profiling, and return the Profiler."""
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def disable():
+    global _profiler
+    _profiler = None
+
+
+def instrument(docker_client):
+    """Record the Docker API calls made by docker_client, if profiling is enabled."""
+    if _profiler is not None:
+        docker_client.api.hooks['response'].append(_profiler.on_response)
+
+
+def phase(name, **args):
+    """Return a context manager recording a build phase, if profiling is enabled."""
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.phase(name, **args)
+
+
+def record_image_lookup(name, source):
+    """Record where an image was found (local, registry or build), if profiling is enabled."""
+    if _profiler is not None:
+        _profiler.add_image_lookup(name, source)
@@ -0,0 +1,213 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import base64
+import collections
+import concurrent.futures
+import logging
+import re
+import threading
+import time
+import urllib.parse
+
+import docker.auth
+import docker.errors
+import requests
+import requests.adapters
+import urllib3.util.retry
+
+logger = logging.getLogger(__name__)
+
+DOCKER_HUB_REGISTRY = 'registry-1.docker.io'
+MANIFEST_MEDIA_TYPES = (
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+)
+
+_CHALLENGE_RE = re.compile(r'(\w+)="([^"]*)"')
+
+Manifest = collections.namedtuple('Manifest', ['digest', 'media_type', 'content'])
+
+
+def split_image_name(name):
+    """Return the repository and the tag of an image name."""
+    repository, _, tag = name.rpartition(':')
+    if not repository or '/' in tag:  # no tag, the colon is the registry port one
+        return name, 'latest'
+    return repository, tag
+
+
+def split_repository(repository):
+    """Return the registry (``registry-1.docker.io`` for Docker Hub) and the path of a repository."""
+    registry, _, path = repository.partition('/')
+    if not path or ('.' not in registry and ':' not in registry and registry != 'localhost'):
+        # Docker Hub, official images are in the library namespace
+        return DOCKER_HUB_REGISTRY, repository if '/' in repository else 'library/' + repository
+    return registry, path
+
+
+class RegistryError(Exception):
+    pass
+
+
+class RegistryClient:
+    """
+    Docker registry (HTTP API V2) client.
+
+    Connections are pooled and kept alive, idempotent requests are retried (with exponential backoff) on
+    connection errors and on 429 and 5xx responses, and bearer tokens (got using Docker credentials when
+    they exist) are cached by scope.
+
+    Args:
+        scheme (str): https, or http for insecure registries
+        timeout (float): timeout of each request (in seconds)
+        retries (int): maximum number of retries
+        backoff (float): backoff factor between retries (in seconds)
+        workers (int): maximum number of concurrent requests (and of pooled connections by registry)
+        auth_config (dict): Docker credentials, default to the Docker client config ones
+    """
+
+    def __init__(self, scheme='https', timeout=5, retries=3, backoff=0.5, workers=8, auth_config=None):
+        self.scheme = scheme
+        self.timeout = timeout
+        self.workers = workers
+        self.auth_config = auth_config
+        self.session = requests.Session()
+        retry = urllib3.util.retry.Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=('HEAD', 'GET'),
+            raise_on_status=False,
+        )
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get_manifest(self, name, method='GET'):
+        """
+        Get an image manifest from its registry.
+
+        Args:
+            name (str): image name
+            method (str): GET, or HEAD to only get the manifest digest
+
+        Returns:
+            Manifest: the manifest (without content for HEAD), None when the registry does not know the image
+
+        """
+        repository, tag = split_image_name(name)
+        registry, path = split_repository(repository)
+        response = self.request(
+            method, registry, f'{path}/manifests/{tag}', scope=f'repository:{path}:pull',
+            headers={'Accept': ', '.join(MANIFEST_MEDIA_TYPES)},
+        )
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return Manifest(
+            digest=response.headers.get('Docker-Content-Digest'),
+            media_type=response.headers.get('Content-Type'),
+            content=response.json() if method == 'GET' else None,
+        )
+
+    def get_manifest_digest(self, name):
+        """Return the manifest digest of an image, None when the registry does not know the image."""
+        manifest = self.get_manifest(name, method='HEAD')
+        return manifest.digest if manifest else None
+
+    def get_manifest_digests(self, names):
+        """
+        Get the manifest digests of many images concurrently.
+
+        Returns:
+            dict: manifest digest (None when unknown) by image name
+
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return dict(zip(names, executor.map(self.get_manifest_digest, names)))
+
+    def list_tags(self, repository):
+        """Return the tags of a repository (an empty list when the registry does not know it)."""
+        registry, path = split_repository(repository)
+        tags = []
+        url_path = f'{path}/tags/list'
+        while url_path:
+            response = self.request('GET', registry, url_path, scope=f'repository:{path}:pull')
+            if response.status_code == 404:
+                return []
+            response.raise_for_status()
+            tags.extend(response.json().get('tags') or [])
+            next_url = response.links.get('next', {}).get('url')  # paginated
+            url_path = next_url.split('/v2/', 1)[1] if next_url else None
+        return tags
+
+    def request(self, method, registry, path, scope=None, headers=None):
+        """Send a request to a registry, authenticating when the registry asks to."""
+        url = f'{self.scheme}://{registry}/v2/{path}'
+        headers = dict(headers or {})
+        token = self._tokens.get((registry, scope))
+        if token and token[1] > time.time():
+            headers['Authorization'] = 'Bearer ' + token[0]
+
+        response = self.session.request(method, url, headers=headers, timeout=self.timeout)
+        if response.status_code == 401 and 'Authorization' not in headers:
+            challenge = response.headers.get('WWW-Authenticate', '')
+            headers['Authorization'] = self._authorize(registry, scope, challenge)
+            response = self.session.request(method, url, headers=headers, timeout=self.timeout)
+        return response
+
+    def _credentials(self, registry):
+        try:
+            auth_config = self.auth_config if self.auth_config is not None else docker.auth.load_config()
+            registry = None if registry == DOCKER_HUB_REGISTRY else registry
+            credentials = docker.auth.resolve_authconfig(auth_config, registry) or {}
+        except docker.errors.DockerException as e:
+            logger.warning('Unable to get %s credentials: %s', registry, e)
+            return None
+        username = credentials.get('username') or credentials.get('Username')
+        password = credentials.get('password') or credentials.get('Password')
+        return (username, password) if username else None
+
+    def _authorize(self, registry, scope, challenge):
+        """Return the Authorization header answering a registry challenge."""
+        scheme, _, parameters = challenge.partition(' ')
+        credentials = self._credentials(registry)
+        if scheme.lower() == 'basic':
+            if not credentials:
+                raise RegistryError('Registry %s needs credentials' % registry)
+            return 'Basic ' + base64.b64encode(':'.join(credentials).encode('utf-8')).decode('ascii')
+        if scheme.lower() != 'bearer':
+            raise RegistryError('Unsupported authentication for registry %s: %s' % (registry, challenge))
+
+        parameters = dict(_CHALLENGE_RE.findall(parameters))
+        query = {'service': parameters.get('service', registry)}
+        if scope or parameters.get('scope'):
+            query['scope'] = scope or parameters['scope']
+        response = self.session.get(
+            parameters['realm'] + '?' + urllib.parse.urlencode(query),
+            auth=credentials,
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        data = response.json()
+        token = data.get('token') or data.get('access_token')
+        with self._lock:
+            self._tokens[(registry, scope)] = (token, time.time() + data.get('expires_in', 60) - 5)
+        return 'Bearer ' + token
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the registry client shared by Grocker commands."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = RegistryClient()
+        return _client
@@ -2,23 +2,62 @@
 
 import argparse
 import base64
+import concurrent.futures
 import configparser
+import contextlib
+import fcntl
+import hashlib
+import html
+import json
 import logging
 import logging.config
 import os
 import os.path
+import re
+import shutil
 import subprocess  # noqa: S404
 import tempfile
+import time
+import urllib.parse
 import zlib
 
 WHEELS_DIRECTORY = os.path.expanduser('~/packages')
+BOOTSTRAPPED_VENV = os.path.expanduser('~/compiler.venv')  # created when building the compiler image
+VENV_PACKAGES = ['pip', 'setuptools', 'wheel']
+# Dot directories are ignored by pip --find-links and nginx autoindex
+METADATA_DIRECTORY = os.path.join(WHEELS_DIRECTORY, '.grocker')
+RECORDS_DIRECTORY = os.path.join(METADATA_DIRECTORY, 'records')
+INVENTORY_PATH = os.path.join(METADATA_DIRECTORY, 'inventory.json')
+LOCK_PATH = os.path.join(METADATA_DIRECTORY, 'lock')
+# PEP 503 simple repository of the wheels, used by runner image builds
+INDEX_DIRECTORY = os.path.join(METADATA_DIRECTORY, 'simple')
+INDEX_LOCK_PATH = os.path.join(METADATA_DIRECTORY, 'index.lock')
+CPU_MAX_PATH = '/sys/fs/cgroup/cpu.max'  # CPU quota (cgroup v2)
+INDEX_LINK_RE = re.compile(r'<a href="[./]*([^"#]+)#sha256=([0-9a-f]{64})">')
 
 
 def arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--python', default='python')
     parser.add_argument('--no-color', action='store_true')
-    parser.add_argument('release', nargs='+')
+    parser.add_argument(
+        '--record', action='append', default=[],
+        help='record the wheels used by the release under this identifier (once per release)',
+    )
+    parser.add_argument(
+        '--jobs', type=int, default=1,
+        help='resolve dependencies first, then build missing wheels in parallel (0 for every available CPU)',
+    )
+    parser.add_argument(
+        '--gc', action='store_true',
+        help='delete the records older than --max-age (except kept ones), then the wheels no record uses',
+    )
+    parser.add_argument('--max-age', type=float, default=30 * 86400, help='maximum age of records (in seconds)')
+    parser.add_argument(
+        '--keep-record', action='append', default=[],
+        help='identifier of a record to keep whatever its age',
+    )
+    parser.add_argument('release', nargs='*')
 
     return parser
 
@@ -62,53 +101,357 @@ def setup_pip(venv, package_dir):
 
 def setup_venv(python):
     """Return python interpreter after setup the venv."""
-    info('Setup venv using %s...', python)
-    venv = tempfile.mkdtemp(suffix='.venv')
-    try:
-        # python 3
-        subprocess.check_call([python, '-m', 'venv', venv])  # noqa: S603
-    except subprocess.CalledProcessError:
-        subprocess.check_call([python, '-m', 'virtualenv', venv])  # noqa: S603
+    if os.path.exists(os.path.join(BOOTSTRAPPED_VENV, 'bin', 'pip')):
+        info('Using bootstrapped venv...')
+        venv = BOOTSTRAPPED_VENV
+        missing_packages = subprocess.check_output(  # noqa: S603
+            [
+                os.path.join(venv, 'bin', 'python'), '-c',
+                'import importlib.util, sys; print(*(p for p in sys.argv[1:] if not importlib.util.find_spec(p)))',
+            ] + VENV_PACKAGES,
+        ).decode().split()
+        if not missing_packages:
+            return venv
+        info('Repairing venv (missing %s)...', ', '.join(missing_packages))
+        packages = missing_packages
+    else:
+        info('Setup venv using %s...', python)
+        venv = tempfile.mkdtemp(suffix='.venv')
+        try:
+            # python 3
+            subprocess.check_call([python, '-m', 'venv', venv])  # noqa: S603
+        except subprocess.CalledProcessError:
+            subprocess.check_call([python, '-m', 'virtualenv', venv])  # noqa: S603
+        packages = VENV_PACKAGES
+
     subprocess.check_call(  # noqa: S603
-        [os.path.join(venv, 'bin', 'pip'), 'install', '-U', 'pip', 'setuptools', 'wheel'],
+        [os.path.join(venv, 'bin', 'pip'), 'install', '-U'] + packages,
     )
     return venv
 
 
-def build_wheels(venv, package, package_dir, constraint=None):
-    info('Building wheels for %s...', package)
+def write_json(path, data):
+    """Atomically write data as JSON in path."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as fp:
+        json.dump(data, fp, indent=2, sort_keys=True)
+    os.replace(fp.name, path)
+
+
+def available_cpus():
+    """Return the number of CPUs this container may use."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open(CPU_MAX_PATH) as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def wheel_key(name, version):
+    """Return a (normalized name, version) key, as used in wheel filenames."""
+    return re.sub(r'[-_.]+', '_', name).lower(), version
+
+
+def pip_wheel(venv, wheel_dir, packages, constraint=None, no_deps=False):
     pip = os.path.join(venv, 'bin', 'pip')
     constraint_args = ['--constraint', constraint] if constraint else []
-    try:
+    no_deps_args = ['--no-deps'] if no_deps else []
+    subprocess.check_call(  # noqa: S603
+        [pip, 'wheel', '--wheel-dir', wheel_dir]
+        + constraint_args
+        + no_deps_args
+        + packages,
+    )
+
+
+def resolve(venv, package, constraint=None):
+    """Return the distributions needed by package as (name, version, url, is_direct) tuples."""
+    info('Resolving dependencies of %s...', package)
+    pip = os.path.join(venv, 'bin', 'pip')
+    constraint_args = ['--constraint', constraint] if constraint else []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        report_path = os.path.join(tmp_dir, 'report.json')
         subprocess.check_call(  # noqa: S603
-            [pip, 'wheel', '--wheel-dir', package_dir]
+            [pip, 'install', '--dry-run', '--ignore-installed', '--quiet', '--report', report_path]
             + constraint_args
             + [package],
         )
-        return True
+        with open(report_path) as f:
+            report = json.load(f)
+
+    return [
+        (item['metadata']['name'], item['metadata']['version'], item['download_info']['url'], item.get('is_direct'))
+        for item in report['install']
+    ]
+
+
+def build_wheels_in_parallel(venv, package, package_dir, wheel_dir, constraint=None, jobs=0):
+    """Build wheels of package dependencies, each missing wheel being built by its own pip process."""
+    jobs = jobs or available_cpus()
+    available_wheels = {
+        wheel_key(*wheel.split('-')[:2]): wheel
+        for wheel in os.listdir(package_dir)
+        if wheel.endswith('.whl')
+    }
+
+    binaries, sources = [], []
+    for name, version, url, is_direct in resolve(venv, package, constraint):
+        # Direct references (as a local release wheel) may be rebuilt without changing their version
+        cached_wheel = None if is_direct else available_wheels.get(wheel_key(name, version))
+        if cached_wheel:
+            os.link(os.path.join(package_dir, cached_wheel), os.path.join(wheel_dir, cached_wheel))
+        elif url.endswith('.whl'):
+            binaries.append(url if is_direct else f'{name}=={version}')
+        else:
+            sources.append(url if is_direct else f'{name}=={version}')
+
+    info(
+        'Wheels for %s: %d cached, %d to download, %d to build using %d processes...',
+        package, len(os.listdir(wheel_dir)), len(binaries), len(sources), jobs,
+    )
+    if binaries:
+        pip_wheel(venv, wheel_dir, binaries, constraint, no_deps=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        # Consume results to raise the first build error
+        list(executor.map(lambda source: pip_wheel(venv, wheel_dir, [source], constraint, no_deps=True), sources))
+
+
+def build_wheels(venv, package, package_dir, constraint=None, jobs=1):
+    """Return the wheels used by package (or None on failure) after building missing ones in package_dir."""
+    info('Building wheels for %s...', package)
+
+    # Every wheel needed by the package is saved in the wheel dir, already built ones included.
+    os.makedirs(METADATA_DIRECTORY, exist_ok=True)
+    wheel_dir = tempfile.mkdtemp(dir=METADATA_DIRECTORY)
+    try:
+        if jobs == 1:
+            pip_wheel(venv, wheel_dir, [package], constraint)
+        else:
+            build_wheels_in_parallel(venv, package, package_dir, wheel_dir, constraint, jobs)
+        wheels = sorted(os.listdir(wheel_dir))
+        for wheel in wheels:
+            os.replace(os.path.join(wheel_dir, wheel), os.path.join(package_dir, wheel))
+        return wheels
     except subprocess.CalledProcessError as exc:
         info(str(exc))
         if exc.output:
             print(exc.output)
-        return False
+        return None
+    finally:
+        shutil.rmtree(wheel_dir, ignore_errors=True)
+
+
+def update_inventory(package_dir):
+    """Record the wheels available in package_dir."""
+    write_json(INVENTORY_PATH, sorted(entry for entry in os.listdir(package_dir) if entry.endswith('.whl')))
+
+
+def project_name(wheel):
+    """Return the normalized (PEP 503) project name of a wheel."""
+    return re.sub(r'[-_.]+', '-', wheel.split('-')[0]).lower()
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_text(path, text):
+    """Atomically write text in path."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as fp:
+        fp.write(text)
+    os.chmod(fp.name, 0o644)  # readable by the wheel server
+    os.replace(fp.name, path)
+
+
+def read_index_hashes(path):
+    """Return the sha256 of the wheels listed by a project page, by wheel."""
+    try:
+        with open(path) as fp:
+            return {urllib.parse.unquote(wheel): digest for wheel, digest in INDEX_LINK_RE.findall(fp.read())}
+    except FileNotFoundError:
+        return {}
+
+
+def html_page(title, links):
+    return ''.join(
+        [f'<!DOCTYPE html>\n<html>\n  <head><title>{html.escape(title)}</title></head>\n  <body>\n']
+        + [f'    <a href="{html.escape(href)}">{html.escape(text)}</a><br>\n' for href, text in links]
+        + ['  </body>\n</html>\n'],
+    )
+
+
+def update_index(package_dir, wheels=None):
+    """
+    Update the simple repository pages of the projects of wheels (of every project when wheels is None).
+
+    Links have a sha256 fragment. Given wheels are hashed (they may have been rebuilt), the hashes of the
+    other wheels are read from the current pages.
+
+    Returns the sha256 of the wheels of the updated projects, by wheel.
+    """
+    available_wheels = {}
+    project_hashes = {}
+    for entry in os.listdir(package_dir):
+        if entry.endswith('.whl'):
+            available_wheels.setdefault(project_name(entry), []).append(entry)
+
+    with open_lock(INDEX_LOCK_PATH, exclusive=True):  # concurrent compilations update the same pages
+        os.makedirs(INDEX_DIRECTORY, exist_ok=True)
+        if wheels is None:
+            projects = set(available_wheels) | set(os.listdir(INDEX_DIRECTORY)) - {'index.html'}
+        else:
+            projects = {project_name(wheel) for wheel in wheels}
+        for project in projects:
+            page_path = os.path.join(INDEX_DIRECTORY, project, 'index.html')
+            if project not in available_wheels:
+                shutil.rmtree(os.path.dirname(page_path), ignore_errors=True)
+                continue
+            hashes = read_index_hashes(page_path)
+            for wheel in wheels or ():
+                hashes.pop(wheel, None)
+            for wheel in sorted(available_wheels[project]):
+                project_hashes[wheel] = hashes.get(wheel) or file_sha256(os.path.join(package_dir, wheel))
+            links = [
+                ('../../../%s#sha256=%s' % (urllib.parse.quote(wheel), project_hashes[wheel]), wheel)
+                for wheel in sorted(available_wheels[project])
+            ]
+            write_text(page_path, html_page(f'Links for {project}', links))
+
+        write_text(
+            os.path.join(INDEX_DIRECTORY, 'index.html'),
+            html_page('Simple index', [(f'{project}/', project) for project in sorted(available_wheels)]),
+        )
+    return project_hashes
+
+
+def release_lock(wheels, hashes):
+    """Return the lock of a release: the name, version, wheel and sha256 of each wheel it uses."""
+    return sorted(
+        (
+            {'name': project_name(wheel), 'version': wheel.split('-')[1], 'wheel': wheel, 'sha256': hashes[wheel]}
+            for wheel in wheels
+        ),
+        key=lambda entry: (entry['name'], entry['wheel']),
+    )
+
+
+@contextlib.contextmanager
+def open_lock(path, exclusive=False):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def volume_lock(exclusive=False):
+    """Lock the wheel volume: compilations share it, garbage collection needs it exclusively."""
+    with open_lock(LOCK_PATH, exclusive):
+        yield
+
+
+def collect_garbage(package_dir, max_age, keep_records=()):
+    """
+    Delete old records (except kept ones), then the wheels which are not used by any remaining record.
+
+    Wheels built less than max_age ago are kept: they may be used by releases compiled before records
+    existed (or by compilations whose records are not written yet).
+    """
+    now = time.time()
+    used_wheels = set()
+    deleted_records = 0
+    os.makedirs(RECORDS_DIRECTORY, exist_ok=True)
+    filenames = os.listdir(RECORDS_DIRECTORY)
+    if not any(filename.endswith('.json') for filename in filenames):
+        info('No record (the volume was filled by an older compiler): nothing deleted.')
+        return
+    for filename in filenames:
+        path = os.path.join(RECORDS_DIRECTORY, filename)
+        identifier, extension = os.path.splitext(filename)
+        if extension != '.json':
+            continue
+        if identifier in keep_records or now - os.path.getmtime(path) <= max_age:
+            try:
+                with open(path) as fp:
+                    used_wheels.update(json.load(fp).get('wheels') or [])
+                continue
+            except ValueError:
+                info('Invalid record %s, deleted', identifier)
+        os.remove(path)
+        deleted_records += 1
+
+    deleted_wheels, freed_size = 0, 0
+    for wheel in os.listdir(package_dir):
+        path = os.path.join(package_dir, wheel)
+        if wheel.endswith('.whl') and wheel not in used_wheels and now - os.path.getmtime(path) > max_age:
+            freed_size += os.path.getsize(path)
+            os.remove(path)
+            deleted_wheels += 1
+
+    update_inventory(package_dir)
+    update_index(package_dir)
+    info(
+        'Deleted %d records and %d wheels (%d bytes), %d wheels are used.',
+        deleted_records, deleted_wheels, freed_size, len(used_wheels),
+    )
+
+
+def compile_releases(venv, releases, records, constraint, jobs=1):
+    try:
+        for release in releases:
+            wheels = build_wheels(venv, release, WHEELS_DIRECTORY, constraint, jobs=jobs)
+            if wheels is None:
+                exit(1)
+            hashes = update_index(WHEELS_DIRECTORY, wheels)
+            if release in records:
+                write_json(
+                    os.path.join(RECORDS_DIRECTORY, records[release] + '.json'),
+                    {'release': release, 'wheels': wheels, 'lock': release_lock(wheels, hashes)},
+                )
+    finally:
+        update_inventory(WHEELS_DIRECTORY)
 
 
 def main():
     parser = arg_parser()
     args = parser.parse_args()
+    if args.record and len(args.record) != len(args.release):
+        parser.error('--record should be given once per release')
+    if not args.release and not args.gc:
+        parser.error('a release is required')
     setup_logging(not args.no_color)
 
+    if args.gc:
+        with volume_lock(exclusive=True):
+            collect_garbage(WHEELS_DIRECTORY, args.max_age, set(args.keep_record))
+        return
+
     venv = setup_venv(args.python)
     setup_pip(venv, WHEELS_DIRECTORY)
 
     constraints = os.environ.get('PIP_CONSTRAINT_CONTENT', base64.b64encode(zlib.compress(b'')))
+    records = dict(zip(args.release, args.record))
     with tempfile.NamedTemporaryFile() as fp:
         fp.write(zlib.decompress(base64.b64decode(constraints)))
         fp.flush()
 
-        for release in args.release:
-            if not build_wheels(venv, release, WHEELS_DIRECTORY, fp.name):
-                exit(1)
+        with volume_lock():
+            compile_releases(venv, args.release, records, fp.name, jobs=args.jobs)
 
 
 if __name__ == '__main__':
@@ -11,4 +11,11 @@ fi
 install -m 0555 -o grocker /tmp/grocker/compile.py /home/grocker/compile.py
 install -m 0777 -o grocker -d /home/grocker/packages
 
+# Bootstrap the compilation venv once for all. It is optional: the pip settings given to Grocker (as a
+# private index) are only used by compilations, which repair (or create) the venv when needed.
+if ! su -c "${GROCKER_RUNTIME} -m venv /home/grocker/compiler.venv || ${GROCKER_RUNTIME} -m virtualenv /home/grocker/compiler.venv" grocker; then
+    rm -rf /home/grocker/compiler.venv
+fi
+su -c "/home/grocker/compiler.venv/bin/pip install --no-cache-dir -U pip setuptools wheel" grocker || true
+
 rm -r $(dirname $0)
@@ -3,39 +3,58 @@ set -xe
 
 GROCKER_USER=grocker
 WORKING_DIR=$(dirname $0)
+VENV=/home/${GROCKER_USER}/app.venv
+WHEEL_SERVER_HOST=grocker-wheels  # resolved to the wheel server container by the build
 
-setup_venv() {  # venv runtime *dependencies
-    local venv runtime release constraint_arg wheelhouse pip
-    venv=$1
-    runtime=$2
-    shift 2
-    release="$*"
+wheelhouse_args() {
+    if [ -d ${WORKING_DIR}/wheels ]; then
+        echo "--no-index --find-links=${WORKING_DIR}/wheels"
+    else
+        # Simple repository (with hashes) maintained by the compiler in the wheel volume
+        echo "--index-url=http://${WHEEL_SERVER_HOST}/.grocker/simple/ --trusted-host=${WHEEL_SERVER_HOST}"
+    fi
+}
+
+pip_install() {  # *requirements
+    local constraint_arg
     if [ -f ${WORKING_DIR}/constraints.txt ]; then
         constraint_arg="--constraint ${WORKING_DIR}/constraints.txt"
     else
         constraint_arg=""
     fi
-    wheelhouse=http://${GROCKER_WHEEL_SERVER_IP:=should-be-defined}/
 
-    pip=${venv}/bin/pip
+    ${VENV}/bin/pip install --no-cache-dir $(wheelhouse_args) ${constraint_arg} "$@" --no-compile
+}
+
+pip_install_lock() {  # lock: requirements pinned to the wheels (and hashes) resolved by the compiler
+    ${VENV}/bin/pip install --no-cache-dir $(wheelhouse_args) --no-deps --require-hashes --requirement "$1" --no-compile
+}
 
-    ${runtime} -m venv ${venv} || ${runtime} -m virtualenv -p ${runtime} ${venv}
+setup_venv() {  # runtime
+    local runtime constraint_arg
+    runtime=$1
+    if [ -f ${WORKING_DIR}/constraints.txt ]; then
+        constraint_arg="--constraint ${WORKING_DIR}/constraints.txt"
+    else
+        constraint_arg=""
+    fi
+
+    ${runtime} -m venv ${VENV} || ${runtime} -m virtualenv -p ${runtime} ${VENV}
     # Old pip can not deal with constraint file
-    ${pip} install --upgrade pip
-    ${pip} install --no-cache-dir --upgrade pip setuptools ${constraint_arg}
-    ${pip} install --no-cache-dir --find-links=${wheelhouse} --trusted-host=${GROCKER_WHEEL_SERVER_IP} --no-index ${constraint_arg} ${release} --no-compile
+    ${VENV}/bin/pip install --upgrade pip
+    ${VENV}/bin/pip install --no-cache-dir --upgrade pip setuptools ${constraint_arg}
 }
 
 
-run_as_user() {  # script_or_function
-    local script_or_function
-    script_or_function="$*"
+run_as_user() {  # step
+    local step
+    step=$1
     if [ "$(whoami)" = ${GROCKER_USER} ]; then
-        ${script_or_function}
+        provision_${step}
     else
         chmod -R go+rX ${WORKING_DIR}  # Allow non-root user to use file in grocker temporary directory
         sync  # sync before running script to avoid "unable to execute /tmp/grocker/provision.sh: Text file busy"
-        HOME=/home/${GROCKER_USER} su -c $0 ${GROCKER_USER}  # Run this script as grocker user
+        HOME=/home/${GROCKER_USER} su -c "$0 ${step}" ${GROCKER_USER}  # Run this script as grocker user
         rm -r ${WORKING_DIR}  # clean up
     fi
 }
@@ -50,10 +69,24 @@ only_run_as_root() {  # script_or_function
 }
 
 
-provision() {
-    setup_venv ~/app.venv \
-        ${GROCKER_RUNTIME:=should-be-defined} \
-        "${GROCKER_APP:=should-be-defined}[${GROCKER_APP_EXTRAS}]==${GROCKER_APP_VERSION:=should-be-defined}"
+provision_dependencies() {
+    setup_venv ${GROCKER_RUNTIME:=should-be-defined}
+    if [ -f ${WORKING_DIR}/requirements.lock ]; then
+        pip_install_lock ${WORKING_DIR}/requirements.lock
+    else
+        pip_install --requirement ${WORKING_DIR}/requirements.txt
+    fi
+}
+
+provision_app() {
+    if [ ! -d ${VENV} ]; then
+        setup_venv ${GROCKER_RUNTIME:=should-be-defined}
+    fi
+    if [ -f ${WORKING_DIR}/requirements.lock ]; then
+        pip_install_lock ${WORKING_DIR}/requirements.lock
+    else
+        pip_install "${GROCKER_APP:=should-be-defined}[${GROCKER_APP_EXTRAS}]==${GROCKER_APP_VERSION:=should-be-defined}"
+    fi
 }
 
 debian_up() {
@@ -75,5 +108,12 @@ system_provision() {
     fi
 }
 
-only_run_as_root system_provision
-run_as_user provision
+case "${1:-app}" in
+    dependencies)  # Third-party dependencies only, in their own (cached) layer
+        run_as_user dependencies
+        ;;
+    *)  # Security updates and application
+        only_run_as_root system_provision
+        run_as_user app
+        ;;
+esac
@@ -0,0 +1,20 @@
+#!/bin/sh
+# Run nginx until it did not serve any wheel for IDLE_TIMEOUT seconds (a SIGUSR1 counts as a request).
+set -e
+
+last_use=$(date +%s)
+trap 'last_use=$(date +%s)' USR1
+trap 'nginx -s quit; exit 0' TERM INT
+
+nginx  # runs in the background: nginx.conf does not disable daemon mode
+
+while sleep 5; do
+    log_time=$(stat -c %Y /var/log/nginx/wheels.log 2>/dev/null || echo 0)
+    if [ "$log_time" -gt "$last_use" ]; then
+        last_use=$log_time
+    fi
+    if [ $(($(date +%s) - last_use)) -ge "$IDLE_TIMEOUT" ]; then
+        nginx -s quit
+        exit 0
+    fi
+done
@@ -0,0 +1,440 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import collections
+import concurrent.futures
+import functools
+import logging
+import os.path
+
+from . import builders
+from . import events
+from . import helpers
+from . import profiling
+from . import registry
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+BUILD_OPTIONS = (
+    'config',
+    'runtime',
+    'entrypoint',
+    'pip_constraint',
+    'image_prefix',
+    'image_base_name',
+    'image_name',
+    'volume',
+    'port',
+    'env',
+    'runner_wheels',
+    'extra_tag',
+)
+ALL_RUNTIMES = 'all'
+
+
+class BuildJob:
+    """A release to build with its own config, and the information collected while building it."""
+
+    def __init__(self, release, config, image_name=None, extra_tags=(), tag_suffix='', requirement=None):
+        self.release = release
+        self.requirement = requirement or utils.GrockerRequirement.parse(release)
+        self.config = config
+        self.image_name = _add_tag_suffix(image_name or utils.default_image_name(config, self.requirement), tag_suffix)
+        self.extra_images = [self._extra_image_name(tag, tag_suffix) for tag in extra_tags]
+        self.collect = {'release': release, 'runtime': config['runtime'], 'image': self.image_name}
+        if self.extra_images:
+            self.collect['extra_images'] = self.extra_images
+        self.error = None
+
+    def _extra_image_name(self, tag, tag_suffix=''):
+        # A full image name, or a tag of the image repository
+        if '/' in tag or ':' in tag:
+            return _add_tag_suffix(tag, tag_suffix)
+        repository, _ = registry.split_image_name(self.image_name)
+        return '%s:%s%s' % (repository, tag, tag_suffix)
+
+    @classmethod
+    def from_options(cls, release, options):
+        """
+        Create a job from build options.
+
+        Args:
+            release (str): the release to build
+            options (dict): build options, keys are the ``BUILD_OPTIONS`` (named as the command line options)
+
+        """
+        if not isinstance(options.get('runtime'), (str, type(None))):
+            raise ValueError('A single runtime is expected, got %r' % (options['runtime'],))
+        config = _parse_options_config(options)
+        warn_deprecated_runtime(config)
+        return cls(release, config, image_name=options.get('image_name'), extra_tags=_get_extra_tags(options))
+
+    @classmethod
+    def matrix(cls, release, options):
+        """
+        Create a job per runtime of the ``runtime`` option: a runtime, a list of runtimes or ``all``.
+
+        The config is parsed once, then each job gets its runtime (so its own Grocker images and wheel
+        volume). When several runtimes are built, runner image tags get the runtime as suffix, e.g.
+        ``project:1.0-bookworm-3.12``.
+
+        Args:
+            release (str): the release to build
+            options (dict): build options (see ``from_options``)
+
+        Returns:
+            list: BuildJob list
+
+        """
+        runtimes = options.get('runtime') or [None]
+        if isinstance(runtimes, str):
+            runtimes = [runtimes]
+        runtimes = list(dict.fromkeys(runtimes))  # without duplicates, in order
+        if len(runtimes) == 1 and runtimes[0] != ALL_RUNTIMES:
+            return [cls.from_options(release, dict(options, runtime=runtimes[0]))]
+
+        base_config = _parse_options_config(dict(options, runtime=None))
+        if ALL_RUNTIMES in runtimes:
+            runtimes = list(base_config['runtimes'])
+        requirement = utils.GrockerRequirement.parse(release)
+        jobs = []
+        for runtime in runtimes:
+            config = base_config.replace(runtime=runtime)
+            warn_deprecated_runtime(config)
+            jobs.append(cls(
+                release,
+                config,
+                image_name=options.get('image_name'),
+                extra_tags=_get_extra_tags(options),
+                tag_suffix='-' + runtime.replace('/', '-'),
+                requirement=requirement,
+            ))
+        return jobs
+
+
+def _parse_options_config(options):
+    envs = options.get('env') or {}
+    if not isinstance(envs, dict):
+        envs = dict(item.split('=', 1) for item in envs)
+
+    return utils.Config.parse(
+        options.get('config') or [],
+        runtime=options.get('runtime'),
+        entrypoint_name=options.get('entrypoint'),
+        pip_constraint=options.get('pip_constraint'),
+        docker_image_prefix=options.get('image_prefix'),
+        image_base_name=options.get('image_base_name'),
+        volumes=options.get('volume'),
+        ports=options.get('port'),
+        envs=envs,
+        runner_wheels=options.get('runner_wheels'),
+    )
+
+
+def _get_extra_tags(options):
+    extra_tags = options.get('extra_tag') or []
+    if isinstance(extra_tags, str):
+        extra_tags = [extra_tags]
+    return extra_tags
+
+
+def _add_tag_suffix(image_name, tag_suffix):
+    if not tag_suffix:
+        return image_name
+    repository, tag = registry.split_image_name(image_name)
+    return '%s:%s%s' % (repository, tag, tag_suffix)
+
+
+def warn_deprecated_runtime(config):
+    if config['runtimes'][config['runtime']].get('deprecated'):
+        logger.warning(
+            "Runtime %s is deprecated, please update to more recent runtime",
+            config['runtime'],
+        )
+
+
+def load_manifest(manifest_path, defaults):
+    """
+    Create build jobs from a manifest file.
+
+    The manifest is a YAML file with a ``builds`` list. Each item has a mandatory ``release`` key and may
+    override any of the ``BUILD_OPTIONS`` given on the command line. Relative paths are relative to the
+    manifest directory.
+
+    Args:
+        manifest_path (str): path of the manifest file
+        defaults (dict): build options used when a build does not define them
+
+    Returns:
+        list: BuildJob list
+
+    """
+    manifest = helpers.load_yaml(manifest_path) or {}
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+
+    def relative_to_manifest(path):
+        return os.path.join(base_dir, os.path.expanduser(path))
+
+    jobs = []
+    for entry in manifest.get('builds') or []:
+        entry = dict(entry)
+        release = entry.pop('release', None)
+        if not release:
+            raise ValueError('Invalid manifest %s: a release is mandatory for each build' % manifest_path)
+        unknown_options = set(entry) - set(BUILD_OPTIONS)
+        if unknown_options:
+            raise ValueError('Invalid manifest %s: unknown options %s' % (manifest_path, sorted(unknown_options)))
+
+        if isinstance(entry.get('config'), str):
+            entry['config'] = [entry['config']]
+        if entry.get('config'):
+            entry['config'] = [relative_to_manifest(path) for path in entry['config']]
+        if entry.get('pip_constraint'):
+            entry['pip_constraint'] = relative_to_manifest(entry['pip_constraint'])
+        if os.path.sep in release:
+            release = relative_to_manifest(release)
+
+        options = dict(defaults)
+        options.update(entry)
+        jobs.extend(BuildJob.matrix(release, options))
+
+    if not jobs:
+        raise ValueError('Invalid manifest %s: no build defined' % manifest_path)
+    return jobs
+
+
+def group_jobs(jobs):
+    """Group jobs sharing the same wheel volume (i.e. the same runtime and config identifier)."""
+    groups = collections.OrderedDict()
+    for job in jobs:
+        key = (job.config['runtime'], utils.config_identifier(job.config))
+        groups.setdefault(key, []).append(job)
+    return list(groups.values())
+
+
+def compile_group(docker_client, images, jobs, pip_conf, reuse_wheels=True, compile_jobs=1):
+    """Compile wheels of every job of a group, using a single compiler run per pip constraint file."""
+    config = jobs[0].config
+    logger.info('Compiling dependencies for %s...', ', '.join(job.release for job in jobs))
+    compiler = images.get(config, 'compiler')
+
+    by_constraint = collections.OrderedDict()
+    for job in jobs:
+        job.collect['compiler_image'] = compiler.tags[0]
+        by_constraint.setdefault(job.config['pip_constraint'], []).append(job)
+
+    for constrained_jobs in by_constraint.values():
+        releases = [job.release for job in constrained_jobs]
+        with profiling.phase('compile wheels', releases=releases):
+            builders.compile_wheels(
+                docker_client=docker_client,
+                config=constrained_jobs[0].config,
+                requirements=[job.requirement for job in constrained_jobs],
+                pip_conf=pip_conf,
+                reuse_wheels=reuse_wheels,
+                jobs=compile_jobs,
+            )
+
+
+def build_job(docker_client, images, job, build_image, push):
+    """Build then push the runner image of a job."""
+    if build_image:
+        logger.info('Building image %s...', job.image_name)
+        root_image = images.get(job.config, 'root')
+        job.collect['root_image'] = root_image.tags[0]
+        if job.config['runner_wheels'] != 'context':
+            images.get(job.config, 'wheel-server')
+        with profiling.phase('build runner image', image=job.image_name):
+            job.collect['lock'] = builders.build_runner_image(
+                docker_client=docker_client,
+                config=job.config,
+                name=job.image_name,
+                requirement=job.requirement,
+            )
+
+    if push:
+        if not builders.is_prefixed_image(job.image_name):
+            logger.warning('Not pushing any image since the registry is unclear in %s', job.image_name)
+        else:
+            with profiling.phase('push', image=job.image_name):
+                digest = builders.docker_publish_image(docker_client, job.image_name, job.extra_images)
+            if job.config['manifest']:
+                with profiling.phase('manifest digest', image=job.image_name):
+                    job.collect['hash'] = digest or builders.get_manifest_digest(job.image_name) or [
+                        x.split('@')[1] for x in docker_client.images.get(job.image_name).attrs['RepoDigests']
+                    ][0]
+            else:
+                job.collect['hash'] = None
+
+
+def get_image_roles(config, build_dependencies=True, build_image=True):
+    """Return the Grocker images needed by a build."""
+    roles = []
+    if build_dependencies or build_image:
+        roles.append('root')
+    if build_dependencies:
+        roles.append('compiler')
+    if build_image and config['runner_wheels'] != 'context':
+        roles.append('wheel-server')
+    return roles
+
+
+IMAGE_ACTIONS = {'local': 'use', 'registry': 'pull', None: 'build'}
+
+
+def plan(docker_client, jobs, build_dependencies=True, build_image=True, push=True, workers=1):
+    """
+    Report what building jobs would do, without doing it.
+
+    Grocker images are looked up like builds do (locally, then in the registry), as well as runner images
+    and wheel volumes (compilations reuse the wheels of existing volumes).
+
+    Args:
+        docker_client (docker.DockerClient): a docker client
+        jobs (list): BuildJob list
+        build_dependencies (bool): whether the dependencies would be compiled
+        build_image (bool): whether the runner images would be built
+        push (bool): whether the runner images would be pushed
+        workers (int): maximum number of concurrent lookups
+
+    Returns:
+        dict: plan of each build, the images to pull, build and push, and whether some Grocker image
+        or wheel volume is missing (``cold``)
+
+    """
+    job_images = [
+        {
+            role: builders.image_name(job.config, role)
+            for role in get_image_roles(job.config, build_dependencies, build_image)
+        }
+        for job in jobs
+    ]
+    names = sorted({name for images in job_images for name in images.values()} | {job.image_name for job in jobs})
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        sources = dict(zip(names, executor.map(functools.partial(builders.docker_find_image, docker_client), names)))
+
+    builds = []
+    actions = collections.defaultdict(set)
+    for job, images in zip(jobs, job_images):
+        build = {'release': job.release, 'runtime': job.config['runtime'], 'images': {}}
+        for role, name in images.items():
+            action = IMAGE_ACTIONS[sources[name]]
+            build['images'][role] = {'image': name, 'source': sources[name], 'action': action}
+            actions[action].add(name)
+            if action == 'build' and builders.is_prefixed_image(name):
+                actions['push'].add(name)
+
+        if build_dependencies:
+            volume_name = builders.wheel_volume_name(job.config)
+            volumes = docker_client.volumes.list(filters={'name': volume_name})
+            build['wheel_volume'] = {'name': volume_name, 'exists': any(v.name == volume_name for v in volumes)}
+
+        runner_actions = []
+        if build_image:
+            runner_actions.append('build')
+        if push and builders.is_prefixed_image(job.image_name):
+            runner_actions.append('push')
+        build['runner'] = {'image': job.image_name, 'source': sources[job.image_name], 'actions': runner_actions}
+        for action in runner_actions:
+            actions[action].update([job.image_name] + (job.extra_images if action == 'push' else []))
+        builds.append(build)
+
+    return {
+        'builds': builds,
+        'pull': sorted(actions['pull']),
+        'build': sorted(actions['build']),
+        'push': sorted(actions['push']),
+        'cold': any(
+            image['action'] == 'build' for build in builds for image in build['images'].values()
+        ) or not all(build.get('wheel_volume', {}).get('exists', True) for build in builds),
+    }
+
+
+def _run_step(jobs, function, *args):
+    with events.recording() as recorder:
+        try:
+            function(*args)
+        except Exception as e:
+            logger.error('Build of %s failed: %s', ', '.join(job.release for job in jobs), e)
+            for job in jobs:
+                job.error = e
+                job.collect['error'] = str(e)
+
+    for job in jobs:
+        steps = job.collect.setdefault('steps', [])
+        steps.extend(step for step in recorder.step_durations() if step not in steps)  # as shared image builds
+
+
+def run_job(
+    docker_client, images, job, pip_conf, build_dependencies=True, build_image=True, push=True, reuse_wheels=True,
+    compile_jobs=1,
+):
+    """
+    Build a job in the current thread (its compilation and runner image build events are emitted in it).
+
+    Args:
+        docker_client (docker.DockerClient): a docker client
+        images (grocker.builders.ImagePrefetcher): Grocker image lookups, shared with other jobs
+        job (BuildJob): the job
+        pip_conf (str): pip configuration file used to download dependencies
+
+    Other arguments are the ``run`` ones.
+
+    Returns:
+        bool: whether the build succeeded
+
+    """
+    images.prefetch(job.config, get_image_roles(job.config, build_dependencies, build_image))
+    if build_dependencies:
+        _run_step([job], compile_group, docker_client, images, [job], pip_conf, reuse_wheels, compile_jobs)
+    if job.error is None and (build_image or push):
+        _run_step([job], build_job, docker_client, images, job, build_image, push)
+    return job.error is None
+
+
+def run(
+    docker_client, jobs, pip_conf, build_dependencies=True, build_image=True, push=True, workers=1, reuse_wheels=True,
+    compile_jobs=1,
+):
+    """
+    Build jobs using a bounded pool of workers.
+
+    Wheels are compiled once per group of jobs sharing a wheel volume, then runner images are built
+    and pushed concurrently.
+
+    Args:
+        docker_client (docker.DockerClient): a docker client
+        jobs (list): BuildJob list
+        pip_conf (str): pip configuration file used to download dependencies
+        build_dependencies (bool): whether the dependencies are compiled
+        build_image (bool): whether the runner images are built
+        push (bool): whether the runner images are pushed
+        workers (int): maximum number of concurrent steps
+        reuse_wheels (bool): whether compilation is skipped when wheels compiled for a release are still available
+        compile_jobs (int): number of wheels built in parallel by each compilation (0 for every available CPU)
+
+    Returns:
+        list: failed jobs
+
+    """
+    images = builders.ImagePrefetcher(docker_client, max_workers=workers)
+    with images, concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        # Images are looked up (pulled or built) in the background, while the first steps wait for theirs.
+        for job in jobs:
+            images.prefetch(job.config, get_image_roles(job.config, build_dependencies, build_image))
+
+        if build_dependencies:
+            compile_step = functools.partial(compile_group, reuse_wheels=reuse_wheels, compile_jobs=compile_jobs)
+            concurrent.futures.wait([
+                executor.submit(_run_step, group, compile_step, docker_client, images, group, pip_conf)
+                for group in group_jobs(jobs)
+            ])
+
+        if build_image or push:
+            concurrent.futures.wait([
+                executor.submit(_run_step, [job], build_job, docker_client, images, job, build_image, push)
+                for job in jobs
+                if job.error is None
+            ])
+
+    return [job for job in jobs if job.error is not None]
@@ -0,0 +1,349 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import collections
+import http.server
+import itertools
+import json
+import logging
+import os
+import re
+import socketserver
+import threading
+import time
+
+from . import __version__
+from . import builders
+from . import events
+from . import scheduler
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+# Build settings which are not build options (see scheduler.BUILD_OPTIONS), with their default
+JOB_SETTINGS = {
+    'build_dependencies': True,
+    'build_image': True,
+    'push': True,
+    'reuse_wheels': True,
+    'compile_jobs': 1,
+}
+MAX_FINISHED_JOBS = 1000
+
+
+class ServerJob:
+    """A build job submitted to the server, with the events emitted while building it."""
+
+    def __init__(self, job_id, build_job, settings):
+        self.id = job_id
+        self.build_job = build_job
+        self.settings = settings
+        # Jobs sharing a config share a wheel volume
+        self.key = (build_job.config['runtime'], utils.config_identifier(build_job.config))
+        self.status = 'queued'
+        self.times = {'queued': time.time()}
+        self.error = None
+        self.events = []
+        self._condition = threading.Condition()
+
+    def add(self, event):
+        """Record an event (the job is an events recorder)."""
+        with self._condition:
+            self.events.append(event.to_dict())
+            self._condition.notify_all()
+
+    def set_status(self, status):
+        with self._condition:
+            self.status = status
+            self.times[status] = time.time()
+            self._condition.notify_all()
+
+    @property
+    def finished(self):
+        return self.status in ('succeeded', 'failed')
+
+    def cancel(self, error):
+        """Fail the job without running it."""
+        self.error = error
+        self.add(events.ErrorEvent(self.build_job.release, error))
+        self.set_status('failed')
+
+    def follow(self, timeout=None):
+        """Yield the recorded events, then the new ones until the job is finished."""
+        def has_news(position):
+            return lambda: len(self.events) > position or self.finished
+
+        position = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(has_news(position), timeout=timeout)
+                new_events = self.events[position:]
+                finished = self.finished
+            position += len(new_events)
+            yield from new_events
+            if finished and not new_events:
+                return
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'release': self.build_job.release,
+            'runtime': self.build_job.config['runtime'],
+            'times': dict(self.times),
+            'error': self.error,
+            'result': self.build_job.collect,
+        }
+
+
+class JobQueue:
+    """
+    Run jobs with a bounded number of workers, in submission order.
+
+    At most ``per_config`` jobs sharing a config run at once: a job waits (without blocking the jobs
+    submitted after it) while enough jobs sharing its config are running.
+    """
+
+    def __init__(self, run, workers=4, per_config=1):
+        self._run = run
+        self.per_config = per_config
+        self.jobs = collections.OrderedDict()
+        self._pending = collections.deque()
+        self._running = collections.Counter()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._work, name='grocker-worker-%d' % i, daemon=True) for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, job):
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('The job queue is closed')
+            self.jobs[job.id] = job
+            self._pending.append(job)
+            self._forget_finished_jobs()
+            self._condition.notify_all()
+
+    def close(self, wait=True, cancel=False):
+        """Stop the workers once they have run the pending jobs (or once the running ones are finished, cancelling
+        the pending ones)."""
+        with self._condition:
+            self._closed = True
+            cancelled_jobs = list(self._pending) if cancel else []
+            for job in cancelled_jobs:
+                self._pending.remove(job)
+            self._condition.notify_all()
+        for job in cancelled_jobs:
+            job.cancel('Cancelled: the server stopped')
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _forget_finished_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self.jobs[job_id]
+
+    def _next(self):
+        with self._condition:
+            while True:
+                for job in self._pending:
+                    if self._running[job.key] < self.per_config:
+                        self._pending.remove(job)
+                        self._running[job.key] += 1
+                        return job
+                if self._closed and not self._pending:
+                    return None
+                self._condition.wait()
+
+    def _work(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            try:
+                self._run(job)
+            except Exception:  # the worker must survive
+                logger.exception('Job %s crashed', job.id)
+                job.set_status('failed')
+            finally:
+                with self._condition:
+                    self._running[job.key] -= 1
+                    self._condition.notify_all()
+
+
+class BuildServer:
+    """
+    Build jobs submitted to a long-running process.
+
+    The Docker client, the parsed default config and the Grocker image lookups are kept from one
+    job to the next.
+
+    Args:
+        docker_client (docker.DockerClient): a docker client
+        pip_conf (str): pip configuration file used to download dependencies
+        workers (int): maximum number of concurrent jobs
+        per_config (int): maximum number of concurrent jobs sharing a config (and a wheel volume)
+    """
+
+    def __init__(self, docker_client, pip_conf=None, workers=4, per_config=1):
+        self.docker_client = docker_client
+        self.pip_conf = pip_conf
+        self.images = builders.ImagePrefetcher(docker_client, max_workers=workers)
+        self.queue = JobQueue(self._run, workers=workers, per_config=per_config)
+        self._ids = itertools.count(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.queue.close(wait=exc_info[0] is None, cancel=True)
+        self.images.__exit__(*exc_info)
+
+    def submit(self, request):
+        """
+        Queue a build.
+
+        Args:
+            request (dict): ``release``, build options (see scheduler.BUILD_OPTIONS) and settings (see
+                JOB_SETTINGS)
+
+        Returns:
+            ServerJob: the queued job
+
+        """
+        if not isinstance(request, dict) or not request.get('release'):
+            raise ValueError('A release is mandatory')
+        unknown_keys = set(request) - {'release'} - set(scheduler.BUILD_OPTIONS) - set(JOB_SETTINGS)
+        if unknown_keys:
+            raise ValueError('Unknown options: %s' % ', '.join(sorted(unknown_keys)))
+
+        options = {name: request.get(name) for name in scheduler.BUILD_OPTIONS}
+        settings = {name: request.get(name, default) for name, default in JOB_SETTINGS.items()}
+        job = ServerJob('%d' % next(self._ids), scheduler.BuildJob.from_options(request['release'], options), settings)
+        self.queue.submit(job)
+        logger.info('Job %s queued: %s', job.id, job.build_job.release)
+        return job
+
+    def _run(self, job):
+        job.set_status('running')
+        with events.recording(job):
+            success = scheduler.run_job(self.docker_client, self.images, job.build_job, self.pip_conf, **job.settings)
+        job.set_status('succeeded' if success else 'failed')
+        logger.info('Job %s %s', job.id, job.status)
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    HTTP API of a BuildServer.
+
+    - ``POST /jobs``: queue a build (a JSON object, see BuildServer.submit), answer the job
+    - ``GET /jobs``: list the jobs
+    - ``GET /jobs/<id>``: get a job, with its result once finished
+    - ``GET /jobs/<id>/events``: stream the job events (NDJSON) until it is finished, then its result
+    """
+
+    server_version = 'Grocker/' + __version__
+    routes = [
+        ('GET', re.compile(r'^/jobs/?$'), 'list_jobs'),
+        ('POST', re.compile(r'^/jobs/?$'), 'submit_job'),
+        ('GET', re.compile(r'^/jobs/(?P<job_id>\w+)$'), 'get_job'),
+        ('GET', re.compile(r'^/jobs/(?P<job_id>\w+)/events$'), 'stream_events'),
+    ]
+
+    def do_GET(self):  # noqa: N802
+        self.dispatch()
+
+    def do_POST(self):  # noqa: N802
+        self.dispatch()
+
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix socket'
+
+    def log_message(self, format, *args):  # noqa: A002
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+    def dispatch(self):
+        path = self.path.split('?', 1)[0]
+        for method, path_re, handler in self.routes:
+            match = path_re.match(path)
+            if match and method == self.command:
+                return getattr(self, handler)(**match.groupdict())
+        return self.send_json(404, {'error': 'Not found'})
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8') + b'\n'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_server_job(self, job_id):
+        job = self.server.build_server.queue.jobs.get(job_id)
+        if job is None:
+            self.send_json(404, {'error': 'Unknown job %s' % job_id})
+        return job
+
+    def list_jobs(self):
+        jobs = list(self.server.build_server.queue.jobs.values())
+        self.send_json(200, {'jobs': [job.to_dict() for job in jobs]})
+
+    def submit_job(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'null')
+            job = self.server.build_server.submit(request)
+        except (ValueError, RuntimeError) as e:  # invalid JSON, request or config
+            return self.send_json(400, {'error': str(e)})
+        return self.send_json(202, job.to_dict())
+
+    def get_job(self, job_id):
+        job = self.get_server_job(job_id)
+        if job is not None:
+            self.send_json(200, job.to_dict())
+
+    def stream_events(self, job_id):
+        job = self.get_server_job(job_id)
+        if job is None:
+            return
+        # HTTP/1.0: the stream ends when the connection is closed
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        try:
+            for event in job.follow():
+                self.wfile.write(json.dumps(event).encode('utf-8') + b'\n')
+                self.wfile.flush()
+            self.wfile.write(json.dumps(dict(job.to_dict(), event='result')).encode('utf-8') + b'\n')
+        except (BrokenPipeError, ConnectionResetError):
+            logger.debug('Client stopped following job %s', job.id)
+
+
+class ThreadingHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_http_server(build_server, address=None, socket_path=None):
+    """
+    Return an HTTP server for a BuildServer.
+
+    Args:
+        build_server (BuildServer): the build server
+        address (tuple): host and port to listen on
+        socket_path (str): unix socket to listen on, instead of a TCP port
+
+    """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)  # left by a previous server
+        http_server = ThreadingUnixHTTPServer(socket_path, RequestHandler)
+    else:
+        http_server = ThreadingHTTPServer(address, RequestHandler)
+    http_server.build_server = build_server
+    return http_server
@@ -0,0 +1,135 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+
+
+def state_path(name='volumes'):
+    """Return the path of the file where wheel volume (or record) last uses are recorded (on the Docker client host)."""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'grocker', name + '.json')
+
+
+def _load(path):
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logger.warning('Invalid usage file %s, ignored', path)
+        return {}
+
+
+def load_volume_uses(path=None):
+    """
+    Return when wheel volumes were last used.
+
+    Returns:
+        dict: timestamps by volume name
+
+    """
+    return _load(path or state_path())
+
+
+def load_record_uses(volume_name, path=None):
+    """
+    Return when the records of a wheel volume were last used (compiled, or used to build a runner image).
+
+    Returns:
+        dict: timestamps by record identifier
+
+    """
+    return _load(path or state_path('records')).get(volume_name, {})
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """Lock path against updates from other processes (as concurrent Grocker builds on the same host)."""
+    with open(path + '.lock', 'a') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def volume_lock(name, exclusive=False):
+    """
+    Lock a wheel volume against the Grocker processes of this host: builds reading its wheels share the
+    lock, garbage collection needs it exclusively.
+
+    Args:
+        name (str): wheel volume name
+        exclusive (bool): whether the lock is exclusive
+
+    """
+    path = os.path.join(os.path.dirname(state_path()), 'locks', name + '.lock')
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fp = open(path, 'a')
+    except OSError as e:  # as usage, never fail a build because of it
+        logger.warning('Unable to lock volume %s: %s', name, e)
+        yield
+        return
+    with fp:
+        fcntl.flock(fp, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def _update(update, path=None):
+    path = path or state_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with _lock, _file_lock(path):
+        uses = _load(path)
+        update(uses)
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as fp:
+            json.dump(uses, fp, indent=2, sort_keys=True)
+        os.replace(fp.name, path)
+
+
+def record_volume_use(name, timestamp=None, path=None):
+    """Record that a wheel volume is used now (or at timestamp)."""
+    try:
+        _update(lambda uses: uses.__setitem__(name, timestamp or time.time()), path)
+    except OSError as e:  # usage is only needed to evict volumes, never fail a build because of it
+        logger.warning('Unable to record volume %s usage: %s', name, e)
+
+
+def record_records_use(volume_name, identifiers, timestamp=None, path=None):
+    """Record that records of a wheel volume are used now (or at timestamp)."""
+    def update(uses):
+        uses.setdefault(volume_name, {}).update(dict.fromkeys(identifiers, timestamp or time.time()))
+
+    try:
+        _update(update, path or state_path('records'))
+    except OSError as e:
+        logger.warning('Unable to record volume %s usage: %s', volume_name, e)
+
+
+def forget_volumes(names, path=None, records_path=None):
+    """Forget the usage of (deleted) volumes, and of their records."""
+    def update(uses):
+        for name in names:
+            uses.pop(name, None)
+
+    try:
+        _update(update, path)
+        _update(update, records_path or state_path('records'))
+    except OSError as e:  # forgotten usages only take some space
+        logger.warning('Unable to forget volumes usage: %s', e)
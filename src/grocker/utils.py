@@ -1,7 +1,11 @@
 # Copyright (c) Polyconseil SAS. All rights reserved.
 
+import collections.abc
+import copy
+import functools
 import hashlib
 import os.path
+import types
 
 import docker
 import packaging.utils
@@ -13,6 +17,10 @@ GROUP_SEPARATOR = b'\x1D'
 RECORD_SEPARATOR = b'\x1E'
 UNIT_SEPARATOR = b'\x1F'
 
+# Where the runner image build gets its wheels: from a wheel server container (started for the build or
+# shared by the builds using the same wheel volume) or from the build context.
+RUNNER_WHEELS_SOURCES = ('server', 'shared-server', 'context')
+
 
 def config_identifier(config):
     """
@@ -25,6 +33,12 @@ def config_identifier(config):
         str: Config identifier (SHA 256)
 
     """
+    if isinstance(config, Config):
+        return config.identifier
+    return _hash_config(config)
+
+
+def _hash_config(config):
     def unit_list(list_item):
         return UNIT_SEPARATOR.join(sorted(x.encode('utf-8') for x in list_item))
 
@@ -78,19 +92,24 @@ def get_dependencies(config, with_build_dependencies=False):
     runtime_dependencies = config['runtimes'][runtime]['dependencies']
 
     dependencies = (
-        runtime_dependencies.get('run', [])
-        + config['dependencies'].get('run', [])
+        list(runtime_dependencies.get('run', []))
+        + list(config['dependencies'].get('run', []))
     )
 
     if with_build_dependencies:
         dependencies += (
-            runtime_dependencies.get('build', [])
-            + config['dependencies'].get('build', [])
+            list(runtime_dependencies.get('build', []))
+            + list(config['dependencies'].get('build', []))
         )
 
     return dependencies
 
 
+@functools.lru_cache(maxsize=None)
+def _default_config():
+    return helpers.load_yaml_resource('grocker.resources', 'grocker.yaml')
+
+
 def parse_config(config_paths, **kwargs):
     """
     Generate config regarding precedence order.
@@ -101,7 +120,7 @@ def parse_config(config_paths, **kwargs):
     2. project ``.grocker.yml`` file (or the one specified on the command line)
     3. the grocker ``resources/grocker.yaml`` file
     """
-    config = helpers.load_yaml_resource('grocker.resources', 'grocker.yaml')
+    config = copy.deepcopy(_default_config())
 
     if not config_paths and os.path.exists('.grocker.yml'):
         config_paths = ['.grocker.yml']
@@ -113,6 +132,109 @@ def parse_config(config_paths, **kwargs):
     return helpers.deep_update(config, {k: v for k, v in kwargs.items() if v})
 
 
+def _freeze(value):
+    if isinstance(value, collections.abc.Mapping):
+        return types.MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _check_type(name, value, expected_types, expected):
+    if not isinstance(value, expected_types):
+        raise ValueError('Invalid config: %s should be %s (got %r)' % (name, expected, value))
+
+
+def _check_string_list(name, value):
+    _check_type(name, value, (list, tuple), 'a list')
+    for item in value:
+        _check_type(name, item, (str, int), 'a list of strings')
+
+
+class Config(collections.abc.Mapping):
+    """
+    Validated and frozen Grocker config.
+
+    The config identifier is computed once, as the config can not change: nested mappings are
+    read-only and lists are tuples.
+
+    Raises:
+        RuntimeError: when the runtime is unknown
+        ValueError: when a config value is invalid
+    """
+
+    def __init__(self, data):
+        self._data = _freeze(data)
+        self._validate()
+        self.identifier = _hash_config(self)
+
+    @classmethod
+    def parse(cls, config_paths, **kwargs):
+        """Parse config files (see ``parse_config``) and return a validated Config."""
+        return cls(parse_config(config_paths, **kwargs))
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '<Config %s %s>' % (self._data.get('runtime'), self.identifier[:12])
+
+    def replace(self, **kwargs):
+        """Return a new Config with some (top level) values replaced."""
+        data = dict(self._data)
+        data.update(kwargs)
+        return type(self)(data)
+
+    def _validate(self):
+        self._validate_runtime()
+        self._validate_dependencies()
+
+        data = self._data
+        _check_string_list('volumes', data.get('volumes'))
+        _check_string_list('ports', data.get('ports'))
+        if data.get('envs'):  # default to an empty list
+            _check_type('envs', data['envs'], collections.abc.Mapping, 'a mapping')
+        _check_type('entrypoint_name', data.get('entrypoint_name'), str, 'a string')
+        for name in ('docker_image_prefix', 'image_base_name'):
+            _check_type(name, data.get(name), (str, type(None)), 'a string')
+        if data.get('runner_wheels') not in RUNNER_WHEELS_SOURCES:
+            raise ValueError('Invalid config: runner_wheels should be one of %s' % ', '.join(RUNNER_WHEELS_SOURCES))
+        if data.get('pip_constraint') and not os.path.isfile(data['pip_constraint']):
+            raise ValueError('Invalid config: pip_constraint %s is not a file' % data['pip_constraint'])
+
+    def _validate_runtime(self):
+        data = self._data
+        _check_type('runtimes', data.get('runtimes'), collections.abc.Mapping, 'a mapping')
+        if data.get('runtime') not in data['runtimes']:
+            raise RuntimeError('Unknown runtime: %s' % data.get('runtime'))
+        for name, runtime in data['runtimes'].items():
+            _check_type('runtimes.%s' % name, runtime, collections.abc.Mapping, 'a mapping')
+            for key in ('image', 'runtime'):
+                _check_type('runtimes.%s.%s' % (name, key), runtime.get(key), str, 'a string')
+
+    def _validate_dependencies(self):
+        data = self._data
+        for name, dependencies in (
+            ('dependencies', data.get('dependencies')),
+            ('runtimes.%s.dependencies' % data['runtime'], data['runtimes'][data['runtime']].get('dependencies')),
+        ):
+            _check_type(name, dependencies, collections.abc.Mapping, 'a mapping')
+            for kind in ('run', 'build'):
+                _check_string_list('%s.%s' % (name, kind), dependencies.get(kind, ()))
+
+        _check_type('repositories', data.get('repositories'), collections.abc.Mapping, 'a mapping')
+        for name, repository in data['repositories'].items():
+            _check_type('repositories.%s' % name, repository, collections.abc.Mapping, 'a mapping')
+            for key, value in repository.items():
+                _check_type('repositories.%s.%s' % (name, key), value, str, 'a string')
+
+
 class GrockerRequirement:
 
     def __init__(self, project_name, operator, version, extras, filepath):
@@ -0,0 +1,528 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+"""In-memory Docker engine implementing the docker-py client surface used by Grocker."""
+
+import collections
+import hashlib
+import io
+import itertools
+import json
+import posixpath
+import re
+import tarfile
+import threading
+
+import docker.errors
+import requests
+
+
+def _matches(labels, filters):
+    """Whether labels match Docker label filters (``label`` and ``label!``, key or key=value)."""
+    def match(selector):
+        key, _, value = selector.partition('=')
+        return key in labels and (not value or labels[key] == value)
+
+    def as_list(value):
+        return [value] if isinstance(value, str) else list(value or [])
+
+    return (
+        all(match(selector) for selector in as_list(filters.get('label')))
+        and not any(match(selector) for selector in as_list(filters.get('label!')))
+    )
+
+
+# Filters accepted by the list endpoints (prune endpoints also accept label! and until)
+LIST_FILTERS = {
+    'images': {'before', 'dangling', 'label', 'reference', 'since', 'until'},
+    'containers': {
+        'ancestor', 'before', 'expose', 'exited', 'health', 'id', 'isolation', 'is-task', 'label', 'name', 'network',
+        'publish', 'since', 'status', 'volume',
+    },
+    'volumes': {'dangling', 'driver', 'label', 'name'},
+}
+
+
+def _check_filters(endpoint, filters):
+    """Reject the filters a Docker list endpoint does not accept, like the Docker daemon."""
+    for key in filters or {}:
+        if key not in LIST_FILTERS[endpoint]:
+            raise _api_error(400, "invalid filter '%s'" % key)
+
+
+def _tar(members):
+    """Return a tar archive of members (None content for directories), in chunks like the Docker API."""
+    fileobj = io.BytesIO()
+    with tarfile.open(fileobj=fileobj, mode='w') as archive:
+        for name, content in members:
+            info = tarfile.TarInfo(name)
+            if content is None:
+                info.type = tarfile.DIRTYPE
+                archive.addfile(info)
+            else:
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+    data = fileobj.getvalue()
+    return [data[i:i + 2048] for i in range(0, len(data), 2048)]
+
+
+def _api_error(status_code, message):
+    response = requests.Response()
+    response.status_code = status_code
+    return docker.errors.APIError(message, response=response)
+
+
+def fake_compiler(engine, image, command, volumes):
+    """
+    Run a compiler container: write the wheels, record (and lock) and inventory of each release to the wheel
+    volume.
+
+    Each release (``project==version``) gets its own wheel and a shared dependency wheel.
+    """
+    if '-compiler:' not in image or '--record' not in command:
+        return
+    volume_name = next(name for name, bind in volumes.items() if bind['bind'] == '/home/grocker/packages')
+    files = engine.volume_files.setdefault(volume_name, {})
+    for identifier, release in re.findall(r'--record (\S+) (\S+)', ' '.join(command)):
+        project, _, version = release.partition('==')
+        wheels = ['%s-%s-py3-none-any.whl' % (project.replace('-', '_'), version), 'six-1.16.0-py2.py3-none-any.whl']
+        lock = []
+        for wheel in wheels:
+            files[wheel] = b'wheel content'
+            name, version = wheel.split('-')[:2]
+            lock.append({
+                'name': name.replace('_', '-').lower(),
+                'version': version,
+                'wheel': wheel,
+                'sha256': hashlib.sha256(files[wheel]).hexdigest(),
+            })
+        record = {'release': release, 'wheels': wheels, 'lock': lock}
+        files['.grocker/records/%s.json' % identifier] = json.dumps(record).encode()
+    inventory = sorted(path for path in files if path.endswith('.whl'))
+    files['.grocker/inventory.json'] = json.dumps(inventory).encode()
+
+
+class FakeImage:
+
+    def __init__(self, engine, record):
+        self.engine = engine
+        self.id = record['Id']
+        self.attrs = {
+            'Id': record['Id'],
+            'RepoTags': record['RepoTags'],
+            'RepoDigests': record['RepoDigests'],
+            'Config': {'Labels': record['Labels']},
+        }
+
+    @property
+    def tags(self):
+        return list(self.attrs['RepoTags'])
+
+    def tag(self, repository, tag=None):
+        self.engine.add_tag(self.id, '%s:%s' % (repository, tag or 'latest'))
+        return True
+
+
+class FakeContainer:
+
+    def __init__(self, engine, record, volumes=None):
+        self.engine = engine
+        self.volumes = volumes or {}
+        self.id = record['Id']
+        self.short_id = record['Id'][:12]
+        self.name = record['Names'][0].lstrip('/')
+        self.attrs = {
+            'Id': self.id,
+            'Config': {'Labels': record['Labels']},
+            'NetworkSettings': {'IPAddress': ''},  # like docker-py, attributes read before starting
+        }
+
+    def reload(self):
+        self.engine.call('containers.reload')
+        record = self.engine.find_container(self.id)
+        self.attrs['NetworkSettings']['IPAddress'] = '172.17.0.2' if record and record['State'] == 'running' else ''
+
+    def attach(self, stream=False, logs=False):
+        self.engine.call('containers.attach')
+        return iter(self.engine.container_output)
+
+    def wait(self):
+        self.engine.call('containers.wait')
+        return {'StatusCode': 0, 'Error': None}
+
+    def get_archive(self, path):
+        self.engine.call('containers.get_archive')
+        for volume_name, bind in self.volumes.items():
+            if path == bind['bind'] or path.startswith(bind['bind'] + '/'):
+                files = self.engine.volume_files.get(volume_name, {})
+                relative_path = path[len(bind['bind']):].strip('/')
+                if relative_path in files:
+                    return _tar([(posixpath.basename(path), files[relative_path])]), {}
+                directory = posixpath.basename(path)
+                members = [
+                    (posixpath.join(directory, posixpath.relpath(name, relative_path or '.')), content)
+                    for name, content in sorted(files.items())
+                    if not relative_path or name.startswith(relative_path + '/')
+                ]
+                if members or not relative_path:
+                    return _tar([(directory, None)] + members), {}
+        raise docker.errors.NotFound('No such file or directory: %s' % path)
+
+    def remove(self, force=False):
+        self.engine.api.remove_container(self.id, force=force)
+
+
+class FakeVolume:
+
+    def __init__(self, record):
+        self.id = self.name = record['Name']
+        self.attrs = record
+
+
+class FakeImageCollection:
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def get(self, name):
+        self.engine.call('images.get')
+        record = self.engine.find_image(name)
+        if record is None:
+            raise docker.errors.ImageNotFound('No such image: %s' % name)
+        return FakeImage(self.engine, record)
+
+    def pull(self, name):
+        self.engine.call('images.pull')
+        if name not in self.engine.registry:
+            raise docker.errors.NotFound('manifest for %s not found' % name)
+        self.engine.add_image(name, self.engine.registry[name])
+        return self.get(name)
+
+    def list(self, filters=None):
+        return [FakeImage(self.engine, record) for record in self.engine.api.images(filters=filters)]
+
+
+class FakeContainerCollection:
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def create(self, image, command=None, volumes=None, labels=None, **kwargs):
+        self.engine.call('containers.create')
+        return FakeContainer(self.engine, self.engine.add_container(image, labels), volumes)
+
+    def run(
+        self, image, command=None, volumes=None, environment=None, detach=False, name=None, labels=None,
+        auto_remove=False, **kwargs,
+    ):
+        self.engine.call('containers.run')
+        self.engine.runs.append({'image': image, 'command': list(command or [])})
+        fake_compiler(self.engine, image, command or [], volumes or {})
+        with self.engine.lock:
+            if name and self.engine.find_container(name):
+                raise _api_error(409, 'Conflict. The container name "/%s" is already in use' % name)
+            image_record = self.engine.find_image(image) or {'Labels': {}}
+            record = self.engine.add_container(
+                image, dict(image_record['Labels'], **(labels or {})), state='running', name=name,
+                auto_remove=auto_remove,
+            )
+        return FakeContainer(self.engine, record, volumes)
+
+
+class FakeVolumeCollection:
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def create(self, name, labels=None, **kwargs):
+        self.engine.call('volumes.create')
+        return FakeVolume(self.engine.add_volume(name, labels))
+
+    def get(self, name):
+        self.engine.call('volumes.get')
+        if name not in self.engine.volumes:
+            raise docker.errors.NotFound('No such volume: %s' % name)
+        return FakeVolume(self.engine.volumes[name])
+
+    def list(self, filters=None):
+        self.engine.call('volumes.list')
+        _check_filters('volumes', filters)
+        name = (filters or {}).get('name', '')
+        return [FakeVolume(record) for record in self.engine.volumes.values() if name in record['Name']]
+
+
+class FakeAPIClient:
+    """Low-level API (``docker_client.api``)."""
+
+    api_version = '1.43'
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.hooks = {'response': []}
+
+    def build(self, fileobj=None, custom_context=False, tag=None, labels=None, buildargs=None, **kwargs):
+        self.engine.call('api.build')
+        context = fileobj if isinstance(fileobj, bytes) else b''.join(fileobj)
+        self.engine.builds.append({
+            'tag': tag,
+            'context': context,
+            'buildargs': dict(buildargs or {}),
+            'extra_hosts': kwargs.get('extra_hosts'),
+        })
+        image_id = self.engine.add_image(tag, labels)['Id']
+        return iter([
+            json.dumps({'stream': 'Step 1/2 : FROM base\n'}),
+            json.dumps({'stream': 'Step 2/2 : RUN provision\n'}),
+            json.dumps({'stream': 'Successfully built %s\n' % image_id[7:19]}),
+            json.dumps({'stream': 'Successfully tagged %s\n' % tag}),
+        ])
+
+    def push(self, repository, tag=None, stream=False, decode=False):
+        self.engine.call('api.push')
+        digest = 'sha256:' + hashlib.sha256(('%s:%s' % (repository, tag)).encode('utf-8')).hexdigest()
+        return iter([
+            {'status': 'The push refers to repository [%s]' % repository},
+            {'status': 'Pushed', 'id': 'layer'},
+            {'aux': {'Tag': tag, 'Digest': digest, 'Size': 1234}},
+        ])
+
+    def images(self, filters=None):
+        self.engine.call('api.images')
+        _check_filters('images', filters)
+        with self.engine.lock:
+            return [dict(record) for record in self.engine.images.values() if _matches(record['Labels'], filters or {})]
+
+    def containers(self, all=False, filters=None, size=False):  # noqa: A002
+        self.engine.call('api.containers')
+        _check_filters('containers', filters)
+        filters = filters or {}
+        with self.engine.lock:
+            return [
+                dict(record)
+                for record in self.engine.containers.values()
+                if (
+                    _matches(record['Labels'], filters)
+                    and (all or record['State'] == 'running')
+                    and filters.get('status', record['State']) == record['State']
+                )
+            ]
+
+    def volumes(self, filters=None):
+        self.engine.call('api.volumes')
+        _check_filters('volumes', filters)
+        with self.engine.lock:
+            return {'Volumes': [
+                dict(record) for record in self.engine.volumes.values() if _matches(record['Labels'], filters or {})
+            ]}
+
+    def df(self):
+        self.engine.call('api.df')
+        with self.engine.lock:
+            return {
+                'Images': [dict(record) for record in self.engine.images.values()],
+                'Containers': [dict(record) for record in self.engine.containers.values()],
+                'Volumes': [dict(record) for record in self.engine.volumes.values()],
+            }
+
+    def remove_image(self, image, force=False):
+        self.engine.call('api.remove_image')
+        with self.engine.lock:
+            if image not in self.engine.images:
+                raise docker.errors.ImageNotFound('No such image: %s' % image)
+            del self.engine.images[image]
+
+    def inspect_container(self, container):
+        self.engine.call('api.inspect_container')
+        with self.engine.lock:
+            record = self.engine.find_container(container)
+            if record is None:
+                raise docker.errors.NotFound('No such container: %s' % container)
+            return {
+                'Id': record['Id'],
+                'Name': record['Names'][0],
+                'State': {
+                    'Status': record['State'],
+                    'Running': record['State'] == 'running',
+                    'Health': {'Status': record['Health']},
+                },
+                'NetworkSettings': {'IPAddress': '172.17.0.2' if record['State'] == 'running' else ''},
+                'Config': {'Labels': dict(record['Labels'])},
+            }
+
+    def kill(self, container, signal=None):
+        self.engine.call('api.kill')
+        with self.engine.lock:
+            record = self.engine.find_container(container)
+            if record is None:
+                raise docker.errors.NotFound('No such container: %s' % container)
+            if record['State'] != 'running':
+                raise _api_error(409, 'Container %s is not running' % container)
+            record['Signals'].append(signal)
+
+    def stop(self, container):
+        self.engine.call('api.stop')
+        with self.engine.lock:
+            record = self.engine.find_container(container)
+            if record is None:
+                raise docker.errors.NotFound('No such container: %s' % container)
+            record['State'] = 'exited'
+            if record['AutoRemove']:
+                del self.engine.containers[record['Id']]
+
+    def wait(self, container, condition=None):
+        self.engine.call('api.wait')
+        if self.engine.find_container(container) is None:
+            raise docker.errors.NotFound('No such container: %s' % container)
+        return {'StatusCode': 0}
+
+    def remove_container(self, container, force=False):
+        self.engine.call('api.remove_container')
+        with self.engine.lock:
+            record = self.engine.find_container(container)
+            if record is None:
+                raise docker.errors.NotFound('No such container: %s' % container)
+            del self.engine.containers[record['Id']]
+
+    def remove_volume(self, name, force=False):
+        self.engine.call('api.remove_volume')
+        with self.engine.lock:
+            if name not in self.engine.volumes:
+                raise docker.errors.NotFound('No such volume: %s' % name)
+            del self.engine.volumes[name]
+
+    def prune_images(self, filters=None):
+        self.engine.call('api.prune_images')
+        deleted = self.engine.prune(self.engine.images, filters, 'Id')
+        return {'ImagesDeleted': [{'Deleted': record['Id']} for record in deleted], 'SpaceReclaimed': 0}
+
+    def prune_containers(self, filters=None):
+        self.engine.call('api.prune_containers')
+        deleted = self.engine.prune(self.engine.containers, filters, 'Id', states=('created', 'exited', 'dead'))
+        return {'ContainersDeleted': [record['Id'] for record in deleted], 'SpaceReclaimed': 0}
+
+    def prune_volumes(self, filters=None):
+        self.engine.call('api.prune_volumes')
+        deleted = self.engine.prune(self.engine.volumes, filters, 'Name')
+        return {'VolumesDeleted': [record['Name'] for record in deleted], 'SpaceReclaimed': 0}
+
+
+class FakeEngine:
+    """Docker objects (as listed by the low-level API), and the count of the calls made to them."""
+
+    def __init__(self, registry, container_output):
+        self.lock = threading.RLock()
+        self.calls = collections.Counter()
+        self.registry = registry
+        self.container_output = container_output
+        self.builds = []  # build context and options, by build
+        self.runs = []  # image and command, by run container
+        self.images = {}
+        self.containers = {}
+        self.volumes = {}
+        self.volume_files = {}  # file content by path, by volume name
+        self._ids = itertools.count()
+
+    def call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def _new_id(self, name):
+        with self.lock:
+            return hashlib.sha256(('%s-%d' % (name, next(self._ids))).encode('utf-8')).hexdigest()
+
+    def add_image(self, name=None, labels=None, size=100 * 1000 * 1000):
+        with self.lock:
+            record = self.find_image(name) if name else None
+            if record is not None:  # the new image gets the tag
+                record['RepoTags'].remove(name)
+            record = {
+                'Id': 'sha256:' + self._new_id(name or 'image'),
+                'RepoTags': [name] if name else [],
+                'RepoDigests': [],
+                'Labels': dict(labels or {}),
+                'Size': size,
+            }
+            self.images[record['Id']] = record
+            return record
+
+    def add_tag(self, image_id, name):
+        with self.lock:
+            record = self.images[image_id]
+            if name not in record['RepoTags']:
+                record['RepoTags'].append(name)
+
+    def find_image(self, name):
+        with self.lock:
+            if name in self.images:
+                return self.images[name]
+            for record in self.images.values():
+                if name in record['RepoTags']:
+                    return record
+            return None
+
+    def add_container(self, image, labels=None, state='exited', size=0, name=None, auto_remove=False):
+        with self.lock:
+            container_id = self._new_id('container')
+            record = {
+                'Id': container_id,
+                'Names': ['/%s' % (name or 'container-%s' % container_id[:8])],
+                'Image': image,
+                'Labels': dict(labels or {}),
+                'State': state,
+                'Health': 'healthy',
+                'SizeRw': size,
+                'AutoRemove': auto_remove,
+                'Signals': [],
+            }
+            self.containers[container_id] = record
+            return record
+
+    def find_container(self, container):
+        with self.lock:
+            if container in self.containers:
+                return self.containers[container]
+            for record in self.containers.values():
+                if record['Names'][0] == '/' + container:
+                    return record
+            return None
+
+    def add_volume(self, name, labels=None, size=0, created_at='2024-01-01T00:00:00Z'):
+        with self.lock:
+            return self.volumes.setdefault(name, {
+                'Name': name,
+                'Labels': dict(labels or {}),
+                'CreatedAt': created_at,
+                'UsageData': {'Size': size, 'RefCount': 0},
+            })
+
+    def prune(self, records, filters, key, states=None):
+        with self.lock:
+            deleted = [
+                record
+                for record in records.values()
+                if _matches(record['Labels'], filters or {}) and (states is None or record.get('State') in states)
+            ]
+            for record in deleted:
+                del records[record[key]]
+            return deleted
+
+
+class FakeDockerClient:
+    """
+    docker.DockerClient of an in-memory Docker engine.
+
+    Images are built instantly (the build context is read, then dropped), pulled from ``registry`` (image
+    labels by name) and pushed nowhere. Containers exit at once, after printing ``container_output``;
+    compiler containers first write fake wheels to their wheel volume (see ``fake_compiler``).
+    """
+
+    def __init__(self, registry=None, container_output=(b'Done\n',)):
+        self.engine = FakeEngine(dict(registry or {}), list(container_output))
+        self.api = FakeAPIClient(self.engine)
+        self.images = FakeImageCollection(self.engine)
+        self.containers = FakeContainerCollection(self.engine)
+        self.volumes = FakeVolumeCollection(self.engine)
+        self.engine.api = self.api
+
+    @property
+    def calls(self):
+        return self.engine.calls
@@ -0,0 +1,185 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+"""
+Benchmarks of Grocker own overhead, using an in-memory Docker engine.
+
+Durations are compared to the duration of a reference workload measured on the same machine, and must
+stay within TOLERANCE times their baseline ratio; Docker API calls must not exceed their baseline count.
+Update baselines (tests/resources/benchmarks.json) with ``GROCKER_UPDATE_BENCHMARKS=1 py.test
+tests/test_benchmarks.py``.
+"""
+
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+import fake_docker
+
+import grocker.builders.naming as grocker_naming
+import grocker.cleanners as grocker_cleanners
+import grocker.scheduler as grocker_scheduler
+import grocker.utils as grocker_utils
+from grocker import __version__
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), 'resources', 'benchmarks.json')
+TOLERANCE = 3  # benchmarks run on shared CI workers, and use threads
+REPEAT = 5
+PURGED_OBJECTS = 2000
+DEFAULT_OPTIONS = {name: None for name in grocker_scheduler.BUILD_OPTIONS}
+
+
+def reference_workload():
+    data = {'key%d' % i: list(range(10)) for i in range(2000)}
+    for _ in range(5):
+        hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def measure(function, setup=None, number=1):
+    """Return the best duration of REPEAT runs of function (called number times, after setup)."""
+    durations = []
+    for _ in range(REPEAT):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        for _ in range(number):
+            function(*args)
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def populated_client(count, version='1.0'):
+    client = fake_docker.FakeDockerClient()
+    labels = {'grocker.version': version, 'grocker.image.role': 'root'}
+    for i in range(count):
+        client.engine.add_image('grocker-root-%d:%s' % (i, version), labels)
+        client.engine.add_container('grocker-root-%d:%s' % (i, version), labels)
+        client.engine.add_volume('grocker-volume-%d' % i, labels, size=1000)
+    return client
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.reference = measure(reference_workload)
+        cls.update = bool(os.environ.get('GROCKER_UPDATE_BENCHMARKS'))
+        try:
+            with open(BASELINES_PATH) as fp:
+                cls.baselines = json.load(fp)
+        except FileNotFoundError:
+            cls.baselines = {}
+        cls.results = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.update:
+            with open(BASELINES_PATH, 'w') as fp:
+                json.dump(dict(cls.baselines, **cls.results), fp, indent=2, sort_keys=True)
+                fp.write('\n')
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        environ = unittest.mock.patch.dict(os.environ, {'XDG_CACHE_HOME': tmp_dir.name})  # wheel volume usage
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.config_path = os.path.join(tmp_dir.name, '.grocker.yml')
+        with open(self.config_path, 'w') as fp:
+            fp.write('dependencies:\n  run: [libpq5, libjpeg62-turbo]\n  build: [libpq-dev]\nvolumes: [/data]\n')
+
+    def check(self, name, duration, calls=None):
+        result = {'ratio': round(duration / self.reference, 3)}
+        if calls is not None:
+            result['calls'] = sum(calls.values())
+        self.results[name] = result
+        if self.update:
+            return
+
+        baseline = self.baselines[name]
+        self.assertLessEqual(
+            result['ratio'], baseline['ratio'] * TOLERANCE,
+            '%s took %.1f times the reference workload, its baseline is %.1f' % (
+                name, result['ratio'], baseline['ratio'],
+            ),
+        )
+        if calls is not None:
+            self.assertLessEqual(result['calls'], baseline['calls'], '%s made more Docker API calls: %s' % (
+                name, dict(calls),
+            ))
+
+    def test_parse_config(self):
+        self.check('parse_config', measure(lambda: grocker_utils.parse_config([self.config_path]), number=10))
+
+    def test_config_identifier(self):
+        config = grocker_utils.parse_config([self.config_path])
+        self.check('config_identifier', measure(lambda: grocker_utils.config_identifier(config), number=1000))
+
+    def test_naming(self):
+        config = grocker_utils.Config.parse([self.config_path])
+
+        def names():
+            for role in ('root', 'compiler', 'wheel-server'):
+                grocker_naming.image_name(config, role)
+            grocker_naming.wheel_volume_name(config)
+
+        self.check('naming', measure(names, number=1000))
+
+    def test_build(self):
+        jobs = []
+
+        def setup():
+            jobs[:] = [
+                grocker_scheduler.BuildJob.from_options('project-%d==1.0' % i, dict(
+                    DEFAULT_OPTIONS,
+                    config=[self.config_path],
+                    runner_wheels='context' if i % 2 else 'server',
+                    runtime='bookworm/3.12' if i % 4 == 3 else None,
+                ))
+                for i in range(20)
+            ]
+            return (fake_docker.FakeDockerClient(),)
+
+        def build(client):
+            failed_jobs = grocker_scheduler.run(client, jobs, pip_conf=None, push=False, workers=4)
+            self.assertEqual(failed_jobs, [])
+
+        duration = measure(build, setup)
+        client, = setup()
+        build(client)
+        self.check('build', duration, calls=client.calls)
+
+    def test_purge(self):
+        def purge(client):
+            self.assertEqual(grocker_cleanners.docker_purge_container(client)[0], PURGED_OBJECTS)
+            self.assertEqual(grocker_cleanners.docker_purge_volumes(client)[0], PURGED_OBJECTS)
+            self.assertEqual(grocker_cleanners.docker_purge_images(client)[0], PURGED_OBJECTS)
+
+        self.check('purge', measure(purge, lambda: (populated_client(PURGED_OBJECTS),)))
+
+    def test_purge_dry_run(self):
+        client = populated_client(PURGED_OBJECTS)
+
+        def purge():
+            grocker_cleanners.docker_purge_container(client, dry_run=True)
+            grocker_cleanners.docker_purge_volumes(client, dry_run=True)
+            grocker_cleanners.docker_purge_images(client, dry_run=True)
+
+        self.check('purge_dry_run', measure(purge))
+
+    def test_evict_wheel_volumes(self):
+        def setup():
+            client = fake_docker.FakeDockerClient()
+            labels = {'grocker.version': __version__, 'grocker.image.role': 'wheel'}
+            for i in range(PURGED_OBJECTS):
+                client.engine.add_volume('grocker-wheel-cache-%d' % i, labels, size=1000)
+            return (client,)
+
+        def evict(client):
+            count, _ = grocker_cleanners.docker_evict_wheel_volumes(client, max_size=PURGED_OBJECTS * 500)
+            self.assertEqual(count, PURGED_OBJECTS / 2)
+
+        self.check('evict_wheel_volumes', measure(evict, setup))
@@ -0,0 +1,228 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import concurrent.futures
+import os
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import fake_docker
+
+import grocker.cleanners as grocker_cleanners
+import grocker.helpers as grocker_helpers
+import grocker.usage as grocker_usage
+from grocker import __version__
+
+
+class FakeAPI:
+    """Low-level Docker API returning the images given to it."""
+
+    def __init__(self, images=(), volumes=()):
+        self._images = list(images)
+        self._volumes = list(volumes)
+        self.removed = []
+
+    def images(self, filters=None):
+        return self._images
+
+    def remove_image(self, image, force=False):
+        self.removed.append((image, force))
+
+    def df(self):
+        return {'Volumes': self._volumes}
+
+    def volumes(self, filters=None):
+        return {'Volumes': [volume for volume in self._volumes if volume['Name'] not in self.removed]}
+
+    def remove_volume(self, name):
+        self.removed.append(name)
+
+
+class FakeClient:
+
+    def __init__(self, images=(), volumes=()):
+        self.api = FakeAPI(images, volumes)
+
+
+def image(image_id, version, role, tags, size=10):
+    labels = {'grocker.version': version, 'grocker.image.role': role}
+    return {'Id': image_id, 'Labels': labels, 'RepoTags': tags, 'Size': size}
+
+
+def volume(name, size, ref_count=0, created_at='2024-01-01T00:00:00Z', version=__version__):
+    labels = {'grocker.version': version, 'grocker.image.role': 'wheel'}
+    usage_data = {'Size': size, 'RefCount': ref_count}
+    return {'Name': name, 'Labels': labels, 'UsageData': usage_data, 'CreatedAt': created_at}
+
+
+class PurgeImagesTestCase(unittest.TestCase):
+
+    images = [
+        image('old-root', '1.0', 'root', ['grocker-root:1.0']),
+        image('old-runner', '1.0', 'runner', ['project:1.0', 'registry/project:1.0']),
+        image('current-root', __version__, 'root', ['grocker-root:%s' % __version__]),
+    ]
+
+    def test_old_images(self):
+        client = FakeClient(self.images)
+        self.assertEqual(grocker_cleanners.docker_purge_images(client), (1, 10))
+        self.assertEqual(client.api.removed, [('old-root', False)])
+
+    def test_runner_images(self):
+        client = FakeClient(self.images)
+        self.assertEqual(grocker_cleanners.docker_purge_images(client, runner=True), (2, 20))
+        self.assertEqual(sorted(client.api.removed), [('old-root', False), ('old-runner', True)])
+
+    def test_dry_run(self):
+        client = FakeClient(self.images)
+        result = grocker_cleanners.docker_purge_images(client, runner=True, dry_run=True)
+        self.assertEqual(result, (2, 20))
+        self.assertEqual(client.api.removed, [])
+
+    def test_format_size(self):
+        self.assertEqual(grocker_cleanners.format_size(999), '999 B')
+        self.assertEqual(grocker_cleanners.format_size(1234567), '1.2 MB')
+
+
+class PurgeContainersTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = fake_docker.FakeDockerClient()
+        for version in ('1.0', __version__):
+            for role in ('compiler', 'runner'):
+                self.client.engine.add_container('image', {'grocker.version': version, 'grocker.image.role': role})
+        self.client.engine.add_container('image', {'grocker.version': '1.0'}, state='running')
+        labels = {'grocker.version': __version__, 'grocker.image.role': 'compiler'}
+        self.client.engine.add_container('image', labels, state='created')  # used by a running build
+
+    def test_old_containers(self):
+        self.assertEqual(grocker_cleanners.docker_purge_container(self.client, dry_run=True)[0], 1)
+        self.assertEqual(len(self.client.engine.containers), 6)
+        self.assertEqual(grocker_cleanners.docker_purge_container(self.client)[0], 1)
+        self.assertEqual(len(self.client.engine.containers), 5)
+
+    def test_current_version(self):
+        purge = grocker_cleanners.docker_purge_container
+        self.assertEqual(purge(self.client, current_version=True, dry_run=True)[0], 2)
+        self.assertEqual(purge(self.client, current_version=True)[0], 2)
+        containers = self.client.engine.containers.values()
+        roles = sorted(record['Labels'].get('grocker.image.role', '') for record in containers)
+        self.assertEqual(roles, ['', 'compiler', 'runner', 'runner'])
+
+
+def record_volume_uses(path, prefix, count=20):
+    for i in range(count):
+        grocker_usage.record_volume_use('%s-%d' % (prefix, i), path=path)
+
+
+class UsageTestCase(unittest.TestCase):
+
+    def test_concurrent_processes(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, 'grocker', 'volumes.json')
+            with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
+                list(executor.map(record_volume_uses, [path] * 4, 'abcd'))
+            self.assertEqual(len(grocker_usage.load_volume_uses(path)), 80)  # no update lost
+
+    def test_volume_lock(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with unittest.mock.patch.dict(os.environ, {'XDG_CACHE_HOME': cache_dir}):
+                collected = threading.Event()
+
+                def collect_garbage():
+                    with grocker_usage.volume_lock('volume', exclusive=True):
+                        collected.set()
+
+                with grocker_usage.volume_lock('volume'), grocker_usage.volume_lock('volume'):  # builds share it
+                    thread = threading.Thread(target=collect_garbage)
+                    thread.start()
+                    self.assertFalse(collected.wait(timeout=0.1))  # waits for the builds
+                thread.join(timeout=5)
+                self.assertTrue(collected.is_set())
+
+    def test_unwritable_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, 'file', 'volumes.json')
+            with open(os.path.join(cache_dir, 'file'), 'w'):  # not a directory
+                pass
+            with self.assertLogs('grocker.usage', 'WARNING'):
+                grocker_usage.record_volume_use('volume', path=path)
+                grocker_usage.forget_volumes(['volume'], path=path, records_path=path)
+
+
+class EvictWheelVolumesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        patcher = unittest.mock.patch.dict(os.environ, {'XDG_CACHE_HOME': cache_dir.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        now = time.time()
+        grocker_usage.record_volume_use('recent', now - 3600)
+        grocker_usage.record_volume_use('old', now - 10 * 86400)
+        grocker_usage.record_volume_use('in-use', now - 20 * 86400)
+        grocker_usage.record_volume_use('deleted', now - 20 * 86400)
+        self.volumes = [
+            volume('recent', 300),
+            volume('old', 200),
+            volume('in-use', 100, ref_count=1),
+            volume('unknown', 400),  # never used on this host, created a long time ago
+            volume('older-version', 400, version='1.0'),
+        ]
+
+    def test_max_age(self):
+        client = FakeClient(volumes=self.volumes)
+        result = grocker_cleanners.docker_evict_wheel_volumes(client, max_age=7 * 86400)
+        self.assertEqual(result, (2, 600))
+        self.assertEqual(sorted(client.api.removed), ['old', 'unknown'])
+        self.assertEqual(sorted(grocker_usage.load_volume_uses()), ['in-use', 'recent'])
+
+    def test_max_size(self):
+        client = FakeClient(volumes=self.volumes)
+        result = grocker_cleanners.docker_evict_wheel_volumes(client, max_size=500, dry_run=True)
+        self.assertEqual(result, (2, 600))  # least recently used first, volumes in use are kept
+        self.assertEqual(client.api.removed, [])
+
+        result = grocker_cleanners.docker_evict_wheel_volumes(client, max_size=700)
+        self.assertEqual(result, (1, 400))
+        self.assertEqual(client.api.removed, ['unknown'])
+
+
+class StopSharedWheelServersTestCase(unittest.TestCase):
+
+    def test_stop(self):
+        client = fake_docker.FakeDockerClient()
+        for version in ('1.0', __version__):
+            labels = {'grocker.version': version, grocker_cleanners.SHARED_WHEEL_SERVER_LABEL: 'volume-%s' % version}
+            client.engine.add_container('grocker-wheel-server', labels, state='running', auto_remove=True)
+        client.engine.add_container('grocker-wheel-server', {'grocker.version': '1.0'}, state='running')
+
+        self.assertEqual(grocker_cleanners.docker_stop_shared_wheel_servers(client, dry_run=True), (1, 0))
+        self.assertEqual(len(client.engine.containers), 3)
+        self.assertEqual(grocker_cleanners.docker_stop_shared_wheel_servers(client), (1, 0))
+        self.assertEqual(len(client.engine.containers), 2)  # stopped then removed
+        self.assertEqual(grocker_cleanners.docker_stop_shared_wheel_servers(client, current_version=True), (1, 0))
+        self.assertEqual(len(client.engine.containers), 1)  # not a shared wheel server
+
+
+class ParseTestCase(unittest.TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(grocker_helpers.parse_size('500'), 500)
+        self.assertEqual(grocker_helpers.parse_size('1.5G'), 1500000000)
+        self.assertEqual(grocker_helpers.parse_size('20 GB'), 20000000000)
+        self.assertEqual(grocker_helpers.parse_size('20GiB'), 20 * 2 ** 30)
+        self.assertEqual(grocker_helpers.parse_size('1.5Mi'), 1572864)
+        for value in ('20 apples', '20iB'):
+            with self.assertRaises(ValueError):
+                grocker_helpers.parse_size(value)
+
+    def test_parse_duration(self):
+        self.assertEqual(grocker_helpers.parse_duration('2'), 2 * 86400)
+        self.assertEqual(grocker_helpers.parse_duration('12h'), 12 * 3600)
+        with self.assertRaises(ValueError):
+            grocker_helpers.parse_duration('12 years')
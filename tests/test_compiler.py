@@ -0,0 +1,268 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import hashlib
+import importlib.util
+import json
+import os
+import os.path
+import tempfile
+import unittest
+import unittest.mock
+
+import grocker
+
+COMPILE_SCRIPT = os.path.join(os.path.dirname(grocker.__file__), 'resources', 'docker', 'compiler-image', 'compile.py')
+
+
+def load_compile_script(package_dir):
+    spec = importlib.util.spec_from_file_location('grocker_compile', COMPILE_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.METADATA_DIRECTORY = os.path.join(package_dir, '.grocker')
+    module.RECORDS_DIRECTORY = os.path.join(module.METADATA_DIRECTORY, 'records')
+    module.INVENTORY_PATH = os.path.join(module.METADATA_DIRECTORY, 'inventory.json')
+    module.INDEX_DIRECTORY = os.path.join(module.METADATA_DIRECTORY, 'simple')
+    module.INDEX_LOCK_PATH = os.path.join(module.METADATA_DIRECTORY, 'index.lock')
+    return module
+
+
+class CollectGarbageTestCase(unittest.TestCase):
+
+    def test_collect_garbage(self):
+        with tempfile.TemporaryDirectory() as package_dir:
+            compile_script = load_compile_script(package_dir)
+            records = {
+                'recent': ['shared-1.0-py3-none-any.whl', 'recent-1.0-py3-none-any.whl'],
+                'old': ['shared-1.0-py3-none-any.whl', 'old-1.0-py3-none-any.whl'],
+                'kept': ['kept-1.0-py3-none-any.whl'],
+            }
+            for identifier, wheels in records.items():
+                for wheel in wheels:
+                    with open(os.path.join(package_dir, wheel), 'w'):
+                        pass
+                    os.utime(os.path.join(package_dir, wheel), (0, 0))
+                record_path = os.path.join(compile_script.RECORDS_DIRECTORY, identifier + '.json')
+                compile_script.write_json(record_path, {'release': identifier, 'wheels': wheels})
+                if identifier != 'recent':
+                    os.utime(record_path, (0, 0))
+            for wheel in ('unrecorded-1.0-py3-none-any.whl', 'recent-2.0-py3-none-any.whl'):
+                with open(os.path.join(package_dir, wheel), 'w'):
+                    pass
+            os.utime(os.path.join(package_dir, 'unrecorded-1.0-py3-none-any.whl'), (0, 0))
+
+            compile_script.collect_garbage(package_dir, max_age=86400, keep_records={'kept'})
+
+            self.assertEqual(sorted(os.listdir(compile_script.RECORDS_DIRECTORY)), ['kept.json', 'recent.json'])
+            expected_wheels = [
+                'kept-1.0-py3-none-any.whl',
+                'recent-1.0-py3-none-any.whl',
+                'recent-2.0-py3-none-any.whl',  # not recorded, but built recently
+                'shared-1.0-py3-none-any.whl',
+            ]
+            self.assertEqual(sorted(os.listdir(package_dir)), ['.grocker'] + expected_wheels)
+            with open(compile_script.INVENTORY_PATH) as fp:
+                self.assertEqual(json.load(fp), expected_wheels)
+
+    def test_no_record(self):  # wheels compiled by an older compiler
+        with tempfile.TemporaryDirectory() as package_dir:
+            compile_script = load_compile_script(package_dir)
+            wheel_path = os.path.join(package_dir, 'old-1.0-py3-none-any.whl')
+            with open(wheel_path, 'w'):
+                pass
+            os.utime(wheel_path, (0, 0))
+            compile_script.collect_garbage(package_dir, max_age=86400)
+            self.assertTrue(os.path.exists(wheel_path))
+
+
+class IndexTestCase(unittest.TestCase):
+
+    def write_wheel(self, wheel, content):
+        with open(os.path.join(self.package_dir, wheel), 'wb') as fp:
+            fp.write(content)
+        return hashlib.sha256(content).hexdigest()
+
+    def read_page(self, *path):
+        with open(os.path.join(self.compile_script.INDEX_DIRECTORY, *path, 'index.html')) as fp:
+            return fp.read()
+
+    def test_update_index(self):
+        with tempfile.TemporaryDirectory() as self.package_dir:
+            self.compile_script = load_compile_script(self.package_dir)
+            wheels = [
+                'Foo_Bar-1.0-py3-none-any.whl',
+                'foo.bar-2.0+local-py3-none-any.whl',
+                'six-1.16.0-py3-none-any.whl',
+            ]
+            hashes = [self.write_wheel(wheel, wheel.encode('utf-8')) for wheel in wheels]
+            index_hashes = self.compile_script.update_index(self.package_dir, wheels)
+            self.assertEqual(index_hashes, dict(zip(wheels, hashes)))
+            self.assertEqual(self.compile_script.release_lock(wheels[1:], index_hashes), [
+                {'name': 'foo-bar', 'version': '2.0+local', 'wheel': wheels[1], 'sha256': hashes[1]},
+                {'name': 'six', 'version': '1.16.0', 'wheel': wheels[2], 'sha256': hashes[2]},
+            ])
+
+            self.assertEqual(sorted(os.listdir(self.compile_script.INDEX_DIRECTORY)), ['foo-bar', 'index.html', 'six'])
+            self.assertIn('<a href="foo-bar/">foo-bar</a>', self.read_page())
+            page = self.read_page('foo-bar')
+            self.assertIn('<a href="../../../Foo_Bar-1.0-py3-none-any.whl#sha256=%s">' % hashes[0], page)
+            self.assertIn('<a href="../../../foo.bar-2.0%%2Blocal-py3-none-any.whl#sha256=%s">' % hashes[1], page)
+
+            # Only given wheels are hashed again
+            rebuilt_hash = self.write_wheel(wheels[0], b'rebuilt')
+            self.write_wheel(wheels[1], b'unchanged')
+            self.compile_script.update_index(self.package_dir, wheels[:1])
+            page = self.read_page('foo-bar')
+            self.assertIn(rebuilt_hash, page)
+            self.assertIn(hashes[1], page)
+
+            # Every project is updated when no wheel is given
+            os.remove(os.path.join(self.package_dir, wheels[2]))
+            self.compile_script.update_index(self.package_dir)
+            self.assertEqual(sorted(os.listdir(self.compile_script.INDEX_DIRECTORY)), ['foo-bar', 'index.html'])
+            self.assertNotIn('six', self.read_page())
+
+
+class SetupVenvTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.compile_script = load_compile_script(tmp_dir.name)
+        self.compile_script.BOOTSTRAPPED_VENV = os.path.join(tmp_dir.name, 'compiler.venv')
+        self.pip = os.path.join(self.compile_script.BOOTSTRAPPED_VENV, 'bin', 'pip')
+
+    def setup_venv(self, missing_packages=''):
+        subprocess = unittest.mock.Mock()
+        subprocess.check_output.return_value = missing_packages.encode()
+        with unittest.mock.patch.object(self.compile_script, 'subprocess', subprocess):
+            return self.compile_script.setup_venv('python3'), subprocess.check_call.call_args_list
+
+    def bootstrap_venv(self):
+        os.makedirs(os.path.dirname(self.pip))
+        with open(self.pip, 'w'):
+            pass
+
+    def test_compiler_image_bootstrap(self):
+        with open(os.path.join(os.path.dirname(COMPILE_SCRIPT), 'provision.sh')) as fp:
+            provision_script = fp.read()
+        # compile.py runs as grocker, its bootstrapped venv is ~/compiler.venv
+        self.assertIn('-m venv /home/grocker/compiler.venv', provision_script)
+        # pip settings are only given to compilations: a failed bootstrap must not fail the image build
+        self.assertIn('/home/grocker/compiler.venv/bin/pip install --no-cache-dir -U %s" grocker || true' % (
+            ' '.join(self.compile_script.VENV_PACKAGES)
+        ), provision_script)
+
+    def test_bootstrapped_venv(self):
+        self.bootstrap_venv()
+        venv, calls = self.setup_venv()
+        self.assertEqual(venv, self.compile_script.BOOTSTRAPPED_VENV)
+        self.assertEqual(calls, [])
+
+    def test_repair_bootstrapped_venv(self):  # its bootstrap failed when building the compiler image
+        self.bootstrap_venv()
+        venv, calls = self.setup_venv('setuptools wheel\n')
+        self.assertEqual(venv, self.compile_script.BOOTSTRAPPED_VENV)
+        self.assertEqual(calls, [unittest.mock.call([self.pip, 'install', '-U', 'setuptools', 'wheel'])])
+
+    def test_new_venv(self):
+        venv, calls = self.setup_venv()
+        self.addCleanup(os.rmdir, venv)
+        self.assertNotEqual(venv, self.compile_script.BOOTSTRAPPED_VENV)
+        self.assertEqual(calls, [
+            unittest.mock.call(['python3', '-m', 'venv', venv]),
+            unittest.mock.call([os.path.join(venv, 'bin', 'pip'), 'install', '-U', 'pip', 'setuptools', 'wheel']),
+        ])
+
+
+class ParallelBuildTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.package_dir = os.path.join(tmp_dir.name, 'packages')
+        self.wheel_dir = os.path.join(tmp_dir.name, 'wheels')
+        os.makedirs(self.package_dir)
+        os.makedirs(self.wheel_dir)
+        self.compile_script = load_compile_script(self.package_dir)
+
+    def test_resolve(self):
+        report = {'install': [
+            {
+                'metadata': {'name': 'project', 'version': '1.0'},
+                'download_info': {'url': 'file:///tmp/src/project-1.0-py3-none-any.whl'},
+                'is_direct': True,
+            },
+            {
+                'metadata': {'name': 'six', 'version': '1.16.0'},
+                'download_info': {'url': 'https://example.com/six-1.16.0.tar.gz'},
+                'is_direct': False,
+            },
+        ]}
+
+        def check_call(args):
+            with open(args[args.index('--report') + 1], 'w') as fp:
+                json.dump(report, fp)
+
+        with unittest.mock.patch.object(self.compile_script.subprocess, 'check_call', side_effect=check_call) as call:
+            distributions = self.compile_script.resolve('venv', '/tmp/src/project-1.0-py3-none-any.whl', 'c.txt')
+        self.assertEqual(distributions, [
+            ('project', '1.0', 'file:///tmp/src/project-1.0-py3-none-any.whl', True),
+            ('six', '1.16.0', 'https://example.com/six-1.16.0.tar.gz', False),
+        ])
+        args = call.call_args[0][0]
+        self.assertEqual(args[:3], [os.path.join('venv', 'bin', 'pip'), 'install', '--dry-run'])
+        self.assertEqual(args[-3:], ['--constraint', 'c.txt', '/tmp/src/project-1.0-py3-none-any.whl'])
+
+    def test_build_wheels_in_parallel(self):
+        for wheel in ('project-1.0-py3-none-any.whl', 'Six-1.16.0-py2.py3-none-any.whl'):
+            with open(os.path.join(self.package_dir, wheel), 'w'):
+                pass
+        distributions = [
+            ('project', '1.0', 'file:///tmp/src/project-1.0-py3-none-any.whl', True),  # rebuilt, same version
+            ('six', '1.16.0', 'https://example.com/six-1.16.0.tar.gz', False),
+            ('requests', '2.0', 'https://example.com/requests-2.0-py3-none-any.whl', False),
+            ('lxml', '5.0', 'https://example.com/lxml-5.0.tar.gz', False),
+            ('local', '0.1', 'file:///tmp/src/local', True),
+        ]
+        pip_wheel = unittest.mock.Mock()
+        resolve = unittest.mock.Mock(return_value=distributions)
+        with unittest.mock.patch.multiple(self.compile_script, resolve=resolve, pip_wheel=pip_wheel):
+            self.compile_script.build_wheels_in_parallel(
+                'venv', 'project', self.package_dir, self.wheel_dir, jobs=2,
+            )
+
+        self.assertEqual(os.listdir(self.wheel_dir), ['Six-1.16.0-py2.py3-none-any.whl'])  # hard linked
+        binaries_call, *source_calls = pip_wheel.call_args_list
+        self.assertEqual(binaries_call, unittest.mock.call(
+            'venv', self.wheel_dir, ['file:///tmp/src/project-1.0-py3-none-any.whl', 'requests==2.0'], None,
+            no_deps=True,
+        ))
+        self.assertEqual(sorted(call[0][2] for call in source_calls), [['file:///tmp/src/local'], ['lxml==5.0']])
+
+    def test_available_cpus(self):
+        self.compile_script.CPU_MAX_PATH = os.path.join(self.wheel_dir, 'cpu.max')
+        for cpu_max, expected in ((None, 4), ('max 100000\n', 4), ('250000 100000\n', 2), ('50000 100000\n', 1)):
+            with self.subTest(cpu_max=cpu_max):
+                if cpu_max is not None:
+                    with open(self.compile_script.CPU_MAX_PATH, 'w') as fp:
+                        fp.write(cpu_max)
+                with unittest.mock.patch.object(self.compile_script.os, 'sched_getaffinity', return_value={0, 1, 2, 3}):
+                    self.assertEqual(self.compile_script.available_cpus(), expected)
+
+    def test_build_wheels(self):
+        for jobs in (1, 0, 4):
+            with self.subTest(jobs=jobs):
+                pip_wheel, parallel = unittest.mock.Mock(), unittest.mock.Mock()
+                with unittest.mock.patch.multiple(
+                    self.compile_script, pip_wheel=pip_wheel, build_wheels_in_parallel=parallel,
+                ):
+                    self.assertEqual(self.compile_script.build_wheels('venv', 'project', self.package_dir), [])
+                    self.compile_script.build_wheels('venv', 'project', self.package_dir, jobs=jobs)
+                self.assertEqual(pip_wheel.call_count, 2 if jobs == 1 else 1)  # serial by default
+                self.assertEqual(parallel.call_count, 0 if jobs == 1 else 1)
+                if jobs != 1:
+                    self.assertEqual(parallel.call_args[0][-1], jobs)
+
+    def test_jobs_option(self):
+        self.assertEqual(self.compile_script.arg_parser().parse_args(['project==1.0']).jobs, 1)
+        self.assertEqual(self.compile_script.arg_parser().parse_args(['--jobs', '0', 'project==1.0']).jobs, 0)
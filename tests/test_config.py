@@ -93,6 +93,43 @@ class ConfigTestCase(unittest.TestCase):
             self.assertIn('entrypoint_name', config)  # grocker internal config is read
 
 
+class FrozenConfigTestCase(unittest.TestCase):
+
+    def test_frozen_config(self):
+        with mkchtmpdir():
+            data = grocker_utils.parse_config([], dependencies={'run': ['libpq5']})
+            config = grocker_utils.Config(data)
+
+        self.assertEqual(config['dependencies']['run'], ('libpq5',))
+        self.assertEqual(config.identifier, grocker_utils.config_identifier(data))
+        self.assertEqual(grocker_utils.config_identifier(config), config.identifier)
+        with self.assertRaises(TypeError):
+            config['runtime'] = 'alpine/3'
+        with self.assertRaises(TypeError):
+            config['dependencies']['run'] = []
+
+        replaced = config.replace(runtime='bookworm/3.12')
+        self.assertEqual(replaced['runtime'], 'bookworm/3.12')
+        self.assertNotEqual(replaced.identifier, config.identifier)
+
+    def test_invalid_config(self):
+        with mkchtmpdir():
+            config = grocker_utils.Config.parse([])
+
+        with self.assertRaises(RuntimeError):
+            config.replace(runtime='unknown/1.0')
+        for invalid_values in (
+            {'dependencies': {'run': 'libpq5'}},
+            {'volumes': '/data'},
+            {'envs': ['A=1']},
+            {'runner_wheels': 'registry'},
+            {'pip_constraint': 'not_existing_constraints.txt'},
+            {'repositories': {'pgdg': {'uri': 1}}},
+        ):
+            with self.assertRaises(ValueError):
+                config.replace(**invalid_values)
+
+
 class GrockerRequirementTestCase(unittest.TestCase):
 
     def test_existing_filepath(self):
@@ -203,3 +240,45 @@ class PipConfigTestCase(unittest.TestCase):
                 'PIP_INDEX_URL': 'http://example.com/simple',
             },
         )
+
+
+class WheelsRecordTestCase(unittest.TestCase):
+
+    def test_wheels_record_identifier(self):
+        identifier = grocker_builders.wheels.wheels_record_identifier
+        requirement = grocker_utils.GrockerRequirement.parse('grocker-test-project==2.0')
+        self.assertEqual(identifier(requirement, b''), identifier(requirement, b''))
+        self.assertNotEqual(identifier(requirement, b''), identifier(requirement, b'qrcode==5.2'))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepath = os.path.join(tmpdir, 'grocker_test_project-1.2.3-py2.py3-none-any.whl')
+            with open(filepath, 'wb') as fp:
+                fp.write(b'first build')
+            first_build = identifier(grocker_utils.GrockerRequirement.parse(filepath), b'')
+            with open(filepath, 'wb') as fp:
+                fp.write(b'second build')
+            second_build = identifier(grocker_utils.GrockerRequirement.parse(filepath), b'')
+        self.assertNotEqual(first_build, second_build)  # wheel content is used, not its name
+
+    def test_split_wheels(self):
+        wheels = [
+            'Grocker_Test_Project-1.2.3-py2.py3-none-any.whl',
+            'qrcode-5.2-py2.py3-none-any.whl',
+            'six-1.16.0-py2.py3-none-any.whl',
+        ]
+        project_wheels, dependency_wheels = grocker_builders.wheels.split_wheels(wheels, 'grocker-test-project')
+        self.assertEqual(project_wheels, wheels[:1])
+        self.assertEqual(dependency_wheels, wheels[1:])
+        self.assertEqual(
+            grocker_builders.wheels.get_wheels_requirements(dependency_wheels),
+            ['qrcode==5.2', 'six==1.16.0'],
+        )
+        hashes = {wheel: '%d' % i * 64 for i, wheel in enumerate(wheels)}
+        self.assertEqual(
+            grocker_builders.wheels.get_wheels_requirements(dependency_wheels + ['six-1.16.0-py3-none-any.whl'], {
+                **hashes, 'six-1.16.0-py3-none-any.whl': '3' * 64,
+            }),
+            ['qrcode==5.2 --hash=sha256:%s' % ('1' * 64), 'six==1.16.0 --hash=sha256:%s --hash=sha256:%s' % (
+                '2' * 64, '3' * 64,
+            )],
+        )
@@ -0,0 +1,64 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import io
+import tarfile
+import unittest
+
+import grocker.builders.contexts as grocker_contexts
+import grocker.helpers
+
+COMPILER_PACKAGE = 'grocker.resources.docker.compiler-image'
+
+
+def read_archive(data):
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        return {
+            member.name: (member.mode, archive.extractfile(member).read() if member.isfile() else None)
+            for member in archive
+        }
+
+
+class BuildContextTestCase(unittest.TestCase):
+
+    def test_build_context(self):
+        with grocker_contexts.BuildContext(COMPILER_PACKAGE) as build_context:
+            build_context.render_template('Dockerfile.j2', 'Dockerfile', {'base_image': 'root', 'runtime': 'python3'})
+            build_context.add_bytes('stage/requirements.txt', b'six==1.16.0\n')
+            build_context.add_directory('stage/wheels')
+            files = read_archive(b''.join(build_context.chunks()))
+
+        self.assertTrue(files['Dockerfile'][1].startswith(b'FROM root\n'))
+        self.assertIn(b'ENTRYPOINT ["python3", "/home/grocker/compile.py"]', files['Dockerfile'][1])
+        self.assertIn('Dockerfile.j2', files)
+        self.assertTrue(files['provision.sh'][0] & 0o100)  # still executable
+        self.assertEqual(files['stage'], (0o755, None))
+        self.assertEqual(files['stage/requirements.txt'], (0o644, b'six==1.16.0\n'))
+        self.assertEqual(files['stage/wheels'], (0o755, None))
+
+    def test_cached_context(self):
+        context = {'base_image': 'root', 'runtime': 'python3'}
+        templates = {'Dockerfile.j2': 'Dockerfile'}
+        data = grocker_contexts.get_cached_context(COMPILER_PACKAGE, templates, context)
+        self.assertIs(grocker_contexts.get_cached_context(COMPILER_PACKAGE, templates, dict(context)), data)
+        other_context = dict(context, runtime='python3.11')
+        other_data = grocker_contexts.get_cached_context(COMPILER_PACKAGE, templates, other_context)
+        self.assertIsNot(other_data, data)
+        self.assertIn(b'"python3.11"', read_archive(other_data)['Dockerfile'][1])
+
+
+class TemplateTestCase(unittest.TestCase):
+
+    def test_shared_environment(self):
+        env = grocker.helpers.get_template_environment()
+        self.assertIs(grocker.helpers.get_template_environment(), env)
+        template = env.get_template('docker/compiler-image/Dockerfile.j2')
+        self.assertIs(env.get_template('docker/compiler-image/Dockerfile.j2'), template)  # compiled once
+
+    def test_render_template_resource(self):
+        output = grocker.helpers.render_template_resource(
+            'grocker.resources.docker.runner-image', 'Dockerfile.j2',
+            {'base_image': 'root', 'ports': [8080], 'volumes': ['/data'], 'envs': {}},
+        )
+        self.assertIn('EXPOSE 8080\nVOLUME ["/data"]\n', output)
+        with self.assertRaises(ValueError):
+            grocker.helpers.render_template_resource('grocker', 'setup.py', {})
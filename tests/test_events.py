@@ -0,0 +1,65 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import unittest
+
+import grocker.events as grocker_events
+
+
+class ParseLineTestCase(unittest.TestCase):
+
+    def test_step(self):
+        event = grocker_events.parse_line('image', 'Step 3/9 : RUN /bin/sh /tmp/grocker/provision.sh')
+        self.assertIsInstance(event, grocker_events.StepEvent)
+        self.assertEqual((event.number, event.total), (3, 9))
+        self.assertEqual(event.instruction, 'RUN /bin/sh /tmp/grocker/provision.sh')
+
+    def test_pip(self):
+        for line, phase, detail in (
+            ('Collecting qrcode==5.2', 'collecting', 'qrcode==5.2'),
+            ('  Building wheel for pep8 (setup.py): started', 'building-wheel-for', 'pep8 (setup.py): started'),
+            ('Successfully installed pep8-1.7.0', 'successfully-installed', 'pep8-1.7.0'),
+        ):
+            event = grocker_events.parse_line('compiler', line)
+            self.assertIsInstance(event, grocker_events.PipEvent)
+            self.assertEqual((event.phase, event.detail), (phase, detail))
+
+    def test_error_and_output(self):
+        self.assertIsInstance(
+            grocker_events.parse_line('compiler', 'ERROR: No matching distribution found for unknown'),
+            grocker_events.ErrorEvent,
+        )
+        event = grocker_events.parse_line('compiler', ' ---> Running in 0123456789ab')
+        self.assertIsInstance(event, grocker_events.OutputEvent)
+        self.assertEqual(event.to_dict()['event'], 'output')
+        self.assertEqual(event.to_dict()['message'], ' ---> Running in 0123456789ab')
+
+
+class LineSplitterTestCase(unittest.TestCase):
+
+    def test_feed(self):
+        splitter = grocker_events.LineSplitter()
+        self.assertEqual(splitter.feed('first line\r\nsecond'), ['first line'])
+        self.assertEqual(splitter.feed(' line\n'), ['second line'])
+        self.assertEqual(splitter.feed('unterminated'), [])
+        self.assertEqual(splitter.flush(), ['unterminated'])
+        self.assertEqual(splitter.flush(), [])
+
+
+class RecorderTestCase(unittest.TestCase):
+
+    def test_step_durations(self):
+        with grocker_events.recording() as recorder:
+            for event in (
+                grocker_events.StartEvent('image', 'Sending build context', timestamp=10),
+                grocker_events.StepEvent('image', 'Step 1/2 : FROM root', 1, 2, 'FROM root', timestamp=11),
+                grocker_events.PipEvent('image', 'Collecting qrcode', 'collecting', 'qrcode', timestamp=12),
+                grocker_events.StepEvent('image', 'Step 2/2 : RUN app', 2, 2, 'RUN app', timestamp=12),
+                grocker_events.EndEvent('image', 'Build finished', success=True, timestamp=15),
+            ):
+                grocker_events.emit(event)
+
+        self.assertEqual(recorder.step_durations(), [
+            {'source': 'image', 'step': 'Sending build context', 'duration': 1},
+            {'source': 'image', 'step': 'FROM root', 'duration': 1},
+            {'source': 'image', 'step': 'RUN app', 'duration': 3},
+        ])
@@ -0,0 +1,94 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import unittest
+import unittest.mock
+
+import grocker.builders.op as grocker_op
+import grocker.registry
+
+PUSH_OUTPUT = [
+    {'status': 'The push refers to repository [registry.local/project]'},
+    {'status': 'Preparing', 'id': 'layer1'},
+    {'status': 'Pushing', 'id': 'layer1', 'progress': '[=>    ] 1MB/5MB'},
+    {'status': 'Pushing', 'id': 'layer1', 'progress': '[====> ] 4MB/5MB'},
+    {'status': 'Pushed', 'id': 'layer1'},
+    {'status': '1.0: digest: sha256:pushed size: 1234'},
+    {'aux': {'Tag': '1.0', 'Digest': 'sha256:pushed', 'Size': 1234}},
+]
+
+
+class FakeImage:
+
+    def __init__(self, image_id, repo_digests=()):
+        self.id = image_id
+        self.attrs = {'RepoDigests': list(repo_digests)}
+        self.tags = []
+
+    def tag(self, repository, tag):
+        self.tags.append('%s:%s' % (repository, tag))
+
+
+class FakeRegistryClient:
+
+    def __init__(self, digests):
+        self.digests = digests
+
+    def get_manifest_digests(self, names):
+        return {name: self.digests.get(name) for name in names}
+
+    def get_manifest(self, name, method='GET'):
+        return None
+
+
+class FakeClient:
+
+    def __init__(self, image, push_output):
+        self.image = image
+        self.push_output = push_output
+        self.pushed = []
+        self.api = self
+        self.images = self
+
+    def get(self, name):
+        return self.image
+
+    def push(self, repository, tag, stream, decode):
+        self.pushed.append('%s:%s' % (repository, tag))
+        return iter(self.push_output)
+
+
+class PublishImageTestCase(unittest.TestCase):
+
+    def test_push(self):
+        client = FakeClient(FakeImage('sha256:config'), PUSH_OUTPUT)
+        with self.assertLogs('grocker.builders.op', level='DEBUG') as logs:
+            digest = grocker_op._push(client, 'registry.local/project:1.0')
+        self.assertEqual(digest, 'sha256:pushed')
+        self.assertEqual(client.pushed, ['registry.local/project:1.0'])
+        pushing_logs = [line for line in logs.output if 'layer1 Pushing' in line]
+        self.assertEqual(len(pushing_logs), 2)  # status change, then progress (in debug)
+
+    def test_push_error(self):
+        client = FakeClient(FakeImage('sha256:config'), [{'error': 'denied: requested access is denied'}])
+        with self.assertRaisesRegex(RuntimeError, 'denied'):
+            grocker_op._push(client, 'registry.local/project:1.0')
+
+    def test_skip_published_image(self):
+        image = FakeImage('sha256:config', repo_digests=['registry.local/project@sha256:published'])
+        client = FakeClient(image, PUSH_OUTPUT)
+        registry_client = FakeRegistryClient({'registry.local/project:1.0': 'sha256:published'})
+        with unittest.mock.patch.object(grocker.registry, '_client', registry_client):
+            digest = grocker_op.docker_publish_image(client, 'registry.local/project:1.0')
+        self.assertEqual(digest, 'sha256:published')
+        self.assertEqual(client.pushed, [])
+
+    def test_push_extra_tags(self):
+        image = FakeImage('sha256:config')
+        client = FakeClient(image, PUSH_OUTPUT)
+        with unittest.mock.patch.object(grocker.registry, '_client', FakeRegistryClient({})):
+            digest = grocker_op.docker_publish_image(
+                client, 'registry.local/project:1.0', ['registry.local/project:latest'],
+            )
+        self.assertEqual(digest, 'sha256:pushed')
+        self.assertEqual(image.tags, ['registry.local/project:latest'])
+        self.assertEqual(client.pushed, ['registry.local/project:1.0', 'registry.local/project:latest'])
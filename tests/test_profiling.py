@@ -0,0 +1,40 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import unittest
+
+import grocker.profiling as grocker_profiling
+
+
+class ProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.profiler = grocker_profiling.Profiler()
+        self.profiler.origin = 100
+        self.profiler.add_span('compile wheels', 'phase', 101, 30, releases=['project==1.0'])
+        self.profiler.add_span('GET /images/root/json', 'docker', 101, 0.25, status=200)
+        self.profiler.add_span('GET /images/root/json', 'docker', 102, 0.5, status=404)
+        self.profiler.add_image_lookup('root', 'local')
+        self.profiler.add_image_lookup('compiler', 'build')
+
+    def test_summary(self):
+        summary = self.profiler.summary()
+        self.assertEqual(summary['phases'], [{'name': 'compile wheels', 'duration': 30, 'releases': ['project==1.0']}])
+        self.assertEqual(summary['docker_api'], {
+            'calls': 2,
+            'duration': 0.75,
+            'endpoints': {'GET /images/root/json': {'calls': 2, 'duration': 0.75}},
+        })
+        self.assertEqual(summary['image_lookups'], [
+            {'image': 'root', 'source': 'local', 'hit': True},
+            {'image': 'compiler', 'source': 'build', 'hit': False},
+        ])
+
+    def test_trace(self):
+        trace_events = self.profiler.trace()['traceEvents']
+        self.assertEqual([event['ph'] for event in trace_events], ['M', 'X', 'X', 'X'])
+        self.assertEqual(trace_events[1]['ts'], 1000000)
+        self.assertEqual(trace_events[1]['dur'], 30000000)
+        self.assertEqual(trace_events[1]['tid'], trace_events[0]['tid'])
+
+    def test_api_path(self):
+        self.assertEqual(grocker_profiling._api_path('/v1.41/images/root/json?all=1'), '/images/root/json')
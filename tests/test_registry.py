@@ -0,0 +1,130 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import http.server
+import json
+import threading
+import unittest
+
+import grocker.registry as grocker_registry
+
+MANIFEST = {'schemaVersion': 2, 'config': {'digest': 'sha256:config'}}
+
+
+class FakeRegistryHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def handle_request(self, send_body):
+        registry = self.server.registry
+        registry.requests.append((self.command, self.path))
+        if self.path.startswith('/token'):
+            return self.reply(200, {'token': 'secret-token', 'expires_in': 300}, send_body=send_body)
+        if self.headers.get('Authorization') != 'Bearer secret-token':
+            return self.reply(401, {}, send_body=send_body, headers={
+                'WWW-Authenticate': 'Bearer realm="http://%s/token",service="fake"' % registry.address,
+            })
+        if registry.failures:
+            registry.failures -= 1
+            return self.reply(503, {}, send_body=send_body)
+
+        if self.path == '/v2/project/manifests/1.0':
+            return self.reply(200, MANIFEST, send_body=send_body, headers={'Docker-Content-Digest': 'sha256:manifest'})
+        if self.path == '/v2/project/tags/list':
+            return self.reply(200, {'tags': ['1.0']}, send_body=send_body, headers={
+                'Link': '</v2/project/tags/list?last=1.0&n=1>; rel="next"',
+            })
+        if self.path == '/v2/project/tags/list?last=1.0&n=1':
+            return self.reply(200, {'tags': ['latest']}, send_body=send_body)
+        return self.reply(404, {}, send_body=send_body)
+
+    def reply(self, status, content, send_body, headers=None):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/vnd.docker.distribution.manifest.v2+json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+
+class FakeRegistry:
+
+    def __init__(self):
+        self.requests = []
+        self.failures = 0
+        self.server = http.server.ThreadingHTTPServer(('localhost', 0), FakeRegistryHandler)
+        self.server.registry = self
+        self.address = 'localhost:%s' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SplitImageNameTestCase(unittest.TestCase):
+
+    def test_split_image_name(self):
+        self.assertEqual(grocker_registry.split_image_name('project:1.0'), ('project', '1.0'))
+        self.assertEqual(
+            grocker_registry.split_image_name('registry:5000/project:1.0'), ('registry:5000/project', '1.0'),
+        )
+        self.assertEqual(
+            grocker_registry.split_image_name('registry:5000/project'), ('registry:5000/project', 'latest'),
+        )
+
+    def test_split_repository(self):
+        self.assertEqual(grocker_registry.split_repository('registry.local/team/app'), ('registry.local', 'team/app'))
+        self.assertEqual(grocker_registry.split_repository('localhost/project'), ('localhost', 'project'))
+        self.assertEqual(grocker_registry.split_repository('team/project'), ('registry-1.docker.io', 'team/project'))
+        self.assertEqual(grocker_registry.split_repository('python'), ('registry-1.docker.io', 'library/python'))
+
+
+class RegistryClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = FakeRegistry()
+        self.addCleanup(self.registry.close)
+        self.client = grocker_registry.RegistryClient(scheme='http', backoff=0.01, auth_config={})
+
+    def image(self, name):
+        return '%s/%s' % (self.registry.address, name)
+
+    def test_get_manifest(self):
+        manifest = self.client.get_manifest(self.image('project:1.0'))
+        self.assertEqual(manifest.digest, 'sha256:manifest')
+        self.assertEqual(manifest.content, MANIFEST)
+        self.assertIsNone(self.client.get_manifest(self.image('project:2.0')))
+
+    def test_token_is_cached(self):
+        self.assertEqual(self.client.get_manifest_digest(self.image('project:1.0')), 'sha256:manifest')
+        self.assertEqual(self.client.get_manifest_digest(self.image('project:1.0')), 'sha256:manifest')
+        token_requests = [path for _, path in self.registry.requests if path.startswith('/token')]
+        self.assertEqual(token_requests, ['/token?service=fake&scope=repository%3Aproject%3Apull'])
+        self.assertEqual(len(self.registry.requests), 4)  # challenge, token, then authenticated requests
+
+    def test_retry(self):
+        self.registry.failures = 2
+        self.assertEqual(self.client.get_manifest_digest(self.image('project:1.0')), 'sha256:manifest')
+
+    def test_get_manifest_digests(self):
+        names = [self.image('project:1.0'), self.image('project:2.0')]
+        self.assertEqual(
+            self.client.get_manifest_digests(names),
+            {names[0]: 'sha256:manifest', names[1]: None},
+        )
+
+    def test_list_tags(self):
+        self.assertEqual(self.client.list_tags(self.image('project')), ['1.0', 'latest'])
+        self.assertEqual(self.client.list_tags(self.image('unknown')), [])
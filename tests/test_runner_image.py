@@ -0,0 +1,60 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+import unittest.mock
+
+import fake_docker
+
+import grocker.scheduler as grocker_scheduler
+
+DEFAULT_OPTIONS = {name: None for name in grocker_scheduler.BUILD_OPTIONS}
+
+
+def read_archive(data):
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        return {
+            member.name: archive.extractfile(member).read() if member.isfile() else None
+            for member in archive
+        }
+
+
+class RunnerImageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        environ = unittest.mock.patch.dict(os.environ, {'XDG_CACHE_HOME': tmp_dir.name})  # wheel volume usage
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.docker_client = fake_docker.FakeDockerClient()
+
+    def build(self, build_dependencies=True, **options):
+        job = grocker_scheduler.BuildJob.from_options('project==1.0', dict(DEFAULT_OPTIONS, **options))
+        failed_jobs = grocker_scheduler.run(
+            self.docker_client, [job], pip_conf=None, build_dependencies=build_dependencies, push=False,
+        )
+        self.assertEqual(failed_jobs, [])
+        runner_builds = [build for build in self.docker_client.engine.builds if build['tag'] == 'project:1.0']
+        return read_archive(runner_builds[-1]['context'])
+
+    def test_unknown_wheels(self):
+        # Without record, the dependencies stage installs the release itself: its cache is never reused
+        build_ids = [self.build(build_dependencies=False)['dependencies/build-id'] for _ in range(2)]
+        self.assertNotEqual(build_ids[0], build_ids[1])
+        self.assertNotIn('dependencies/build-id', self.build())
+
+    def test_context_wheels(self):
+        files = self.build(runner_wheels='context')
+        wheels = {name: content for name, content in files.items() if name.endswith('.whl')}
+        self.assertEqual(wheels, {
+            'dependencies/wheels/six-1.16.0-py2.py3-none-any.whl': b'wheel content',
+            'app/wheels/project-1.0-py3-none-any.whl': b'wheel content',
+        })
+        self.assertIn(b'six==1.16.0 --hash=sha256:', files['dependencies/requirements.lock'])
+        self.assertIn(b'project==1.0 --hash=sha256:', files['app/requirements.lock'])
+        build, = [build for build in self.docker_client.engine.builds if build['tag'] == 'project:1.0']
+        self.assertIsNone(build['extra_hosts'])  # no wheel server
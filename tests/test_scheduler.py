@@ -0,0 +1,261 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import os
+import os.path
+import tempfile
+import textwrap
+import threading
+import unittest
+import unittest.mock
+
+import fake_docker
+
+import grocker.builders as grocker_builders
+import grocker.events as grocker_events
+import grocker.registry as grocker_registry
+import grocker.scheduler as grocker_scheduler
+import grocker.utils as grocker_utils
+
+DEFAULT_OPTIONS = {name: None for name in grocker_scheduler.BUILD_OPTIONS}
+
+
+def write_file(directory, name, content):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as fp:
+        fp.write(textwrap.dedent(content))
+    return path
+
+
+class ManifestTestCase(unittest.TestCase):
+
+    def test_load_manifest(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            write_file(tmp_dir, 'project.yml', """
+                dependencies:
+                    run: [libpq5]
+            """)
+            manifest_path = write_file(tmp_dir, 'builds.yml', """
+                builds:
+                    - release: first-project==1.0
+                      config: project.yml
+                    - release: second-project[extra]==2.0
+                      image_name: registry.local/second:2.0
+                      env: {SOME_VAR: value}
+            """)
+            options = dict(DEFAULT_OPTIONS, runtime='bookworm/3.12', image_prefix='registry.local')
+            jobs = grocker_scheduler.load_manifest(manifest_path, options)
+
+        self.assertEqual([job.release for job in jobs], ['first-project==1.0', 'second-project[extra]==2.0'])
+        self.assertEqual(jobs[0].image_name, 'registry.local/first-project:1.0')
+        self.assertEqual(jobs[0].config['dependencies']['run'], ('libpq5',))  # relative to the manifest
+        self.assertEqual(jobs[0].config['runtime'], 'bookworm/3.12')  # from command line options
+        self.assertEqual(jobs[1].image_name, 'registry.local/second:2.0')
+        self.assertEqual(jobs[1].config['envs'], {'SOME_VAR': 'value'})
+
+    def test_invalid_manifests(self):
+        for content in (
+            'builds: []',
+            'builds: [{config: project.yml}]',
+            'builds: [{release: project==1.0, unknown_option: 1}]',
+        ):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                manifest_path = write_file(tmp_dir, 'builds.yml', content)
+                with self.assertRaises(ValueError):
+                    grocker_scheduler.load_manifest(manifest_path, DEFAULT_OPTIONS)
+
+    def test_extra_tags(self):
+        options = dict(DEFAULT_OPTIONS, image_prefix='registry.local', extra_tag=['latest', 'other.local/project:1'])
+        job = grocker_scheduler.BuildJob.from_options('project==1.0', options)
+        self.assertEqual(job.extra_images, ['registry.local/project:latest', 'other.local/project:1'])
+
+    def test_unknown_runtime(self):
+        options = dict(DEFAULT_OPTIONS, runtime='unknown/1.0')
+        with self.assertRaises(RuntimeError):
+            grocker_scheduler.BuildJob.from_options('project==1.0', options)
+
+
+class GroupJobsTestCase(unittest.TestCase):
+
+    def test_group_jobs(self):
+        jobs = [
+            grocker_scheduler.BuildJob.from_options('first-project==1.0', DEFAULT_OPTIONS),
+            grocker_scheduler.BuildJob.from_options('second-project==1.0', dict(DEFAULT_OPTIONS, runtime='alpine/3')),
+            grocker_scheduler.BuildJob.from_options('third-project==1.0', dict(DEFAULT_OPTIONS, runtime='buster/3.9')),
+        ]
+        groups = grocker_scheduler.group_jobs(jobs)
+        self.assertEqual([[job.release for job in group] for group in groups], [
+            ['first-project==1.0', 'second-project==1.0'],
+            ['third-project==1.0'],
+        ])
+        self.assertEqual(
+            grocker_utils.config_identifier(groups[0][0].config),
+            grocker_utils.config_identifier(groups[0][1].config),
+        )
+
+    def test_compile_jobs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with unittest.mock.patch.dict(os.environ, {'XDG_CACHE_HOME': tmp_dir}):  # wheel volume usage
+                docker_client = fake_docker.FakeDockerClient()
+                job = grocker_scheduler.BuildJob.from_options('project==1.0', DEFAULT_OPTIONS)
+                failed_jobs = grocker_scheduler.run(
+                    docker_client, [job], pip_conf=None, build_image=False, push=False, compile_jobs=0,
+                )
+        self.assertEqual(failed_jobs, [])
+        compiler_run, = [run for run in docker_client.engine.runs if '--record' in run['command']]
+        self.assertIn('--jobs 0', ' '.join(compiler_run['command']))  # every available CPU
+
+
+class MatrixTestCase(unittest.TestCase):
+
+    def test_matrix(self):
+        options = dict(
+            DEFAULT_OPTIONS, runtime=('bookworm/3.12', 'alpine/3', 'bookworm/3.12'), image_prefix='registry.local',
+            extra_tag=['latest'],
+        )
+        jobs = grocker_scheduler.BuildJob.matrix('project==1.0', options)
+        self.assertEqual([job.config['runtime'] for job in jobs], ['bookworm/3.12', 'alpine/3'])
+        self.assertEqual([job.image_name for job in jobs], [
+            'registry.local/project:1.0-bookworm-3.12',
+            'registry.local/project:1.0-alpine-3',
+        ])
+        self.assertEqual(jobs[1].extra_images, ['registry.local/project:latest-alpine-3'])
+        self.assertEqual(len({grocker_builders.wheel_volume_name(job.config) for job in jobs}), 2)
+        self.assertIs(jobs[0].requirement, jobs[1].requirement)
+
+        jobs = grocker_scheduler.BuildJob.matrix('project==1.0', dict(DEFAULT_OPTIONS, runtime=['all']))
+        self.assertEqual([job.config['runtime'] for job in jobs], list(jobs[0].config['runtimes']))
+
+        job, = grocker_scheduler.BuildJob.matrix('project==1.0', dict(DEFAULT_OPTIONS, runtime=('alpine/3',)))
+        self.assertEqual(job.image_name, 'project:1.0')
+        with self.assertRaises(ValueError):
+            grocker_scheduler.BuildJob.from_options('project==1.0', dict(DEFAULT_OPTIONS, runtime=['alpine/3']))
+
+    def test_run_matrix(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with unittest.mock.patch.dict(os.environ, {'XDG_CACHE_HOME': tmp_dir}):  # wheel volume usage
+                docker_client = fake_docker.FakeDockerClient()
+                jobs = grocker_scheduler.BuildJob.matrix(
+                    'project==1.0', dict(DEFAULT_OPTIONS, runtime=('bookworm/3.12', 'alpine/3')),
+                )
+                self.assertEqual(grocker_scheduler.run(docker_client, jobs, pip_conf=None, push=False, workers=2), [])
+
+        for job in jobs:
+            self.assertIn(grocker_builders.wheel_volume_name(job.config), docker_client.engine.volume_files)
+            self.assertEqual(job.collect['runtime'], job.config['runtime'])
+            self.assertEqual([entry['name'] for entry in job.collect['lock']], ['project', 'six'])
+
+        # The wheel server address is not a build arg, which would change the cache key of the dependencies step
+        runner_builds = [build for build in docker_client.engine.builds if build['tag'].startswith('project:')]
+        self.assertEqual(len(runner_builds), 2)
+        for build in runner_builds:
+            self.assertEqual(sorted(build['buildargs']), ['GROCKER_BUILD_ID'])
+            self.assertEqual(build['extra_hosts'], {'grocker-wheels': '172.17.0.2'})
+
+
+class ImagePrefetcherTestCase(unittest.TestCase):
+
+    def test_prefetch(self):
+        lookups = []
+        wheel_server_lookup = threading.Event()
+
+        def get_or_build_image(docker_client, config, role):
+            if role == 'root':  # only returns if the wheel-server lookup runs concurrently
+                self.assertTrue(wheel_server_lookup.wait(timeout=5))
+            elif role == 'wheel-server':
+                wheel_server_lookup.set()
+            lookups.append(role)
+            return role
+
+        configs = [
+            grocker_scheduler.BuildJob.from_options('project==1.0', DEFAULT_OPTIONS).config,
+            grocker_scheduler.BuildJob.from_options('project==1.0', dict(DEFAULT_OPTIONS, env=['A=1'])).config,
+        ]
+        with unittest.mock.patch('grocker.builders.prefetch.get_or_build_image', get_or_build_image):
+            with grocker_builders.ImagePrefetcher(docker_client=None) as images:
+                for config in configs:  # same images
+                    images.prefetch(config)
+                self.assertEqual(images.get(configs[0], 'compiler'), 'compiler')
+
+        self.assertEqual(sorted(lookups), ['compiler', 'root', 'wheel-server'])  # each image looked up once
+        self.assertLess(lookups.index('root'), lookups.index('compiler'))  # compiler waits for root
+
+    def test_events(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with unittest.mock.patch.dict(os.environ, {'XDG_CACHE_HOME': tmp_dir}):  # wheel volume usage
+                docker_client = fake_docker.FakeDockerClient()
+                jobs = [
+                    grocker_scheduler.BuildJob.from_options('project-%d==1.0' % i, DEFAULT_OPTIONS) for i in range(2)
+                ]
+                with grocker_events.recording() as recorder:  # as a server job
+                    failed_jobs = grocker_scheduler.run(docker_client, jobs, pip_conf=None, push=False, workers=2)
+        self.assertEqual(failed_jobs, [])
+
+        # Image builds run in prefetching threads, and are part of the steps waiting for them
+        image_names = {role: grocker_builders.image_name(jobs[0].config, role) for role in ('root', 'compiler')}
+        recorded_sources = {event.source for event in recorder.events}
+        for job in jobs:
+            sources = [step['source'] for step in job.collect['steps']]
+            for name in image_names.values():
+                self.assertEqual(sources.count(name), 3)  # context upload, FROM and RUN steps, once
+                self.assertIn(name, recorded_sources)
+
+    def test_image_roles(self):
+        config = grocker_scheduler.BuildJob.from_options('project==1.0', DEFAULT_OPTIONS).config
+        self.assertEqual(grocker_scheduler.get_image_roles(config), ['root', 'compiler', 'wheel-server'])
+        self.assertEqual(grocker_scheduler.get_image_roles(config, build_dependencies=False), ['root', 'wheel-server'])
+        self.assertEqual(grocker_scheduler.get_image_roles(config, build_image=False), ['root', 'compiler'])
+        config = dict(config, runner_wheels='context')
+        self.assertEqual(grocker_scheduler.get_image_roles(config, build_dependencies=False), ['root'])
+
+
+class FakeRegistryClient:
+
+    def __init__(self, images):
+        self.images = images
+
+    def get_manifest_digest(self, name):
+        return 'sha256:published' if name in self.images else None
+
+
+class PlanTestCase(unittest.TestCase):
+
+    def test_plan(self):
+        options = dict(DEFAULT_OPTIONS, image_prefix='registry.local', extra_tag=['latest'])
+        job = grocker_scheduler.BuildJob.from_options('project==1.0', options)
+        root, compiler, wheel_server = (
+            grocker_builders.image_name(job.config, role) for role in ('root', 'compiler', 'wheel-server')
+        )
+        client = fake_docker.FakeDockerClient()
+        client.engine.add_image(root)
+        client.engine.add_volume(grocker_builders.wheel_volume_name(job.config))
+
+        with unittest.mock.patch.object(grocker_registry, '_client', FakeRegistryClient([compiler])):
+            plan = grocker_scheduler.plan(client, [job], workers=2)
+
+        self.assertEqual(plan['builds'][0]['images'], {
+            'root': {'image': root, 'source': 'local', 'action': 'use'},
+            'compiler': {'image': compiler, 'source': 'registry', 'action': 'pull'},
+            'wheel-server': {'image': wheel_server, 'source': None, 'action': 'build'},
+        })
+        self.assertTrue(plan['builds'][0]['wheel_volume']['exists'])
+        self.assertEqual(plan['builds'][0]['runner'], {
+            'image': 'registry.local/project:1.0', 'source': None, 'actions': ['build', 'push'],
+        })
+        self.assertEqual(plan['pull'], [compiler])
+        self.assertEqual(plan['build'], sorted([wheel_server, 'registry.local/project:1.0']))
+        self.assertEqual(plan['push'], sorted([
+            wheel_server, 'registry.local/project:1.0', 'registry.local/project:latest',
+        ]))
+        self.assertTrue(plan['cold'])  # the wheel server image is missing
+        self.assertEqual(client.calls['api.build'] + client.calls['images.pull'], 0)  # nothing done
+
+    def test_warm_plan(self):
+        job = grocker_scheduler.BuildJob.from_options('project==1.0', DEFAULT_OPTIONS)
+        client = fake_docker.FakeDockerClient()
+        for role in ('root', 'compiler'):
+            client.engine.add_image(grocker_builders.image_name(job.config, role))
+        client.engine.add_volume(grocker_builders.wheel_volume_name(job.config))
+
+        plan = grocker_scheduler.plan(client, [job], build_image=False, push=False)
+        self.assertFalse(plan['cold'])
+        self.assertEqual((plan['pull'], plan['build'], plan['push']), ([], [], []))
@@ -0,0 +1,143 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import http.client
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import fake_docker
+
+import grocker.scheduler as grocker_scheduler
+import grocker.server as grocker_server
+
+
+class FakeJob:
+
+    def __init__(self, job_id, key):
+        self.id = job_id
+        self.key = key
+        self.status = 'queued'
+
+    @property
+    def finished(self):
+        return self.status in ('succeeded', 'failed')
+
+    def set_status(self, status):
+        self.status = status
+
+    def cancel(self, error):
+        self.status = 'cancelled'
+
+
+class JobQueueTestCase(unittest.TestCase):
+
+    def test_per_config_limit(self):
+        lock = threading.Lock()
+        running = {}
+        peaks = {}
+
+        def run(job):
+            with lock:
+                running[job.key] = running.get(job.key, 0) + 1
+                peaks[job.key] = max(peaks.get(job.key, 0), running[job.key])
+            time.sleep(0.01)
+            with lock:
+                running[job.key] -= 1
+            job.set_status('succeeded')
+
+        queue = grocker_server.JobQueue(run, workers=4, per_config=1)
+        for i in range(12):
+            queue.submit(FakeJob(str(i), 'config-%d' % (i % 2)))
+        queue.close()
+
+        self.assertEqual(peaks, {'config-0': 1, 'config-1': 1})
+        self.assertTrue(all(job.status == 'succeeded' for job in queue.jobs.values()))
+
+    def test_crashed_job(self):
+        queue = grocker_server.JobQueue(lambda job: 1 / 0, workers=1)
+        job = FakeJob('1', 'config')
+        queue.submit(job)
+        queue.close()
+        self.assertEqual(job.status, 'failed')
+        with self.assertRaises(RuntimeError):
+            queue.submit(FakeJob('2', 'config'))
+
+    def test_close_cancel(self):
+        started, release = threading.Event(), threading.Event()
+
+        def run(job):
+            started.set()
+            release.wait(timeout=10)
+            job.set_status('succeeded')
+
+        queue = grocker_server.JobQueue(run, workers=1)
+        jobs = [FakeJob(str(i), 'config') for i in range(3)]
+        for job in jobs:
+            queue.submit(job)
+        started.wait(timeout=10)
+        threading.Timer(0.05, release.set).start()
+        queue.close(cancel=True)  # waits for the running job only
+        self.assertEqual([job.status for job in jobs], ['succeeded', 'cancelled', 'cancelled'])
+
+
+class ServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        environ = unittest.mock.patch.dict(os.environ, {'XDG_CACHE_HOME': tmp_dir.name})  # wheel volume usage
+        environ.start()
+        self.addCleanup(environ.stop)
+
+        self.docker_client = fake_docker.FakeDockerClient()
+        build_server = grocker_server.BuildServer(self.docker_client, workers=2)
+        self.addCleanup(build_server.__exit__, None, None, None)
+        http_server = grocker_server.make_http_server(build_server, address=('127.0.0.1', 0))
+        self.addCleanup(http_server.server_close)
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+        self.addCleanup(http_server.shutdown)
+        self.port = http_server.server_address[1]
+
+    def request(self, method, path, data=None):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        self.addCleanup(connection.close)
+        body = json.dumps(data) if data is not None else None
+        connection.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+        return connection.getresponse()
+
+    def test_build(self):
+        response = self.request('POST', '/jobs', {'release': 'project==1.0', 'push': False})
+        self.assertEqual(response.status, 202)
+        job = json.load(response)
+        self.assertEqual(job['release'], 'project==1.0')
+
+        response = self.request('GET', '/jobs/%s/events' % job['id'])
+        self.assertEqual(response.status, 200)
+        lines = [json.loads(line) for line in response.read().splitlines()]
+        result = lines[-1]
+        self.assertEqual(result['event'], 'result')
+        self.assertEqual(result['status'], 'succeeded')
+        self.assertEqual(result['result']['release'], 'project==1.0')
+        self.assertEqual([entry['name'] for entry in result['result']['lock']], ['project', 'six'])
+        self.assertGreater(len(lines), 1)  # the job events come first
+
+        response = self.request('GET', '/jobs')
+        self.assertEqual([job['status'] for job in json.load(response)['jobs']], ['succeeded'])
+
+    def test_cancelled_job(self):
+        options = dict.fromkeys(grocker_scheduler.BUILD_OPTIONS)
+        job = grocker_server.ServerJob('1', grocker_scheduler.BuildJob.from_options('project==1.0', options), {})
+        job.cancel('Cancelled: the server stopped')
+        job_dict = job.to_dict()
+        self.assertEqual((job_dict['status'], job_dict['error']), ('failed', 'Cancelled: the server stopped'))
+        self.assertEqual([event['event'] for event in job.follow()], ['error'])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.request('POST', '/jobs', {'push': False}).status, 400)
+        self.assertEqual(self.request('POST', '/jobs', {'release': 'project==1.0', 'color': 'red'}).status, 400)
+        self.assertEqual(self.request('GET', '/jobs/42').status, 404)
+        self.assertEqual(self.request('GET', '/nowhere').status, 404)
@@ -0,0 +1,23 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import json
+import subprocess  # noqa: S404
+import sys
+import unittest
+
+# Modules only imported by the commands using them (see grocker.__main__)
+HEAVY_MODULES = ('docker', 'requests', 'jinja2', 'yaml', 'packaging')
+
+
+def run_python(*args):
+    return subprocess.run(  # noqa: S603
+        [sys.executable, *args], check=True, capture_output=True, text=True,
+    )
+
+
+class StartupTestCase(unittest.TestCase):
+
+    def test_heavy_modules_not_imported(self):
+        output = run_python('-c', 'import json, sys, grocker.__main__; print(json.dumps(list(sys.modules)))').stdout
+        imported = {name.split('.')[0] for name in json.loads(output)}
+        self.assertEqual(imported.intersection(HEAVY_MODULES), set())
@@ -0,0 +1,105 @@
+# Copyright (c) Polyconseil SAS. All rights reserved.
+
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import docker.errors
+import fake_docker
+
+import grocker.builders.build as grocker_build
+import grocker.builders.naming as grocker_naming
+import grocker.utils as grocker_utils
+
+
+class SharedWheelServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        environ = unittest.mock.patch.dict(os.environ, {'XDG_CACHE_HOME': tmp_dir.name})  # wheel volume usage
+        environ.start()
+        self.addCleanup(environ.stop)
+        config_path = os.path.join(tmp_dir.name, '.grocker.yml')
+        with open(config_path, 'w') as fp:
+            fp.write('runner_wheels: shared-server\n')
+        self.config = grocker_utils.Config.parse([config_path])
+        self.name = grocker_naming.shared_wheel_server_name(self.config)
+        self.client = fake_docker.FakeDockerClient()
+
+    def get_server(self):
+        with grocker_build.wheel_server(self.client, self.config) as server_ip:
+            return server_ip
+
+    def test_start(self):
+        for _ in range(2):  # then once the previous one stopped, being idle
+            self.assertEqual(self.get_server(), '172.17.0.2')
+            container = self.client.engine.find_container(self.name)
+            self.client.api.stop(container['Id'])
+            self.assertIsNone(self.client.engine.find_container(self.name))  # auto removed
+        self.assertEqual(self.client.calls['containers.run'], 2)
+
+    def test_reuse(self):
+        self.assertEqual(self.get_server(), '172.17.0.2')
+        container = self.client.engine.find_container(self.name)
+        self.assertEqual(container['Labels'][grocker_naming.SHARED_WHEEL_SERVER_LABEL], (
+            grocker_naming.wheel_volume_name(self.config)
+        ))
+        self.assertTrue(container['AutoRemove'])
+
+        self.assertEqual(self.get_server(), '172.17.0.2')
+        self.assertEqual(self.client.calls['containers.run'], 1)
+        self.assertNotIn('api.remove_container', self.client.calls)
+        self.assertEqual(container['Signals'], ['SIGUSR1'])  # restarts its idle delay
+
+    def test_replace(self):
+        for state, health in (('exited', 'healthy'), ('running', 'unhealthy')):
+            with self.subTest(state=state, health=health):
+                self.get_server()
+                container = self.client.engine.find_container(self.name)
+                container['State'], container['Health'] = state, health
+                with unittest.mock.patch.object(grocker_build, 'SHARED_WHEEL_SERVER_RETRY_DELAY', 0):
+                    self.get_server()
+                self.assertNotIn(container['Id'], self.client.engine.containers)
+                self.assertIsNotNone(self.client.engine.find_container(self.name))
+
+    def test_starting(self):
+        self.get_server()
+        container = self.client.engine.find_container(self.name)
+        container['State'] = 'created'  # being started by another process
+
+        def sleep(delay):
+            container['State'] = 'running'
+
+        with unittest.mock.patch.object(grocker_build.time, 'sleep', sleep):
+            self.assertEqual(self.get_server(), '172.17.0.2')
+        self.assertIn(container['Id'], self.client.engine.containers)  # not replaced
+        self.assertEqual(self.client.calls['containers.run'], 1)
+
+    def test_removed_before_start(self):
+        run = self.client.containers.run
+        not_found = [docker.errors.NotFound('No such container')]
+
+        def racing_run(*args, **kwargs):
+            if not_found:  # another process removed it before it started
+                raise not_found.pop()
+            return run(*args, **kwargs)
+
+        with unittest.mock.patch.object(self.client.containers, 'run', racing_run):
+            self.assertEqual(self.get_server(), '172.17.0.2')
+        self.assertEqual(len(self.client.engine.containers), 1)
+
+    def test_started_by_another_process(self):
+        self.get_server()
+        inspect_container = self.client.api.inspect_container
+        not_found = [docker.errors.NotFound('No such container')]
+
+        def racing_inspect_container(container):
+            if not_found:  # the other process starts it after this lookup
+                raise not_found.pop()
+            return inspect_container(container)
+
+        with unittest.mock.patch.object(self.client.api, 'inspect_container', racing_inspect_container):
+            self.assertEqual(self.get_server(), '172.17.0.2')
+        self.assertEqual(len(self.client.engine.containers), 1)